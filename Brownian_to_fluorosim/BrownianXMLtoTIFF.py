@@ -11,12 +11,21 @@ from __future__ import print_function # imports print statement syntax from Pyth
 import sys
 import os
 import glob
+import collections
 import subprocess
 import time
+import shutil
+import tempfile
+import zipfile
+
+import compressed_io
+import frame_manifest
+import metrics
 
 USAGE_STR = '''USAGE:
 {program_name} [args] input_folder
         input_folder: the folder containing the XML files we are generating TIFF files from
+          (XML files can also be compressed, .xml.gz/.xml.bz2/.xml.xz, or bundled in .zip files)
         [args]: 
           [-red]: enables saving red color channel
           [-green]: enables saving green color channel
@@ -24,6 +33,13 @@ USAGE_STR = '''USAGE:
           [-simulator path]: specifies the path of Microscope Simulator
           [-out folder]: specifies the folder to output TIFF files to
           [-norename]: prevents automatic rename of files that look like output to have ordering on end
+          [-jobs count]: keeps count copies of Microscope Simulator running at once
+          [-timeout seconds]: stops a copy of Microscope Simulator that runs longer than seconds on one file
+          [-retries count]: runs a file again up to count times if Microscope Simulator fails or times out
+          [-resume]: skips the files an earlier run with the same settings finished (see the output
+            folder's .manifest.jsonl), as long as their XML file and TIFF files are unchanged
+          [-metrics file]: writes the time, bytes and memory of each stage and each Microscope Simulator run to file (.json, or .csv)
+          [-profile file]: profiles the loop running Microscope Simulator with cProfile into file
           [-h],[-help]: prints out usage information and exits
 '''
 
@@ -48,8 +64,19 @@ class commandParams :
         self.output_folder = "output_tiff"
         # rename enabled?
         self.rename = True
+        # how many copies of Microscope Simulator to run at once
+        self.jobs = 1
+        # seconds before giving up on one file (None waits forever) and how many times to try it again
+        self.timeout = None
+        self.retries = 0
+        # skip the files an earlier run finished
+        self.resume = False
+        # what the run measures, written to metrics_path if given, and where to put a profile
+        self.metrics = metrics.run_metrics( 'BrownianXMLtoTIFF' )
+        self.metrics_path = None
+        self.profile_path = None
         # folder to obtain TIFF files from
-        self.input_folder = os.path.realpath( sys.argv[-1] )
+        self.input_folder = os.path.realpath( arguments[-1] )
 
         # loop through arguments
         for i in range( 1, len( arguments ) - 1 ) :
@@ -60,11 +87,23 @@ class commandParams :
             elif arguments[i] == '-blue' or arguments[i] == '-b' :
                 self.blue = True
             elif arguments[i] == '-simulator' :
-                self.microscope_path = os.path.realpath( sys.argv[i+1] )
+                self.microscope_path = os.path.realpath( arguments[i+1] )
             elif arguments[i] == '-out' :
                 self.output_folder = arguments[i+1]
             elif arguments[i] == '-norename' :
                 self.rename = False
+            elif arguments[i] == '-jobs' :
+                self.jobs = max( 1, int( arguments[i+1] ) )
+            elif arguments[i] == '-timeout' :
+                self.timeout = float( arguments[i+1] )
+            elif arguments[i] == '-retries' :
+                self.retries = max( 0, int( arguments[i+1] ) )
+            elif arguments[i] == '-resume' :
+                self.resume = True
+            elif arguments[i] == '-metrics' :
+                self.metrics_path = arguments[i+1]
+            elif arguments[i] == '-profile' :
+                self.profile_path = arguments[i+1]
         # end loop through arguments
 
         # make sure that microscope_path is a file
@@ -100,10 +139,16 @@ class commandParams :
         if self.green : self.rgb_flags.append( '--green' )
         if self.blue : self.rgb_flags.append( '--blue' )
 
-        # get list of XML files in input_folder
+        # get list of XML files in input_folder, compressed ones and the ones in zip files
+        #  (as zip file path/member name) included
         self.file_list = glob.glob( os.path.join( self.input_folder, '*.xml' ) )
+        for compression in sorted( compressed_io.COMPRESSIONS.keys( ) ) :
+            self.file_list += glob.glob( os.path.join( self.input_folder, '*.xml' + compression ) )
+        for bundle_path in glob.glob( os.path.join( self.input_folder, '*.zip' ) ) :
+            with zipfile.ZipFile( bundle_path ) as bundle :
+                self.file_list += [ os.path.join( bundle_path, name ) for name in bundle.namelist( ) if name.endswith( '.xml' ) ]
         # we are going to sort by the integer after the last _ in each file name
-        getval = lambda x : int( x.split('_')[-1].split('.')[0] )
+        getval = lambda x : int( inputName( x ).split('_')[-1].split('.')[0] )
         # sort by the number
         self.file_list.sort( key = getval )
 
@@ -111,57 +156,186 @@ class commandParams :
 
         # generate list that will be what we want our outfiles to be named
         self.out_list = [ os.path.join( self.output_folder, 
-            os.path.splitext( os.path.basename( x ) )[0] + '_' ) for x in self.file_list ]    
+            os.path.splitext( inputName( x ) )[0] + '_' ) for x in self.file_list ]    
 
-def main( ) :
-    # did they want help?
-    if '-h' in sys.argv or '-help' in sys.argv :
-        print( USAGE_STR.format( program_name = sys.argv[0] ) )
-        sys.exit(1)
-    # parse our command line parameters
-    params = commandParams( sys.argv )
+def inputName ( path ) :
+    # file name of an XML file, without the compression extension
+    return compressed_io.strip_compression( os.path.basename( path ) )
+
+def stageInput ( params, i, scratch_folder ) :
+    # returns the path of a plain XML file of file i for Microscope Simulator to open,
+    #  decompressing it into scratch_folder if it is compressed or in a zip file
+    path = params.file_list[i]
+    if os.path.isfile( path ) and compressed_io.compression_of( path ) is None :
+        return path
+    staged_path = os.path.join( scratch_folder, inputName( path ) )
+    if os.path.isfile( path ) :
+        source = compressed_io.open_file( path, 'rb' )
+    else :
+        bundle = zipfile.ZipFile( os.path.dirname( path ) )
+        source = bundle.open( os.path.basename( path ) )
+    with open( staged_path, 'wb' ) as staged_file :
+        shutil.copyfileobj( source, staged_file )
+    source.close( )
+    if not os.path.isfile( path ) :
+        bundle.close( )
+    return staged_path
+
+def inputDigest ( params, i ) :
+    # what file i is, for the manifest: the hash of its file, or the CRC of its zip file member
+    path = params.file_list[i]
+    if os.path.isfile( path ) :
+        return frame_manifest.file_digest( path )
+    with zipfile.ZipFile( os.path.dirname( path ) ) as bundle :
+        info = bundle.getinfo( os.path.basename( path ) )
+    return '{0}:{1}'.format( info.CRC, info.file_size )
+
+def simulatorCommand ( params, i, input_path = None, out_prefix = None ) :
+    # makes a list with the arguments to process file i (read from input_path and
+    #  written to out_prefix if given)
+    if input_path is None :
+        input_path = params.file_list[i]
+    if out_prefix is None :
+        out_prefix = params.out_list[i]
+    command = [ params.microscope_path ]
+    # a Python stand-in for Microscope Simulator is run with this interpreter
+    if params.microscope_path.endswith( '.py' ) :
+        command = [ sys.executable ] + command
+    return command + [ '--batch-mode', '--open-simulation',
+        input_path, '--save-fluorescence-stack' ] + params.rgb_flags + [ out_prefix ]
+
+def partialFolder ( params, i ) :
+    # Microscope Simulator writes the output of file i into a folder of its own in the
+    #  output folder, so its files are found without listing the output folder
+    return frame_manifest.partial_path( params.out_list[i] )
 
+def finishOutput ( params, i ) :
+    # gives the files Microscope Simulator wrote for file i under their temporary names
+    #  their own, with the value of the file put on the end with rename; returns their paths
+    partial_folder = partialFolder( params, i )
+    prefix = os.path.basename( params.out_list[i] )
+    out_paths = [ ]
+    for name in sorted( os.listdir( partial_folder ) ) :
+        out_path = params.out_list[i] + name[len( prefix ):]
+        if params.rename :
+            # split apart the extension from the file path
+            spfext = os.path.splitext( out_path )
+            out_path = '{base}_{value}{ext}'.format( base = spfext[0], value = params.values[i], ext = spfext[1] )
+        out_paths.append( frame_manifest.commit( os.path.join( partial_folder, name ), out_path ) )
+    os.rmdir( partial_folder )
+    return out_paths
+
+def runSimulator ( params, start_time, scratch_folder, record, todo, manifest ) :
+    # runs Microscope Simulator on the files todo, keeping params.jobs copies running at once,
+    #  returns the list of indices of files that failed every try. Compressed files are
+    #  decompressed into scratch_folder only while their process runs. Output is written
+    #  into a temporary folder per file, and each file's is only renamed into place and added to
+    #  manifest once Microscope Simulator succeeded on it. Each run is added to
+    #  params.metrics, and the bytes of the files read and written to record
+    record['bytes_read'] = 0
+    record['bytes_written'] = 0
+    # open up devnull for sending output of subprocesses we will call to nothingness
+    devnull = open( os.devnull, 'w' )
+    # files still to process, as ( index, tries so far )
+    queue = collections.deque( ( i, 0 ) for i in todo )
+    # running processes, each with ( index, tries so far, time started, file opened )
+    running = { }
+    failed = [ ]
+    done = 0
+    while queue or running :
+        # start processes until we have params.jobs of them
+        while queue and len( running ) < params.jobs :
+            ( i, tries ) = queue.popleft( )
+            input_path = stageInput( params, i, scratch_folder )
+            partial_folder = partialFolder( params, i )
+            os.mkdir( partial_folder )
+            process = subprocess.Popen( simulatorCommand( params, i, input_path,
+                                        os.path.join( partial_folder, os.path.basename( params.out_list[i] ) ) ),
+                                        stdout = devnull, stderr = devnull )
+            running[process] = ( i, tries, time.time( ), input_path )
+        time.sleep( 0.05 )
+        # check on the running processes
+        for process in list( running.keys( ) ) :
+            ( i, tries, started, input_path ) = running[process]
+            code = process.poll( )
+            if code is None :
+                if params.timeout is None or time.time( ) - started < params.timeout :
+                    continue
+                # taking too long, stop it and count it as a failure
+                process.kill( )
+                process.wait( )
+                code = 'timeout'
+            del running[process]
+            params.metrics.subprocess( inputName( params.file_list[i] ), time.time( ) - started, code, tries + 1 )
+            record['bytes_read'] += os.path.getsize( input_path )
+            if input_path != params.file_list[i] :
+                os.remove( input_path )
+            if code != 0 :
+                # whatever it wrote is incomplete
+                shutil.rmtree( partialFolder( params, i ) )
+                if tries < params.retries :
+                    print( "'{}' failed ({}), trying again.".format( params.file_list[i], code ) )
+                    queue.append( ( i, tries + 1 ) )
+                    continue
+                print( "'{}' failed ({}), giving up.".format( params.file_list[i], code ) )
+                failed.append( i )
+            else :
+                out_paths = finishOutput( params, i )
+                manifest.add( inputName( params.file_list[i] ), out_paths, inputDigest( params, i ) )
+                record['bytes_written'] += sum( os.path.getsize( path ) for path in out_paths )
+            done += 1
+            # how much we have processed?
+            elapsed = time.time( ) - start_time
+            print( 'Processed {} out of {} files... {:.4f} seconds elapsed ({:.4f} files per second).'.format( done,
+                len( todo ), elapsed, done / max( elapsed, 1e-9 ) ) )
+    # end loop through all the files
+    devnull.close( )
+    return failed
+
+def xmlToTIFF ( params ) :
+    # runs Microscope Simulator on every XML file of params and renames the output,
+    #  returns the list of XML files that failed
     # get our start time
     start_time = time.time( )
 
-    # open up devnull for sending output of subprocesses we will cal to nothingness
-    devnull = open( os.devnull )
     print(params.input_folder,params.output_folder)
-    for i in range( len( params.file_list ) ) :
-        # how much we have processed?
-        print( 'Processed {} out of {} files... {:.4f} seconds elapsed.'.format( i, 
-            len( params.file_list ), time.time( ) - start_time ) )
-        # make a list with the arguments we are going to process
-        call_list = [ params.microscope_path, '--batch-mode', '--open-simulation',
-            params.file_list[i], '--save-fluorescence-stack' ] + params.rgb_flags + [ params.out_list[i] ]
-        # call it.
-        subprocess.call( call_list, stdout = devnull, stderr = devnull )
-    # end loop through all the files
+    # the output folder's manifest of finished files; with -resume those whose XML file
+    #  and output are unchanged are not run again
+    manifest = frame_manifest.frame_manifest( params.output_folder, { 'simulator' : params.microscope_path,
+        'channels' : params.rgb_flags, 'rename' : params.rename }, params.resume )
+    todo = [ i for i in range( len( params.file_list ) )
+             if not ( params.resume and manifest.finished( inputName( params.file_list[i] ), inputDigest( params, i ) ) ) ]
+    if params.resume :
+        print( 'Resumed: {} of {} files were already processed'.format( len( params.file_list ) - len( todo ), len( params.file_list ) ) )
+    # where compressed XML files are decompressed to while they are processed
+    scratch_folder = tempfile.mkdtemp( prefix = 'xml_' )
+    try :
+        with params.metrics.stage( 'simulator', len( todo ) ) as record, metrics.profiled( params.profile_path ) :
+            record['resumed'] = len( params.file_list ) - len( todo )
+            failed = runSimulator( params, start_time, scratch_folder, record, todo, manifest )
+    finally :
+        shutil.rmtree( scratch_folder, ignore_errors = True )
 
-    print( 'Processed {0} out of {0} files...'.format( len( params.file_list ) ) )
+    print( 'Processed {0} out of {0} files...'.format( len( todo ) ) )
+    if failed :
+        print( '{} files failed: {}'.format( len( failed ), ', '.join( params.file_list[i] for i in failed ) ) )
 
     print( 'Processing complete!' )
-    # do we need to rename the output?
     if params.rename :
-        # loop through all the outfile templates
-        for i in range( len( params.out_list ) ) :
-            # what value should we use?
-
-            # get files that match this pattern
-            matches = glob.glob( params.out_list[i] + '*' )
-
-            # rename each match
-            for path in matches :
-                # split apart the extension from the file path
-                spfext = os.path.splitext( path )
-                # make the new path
-                newpath = '{base}_{value}{ext}'.format( base = spfext[0], 
-                    value = params.values[i], ext = spfext[1] )
-                # rename
-                os.rename( path, newpath )
-        # end loop through all the files, done renaming
-        print( 'Renaming complete! You can import the different channels as image sequences in Fiji.' )
+        print( 'Output renamed! You can import the different channels as image sequences in Fiji.' )
+    if params.metrics_path is not None :
+        print( 'Metrics written to {}'.format( params.metrics.write( params.metrics_path ) ) )
     # we're done
+    return [ params.file_list[i] for i in failed ]
+
+def main( ) :
+    # did they want help?
+    if '-h' in sys.argv or '-help' in sys.argv :
+        print( USAGE_STR.format( program_name = sys.argv[0] ) )
+        sys.exit(1)
+    # parse our command line parameters
+    params = commandParams( sys.argv )
+    xmlToTIFF( params )
 
 # if this is the script being run, call main
 if __name__ == '__main__' :
@@ -7,18 +7,37 @@
 
 from __future__ import print_function # imports print statement syntax from Python 3
 
+import brownian_frames
 import colored_spheres_list
+import compressed_io
+import frame_manifest
+import metrics
+import fluorescence_render
+import src_masks
+import trajectory_store
 import sys
 import os
 import datetime
 import random
+import time
+import copy
+import multiprocessing
+import zipfile
 
+import numpy
+
+# default -cull margin, in standard deviations of the PSF
+CULL_SIGMAS = 5.0
 
 USAGE_STR = \
 '''Usage: 
 {program_name} [args] point_colors coordinates
-        point_colors: the output from brownianMotion of the points' colors
-        coordinates: the ouput from brownianMotion of the points' coordinates over time
+        point_colors: the output from brownianMotion of the points' colors, or a mask
+          store written by src_masks (pick the SRC with -src). A folder of color files
+          or a mask store without -src writes every SRC in one pass, each to out/SRC
+        coordinates: the ouput from brownianMotion of the points' coordinates over time,
+          or a trajectory store folder written by strechscript.processHeaderStore
+          (text files and point_colors can also be compressed: .gz, .bz2 or .xz)
         [args]:
           [-translate x y z]: constant vector to translate coordinates by
           [-random x y z]: translate coordinates by vector randomly selected between ([-x,x], [-y,y], [-z,z])
@@ -32,6 +51,8 @@ USAGE_STR = \
           [-sphere_radius radius]: set radius of spheres to radius (in brownianMotion units)
           [-fake_poles distance]: display fake spindle pole bodies, distance brownianMotion units away from origin
           [-nm_per conversion]: one brownianMotion unit is conversion nanometers
+          [-scale factor]: multiply coordinates by factor as they are read, before anything else (ChromoShake
+            .out files are in meters, -scale 1e6 reads them in microns without converting them first)
           [-pixel_size size]: the width and length of pixels in nanometers
           [-voxel_depth size]: the height of voxels in nanometers
           [-density low high]: sets the fluorophore densities for fake poles (low) and everything else (high)
@@ -39,6 +60,24 @@ USAGE_STR = \
           [-intensity max]: sets the maximum voxel intensity
           [-noise deviation]: sets Gaussian noise to be simulated in Microscope Simulator with some positive standard deviation
           [-every skip]: only outputs an XML file for every skip-th time steps
+          [-start time]: ignore time steps before time
+          [-end time]: ignore time steps after time
+          [-jobs count]: write XML files with count processes at once
+          [-render]: instead of XML files, render green channel TIFF stacks directly (no Microscope Simulator needed)
+          [-compress gz|bz2|xz]: write each XML file compressed (name.xml.gz, ...)
+          [-bundle]: write all XML files of the run into one zip file (deflated) instead of one file each
+          [-psf_sigma lateral axial]: standard deviations in nanometers of the Gaussian PSF used by -render
+          [-cull]: leave out spheres that cannot show up in the image: further than their radius plus a
+            margin from the imaged volume (slide width and height, focal planes)
+          [-cull_margin lateral axial]: the margin in nanometers (default 5 PSF sigmas, see -psf_sigma)
+          [-coalesce distance]: write the spheres of a color within distance nanometers of each other (directly or
+            through others) as one sphere with their fluorophores (below the spacing of neighbouring beads, or whole
+            chains of beads become one sphere)
+          [-resume]: keep the files an earlier run with the same settings finished in the output folder (see
+            its .manifest.jsonl) and only write the rest (not with -bundle)
+          [-src name]: the SRC to use when point_colors is a mask store
+          [-metrics file]: writes the time, speed, bytes and memory of each stage to file (.json, or .csv)
+          [-profile file]: profiles writing the time steps with cProfile into file (use -jobs 1 to see the work itself)
           [-h],[-help]: prints out usage information and exits
 '''
 
@@ -68,9 +107,13 @@ class userParams :
         pfile.close( )
         return ( name, gain )
 
-    # applies the basic translation vectors to coordinates vec
+    # reads the axes of vec in the order given by the -xyz, -xzy, ... flags
+    def axes_transform ( self, vec ) :
+        return tuple( vec[j] for j in self.axes_order )
+
+    # applies -scale and the basic translation vectors to coordinates vec
     def applyTranslation ( self, vec ) :
-        return tuple( x + y + z for x,y,z in zip( vec, self.translate_vector, self.random_vector ) )
+        return tuple( x * self.scale + y + z for x,y,z in zip( vec, self.translate_vector, self.random_vector ) )
 
     # takes coordinates in brownianMotion and converts to Microscope Simulator where origin moved to center of slide and slices
     def coordTransform ( self, vec ) :
@@ -81,6 +124,15 @@ class userParams :
                    ( rotated[2] * self.input_conversion ) + ( ( self.microscope_slices - 1 ) * self.voxel_depth ) / 2.0 )
         return scaled
 
+    # same as coordTransform, but for every row of a (N,3) array of coordinates at once
+    def coordTransformArray ( self, frame ) :
+        frame = numpy.asarray( frame, dtype = 'float64' )
+        if self.scale != 1.0 :
+            frame = frame * self.scale
+        translated = ( frame + self.translate_vector ) + self.random_vector
+        rotated = translated[:, self.axes_order]
+        return ( rotated * self.input_conversion ) + self.slide_center
+
     XML_STRING = '<?xml version="1.0" encoding="ISO-8859-1"?>\n<SimulatedExperiments file="{path}" modified="{time}" created="{time}"><Version major="2" minor="2" revision="1"/><AFMSimulation pixelSize="10.000000" imageWidth="300" imageHeight="300" clipGroundPlane="false" displayAsWireframe="false" surfaceOpacity="1.000000"/><FluorescenceSimulation focalPlaneIndex="0" focalPlaneSpacing="{voxel_depth:f}" numberOfFocalPlanes="{focal_planes_ct}" useCustomFocalPlanePositions="false" gain="{gain:f}" offset="0.000000" maximumVoxelIntensity="{max_voxel_intensity:f}" pixelSize="{pixel_size:f}" psfName="{point_spread}" imageWidth="{image_width}" imageHeight="{image_height}" shearInX="0.000000" shearInY="0.000000" addGaussianNoise="{use_noise}" noiseStdDev="{noise_stdev:f}" showImageVolumeOutline="false" showRefGrid="true" refGridSpacing="1000.000000" superimposeSimulatedImage="false" superimposeComparisonImage="false" minimumIntensityLevel="{min_intensity:f}" maximumIntensityLevel="{max_intensity:f}"><FocalPlanes><Plane index="0" position="0.000000"/><Plane index="1" position="0.000000"/><Plane index="2" position="0.000000"/><Plane index="3" position="0.000000"/><Plane index="4" position="0.000000"/><Plane index="5" position="0.000000"/><Plane index="6" position="0.000000"/><Plane index="7" position="0.000000"/><Plane index="8" position="0.000000"/><Plane index="9" position="0.000000"/><Plane index="10" position="0.000000"/><Plane index="11" position="0.000000"/><Plane index="12" position="0.000000"/><Plane index="13" position="0.000000"/><Plane index="14" position="0.000000"/><Plane index="15" position="0.000000"/><Plane index="16" position="0.000000"/><Plane index="17" position="0.000000"/><Plane index="18" position="0.000000"/><Plane index="19" position="0.000000"/><Plane index="20" position="0.000000"/><Plane index="21" position="0.000000"/><Plane index="22" position="0.000000"/><Plane index="23" position="0.000000"/><Plane index="24" position="0.000000"/><Plane index="25" position="0.000000"/><Plane index="26" position="0.000000"/><Plane index="27" position="0.000000"/><Plane index="28" position="0.000000"/><Plane index="29" position="0.000000"/></FocalPlanes><GradientDescentFluorescenceOptimizer><Iterations value="100"/><DerivativeEstimateStepSize value="1e-008"/><StepScaleFactor value="1"/><ObjectiveFunction name="Gaussian Noise Maximum Likelihood"/></GradientDescentFluorescenceOptimizer><NelderMeadFluorescenceOptimizer><MaximumIterations value="100"/><ParametersConvergenceTolerance value="1e-008"/><ObjectiveFunction name="Gaussian Noise Maximum Likelihood"/></NelderMeadFluorescenceOptimizer><PointsGradientFluorescenceOptimizer><StepSize value="1"/><Iterations value="100"/><ObjectiveFunction name=""/></PointsGradientFluorescenceOptimizer><FluorescenceComparisonImageModelObject name="None"/></FluorescenceSimulation>{model_object_list}</SimulatedExperiments>'
 
     def xmlString ( self, out_path, myModelObjectList ) :
@@ -112,20 +164,53 @@ class userParams :
         ret_str += "Fake distance: {}\n".format( self.fake_distance )
         ret_str += "Fake radius: {}\n".format( self.fake_radius )
         ret_str += "Input Conversion: {}\n".format( self.input_conversion )
+        ret_str += "Coordinate Scale: {}\n".format( self.scale )
         ret_str += "Pixel Size: {}\n".format( self.pixel_size )
         ret_str += "Voxel Depth: {}\n".format( self.voxel_depth )
         ret_str += "Fluorophore Densities: {}\n".format( self.fluorophore_density )
         ret_str += "Gaussian noise: {}\n".format( self.noise_stdev )
         ret_str += "Using every {}-th time steps\n".format( self.skip )
+        ret_str += "Time window: [{}, {}]\n".format( self.start_time, self.end_time )
+        ret_str += "Jobs: {}\n".format( self.jobs )
+        ret_str += "Render TIFF stacks directly: {}\n".format( self.render )
+        ret_str += "PSF sigma (lateral, axial): {}\n".format( self.psf_sigma )
+        ret_str += "Cull spheres outside the view: {}, margin (lateral, axial): {}\n".format( self.cull, self.cull_margin )
+        ret_str += "Coalesce spheres within: {}\n".format( self.coalesce )
+        ret_str += "XML compression: {}, bundled: {}\n".format( self.compress, self.bundle )
+        ret_str += "Resume earlier run: {}\n".format( self.resume )
         return ret_str
 
+    def outputSettings ( self ) :
+        # everything that changes what is written for a time step, or which time step
+        #  each output number is, for the manifests of the output folders
+        return { 'translate' : list( self.translate_vector ), 'random' : list( self.random_vector ),
+                 'axes' : list( self.axes_order ), 'colors' : list( self.use_colors ),
+                 'psf' : [ self.psf_name, self.psf_gain ], 'size' : [ self.microscope_width, self.microscope_height, self.microscope_slices ],
+                 'radii' : [ self.sphere_radius, self.fake_poles, self.fake_distance, self.fake_radius ],
+                 'units' : [ self.input_conversion, self.scale, self.pixel_size, self.voxel_depth ],
+                 'density' : list( self.fluorophore_density ), 'contrast' : list( self.constrast_levels ),
+                 'intensity' : self.max_voxel_intensity, 'noise' : self.noise_stdev,
+                 'frames' : [ self.skip, self.start_time, self.end_time ],
+                 'render' : [ self.render, list( self.psf_sigma ) ], 'compress' : self.compress,
+                 'cull' : [ self.cull, list( self.cull_margin ) ], 'coalesce' : self.coalesce }
+
+    def withOutput ( self, folder ) :
+        # returns a copy of these parameters writing to folder instead (making it if needed)
+        params = copy.copy( self )
+        params.use_colors = list( self.use_colors )
+        params.out_folder = os.path.realpath( folder )
+        assert not os.path.isfile( params.out_folder ), "'{0}' is the name of an already existing file".format( params.out_folder )
+        if not os.path.isdir( params.out_folder ) :
+            os.mkdir( params.out_folder )
+        return params
+
     def __init__ ( self, arguments ) :
         # constant vector to translate coordinates by
         self.translate_vector = ( 0.0, 0.0, 0.0 )
         # vector (x,y,z) such that we pick random number in [-x,x], [-y,y], [-z,z] to translate all vectors by
         self.random_bounds = ( 0.0, 0.0, 0.0 )
-        # function to change axes by
-        self.axes_transform = lambda vec : vec # identity
+        # order to read axes in (see axes_transform)
+        self.axes_order = [ 0, 1, 2 ] # identity
         # list with color integers to give fluorescence
         self.use_colors = [ 4 ]
         # details of PSF name and gain
@@ -146,6 +231,8 @@ class userParams :
         self.fake_radius = 0.150
         # number of nanometers per brownianMotion unit (typically in microns, so 1000)
         self.input_conversion = 1000.0
+        # factor coordinates are multiplied by as they are read (1e6 for ChromoShake .out files in meters)
+        self.scale = 1.0
         # pixel width in nanometers
         self.pixel_size = 63.0971
         # voxel depth in nanometers
@@ -161,6 +248,32 @@ class userParams :
         self.noise_stdev = 0.0
         # do every time step
         self.skip = 1
+        # from the first to the last time step
+        self.start_time = None
+        self.end_time = None
+        # write one XML file at a time
+        self.jobs = 1
+        # write XML files rather than rendering TIFF stacks ourselves, and the PSF
+        #  to render with (nanometers, roughly GFP at NA 1.4)
+        self.render = False
+        # write XML files compressed ( 'gz', 'bz2', 'xz' ) or all in one zip file
+        self.compress = None
+        self.bundle = False
+        # carry on from the files an earlier run finished in the output folder
+        self.resume = False
+        # what the run measures, written to metrics_path if given, and where to put a profile
+        self.metrics = metrics.run_metrics( 'ParseBrownian' )
+        self.metrics_path = None
+        self.profile_path = None
+        self.psf_sigma = ( 80.0, 200.0 )
+        # leave out spheres outside the imaged volume, with a margin in nanometers
+        #  (lateral, axial) for the PSF (None: CULL_SIGMAS PSF sigmas)
+        self.cull = False
+        self.cull_margin = None
+        # merge spheres within this many nanometers of each other (None: never)
+        self.coalesce = None
+        # SRC to take from a mask store
+        self.src_name = None
         # loop through the indices that index arguments (sort of inefficient)
         for i in range( len( arguments ) ) :
             if arguments[i] == '-translate' :
@@ -168,17 +281,17 @@ class userParams :
             elif arguments[i] == '-random' :
                 self.random_bounds = tuple( [ float( arguments[j] ) for j in range( i+1, i+4 ) ] )
             elif arguments[i] == '-xyz' :
-                self.axes_transform = lambda vec : vec
+                self.axes_order = [ 0, 1, 2 ]
             elif arguments[i] == '-xzy' :
-                self.axes_transform = lambda vec : ( vec[0], vec[2], vec[1] )
+                self.axes_order = [ 0, 2, 1 ]
             elif arguments[i] == '-yxz' :
-                self.axes_transform = lambda vec : ( vec[1], vec[0], vec[2] )
+                self.axes_order = [ 1, 0, 2 ]
             elif arguments[i] == '-yzx' :
-                self.axes_transform = lambda vec : ( vec[1], vec[2], vec[0] )
+                self.axes_order = [ 1, 2, 0 ]
             elif arguments[i] == '-zxy' :
-                self.axes_transform = lambda vec : ( vec[2], vec[0], vec[1] )
+                self.axes_order = [ 2, 0, 1 ]
             elif arguments[i] == '-zyx' :
-                self.axes_transform = lambda vec : ( vec[2], vec[1], vec[0] )
+                self.axes_order = [ 2, 1, 0 ]
             elif arguments[i] == '-use_colors' :
                 self.use_colors = self._getColors( arguments[i+1] )
             elif arguments[i] == '-PSF' :
@@ -199,6 +312,8 @@ class userParams :
                 self.fake_radius = float( arguments[i+2] )
             elif arguments[i] == '-nm_per' :
                 self.input_conversion = float( arguments[i+1] )
+            elif arguments[i] == '-scale' :
+                self.scale = float( arguments[i+1] )
             elif arguments[i] == '-pixel_size' :
                 self.pixel_size = float( arguments[i+1] )
             elif arguments[i] == '-voxel_depth' :
@@ -218,8 +333,41 @@ class userParams :
             elif arguments[i] == '-every' :
                 self.skip = int( arguments[i+1] )
                 if self.skip < 1 : self.skip = 1
+            elif arguments[i] == '-start' :
+                self.start_time = float( arguments[i+1] )
+            elif arguments[i] == '-end' :
+                self.end_time = float( arguments[i+1] )
+            elif arguments[i] == '-jobs' :
+                self.jobs = max( 1, int( arguments[i+1] ) )
+            elif arguments[i] == '-compress' :
+                self.compress = arguments[i+1]
+                assert self.compress in compressed_io.COMPRESSIONS.values( ), \
+                    "-compress must be one of {0}".format( sorted( compressed_io.COMPRESSIONS.values( ) ) )
+            elif arguments[i] == '-bundle' :
+                self.bundle = True
+            elif arguments[i] == '-resume' :
+                self.resume = True
+            elif arguments[i] == '-metrics' :
+                self.metrics_path = arguments[i+1]
+            elif arguments[i] == '-profile' :
+                self.profile_path = arguments[i+1]
+            elif arguments[i] == '-render' :
+                self.render = True
+            elif arguments[i] == '-cull' :
+                self.cull = True
+            elif arguments[i] == '-coalesce' :
+                self.coalesce = float( arguments[i+1] )
+            elif arguments[i] == '-cull_margin' :
+                self.cull_margin = tuple( [ float( arguments[j] ) for j in range( i+1, i+3 ) ] )
+            elif arguments[i] == '-psf_sigma' :
+                self.psf_sigma = tuple( [ float( arguments[j] ) for j in range( i+1, i+3 ) ] )
+            elif arguments[i] == '-src' :
+                self.src_name = arguments[i+1]
             # that's all the flags (for now, at least)
         # end loop through the arguments
+        assert not ( self.render and ( self.compress or self.bundle ) ), '-compress and -bundle only apply to XML files, not -render'
+        assert not ( self.compress and self.bundle ), 'use either -compress or -bundle'
+        assert not ( self.resume and self.bundle ), '-resume needs one file per time step, not -bundle'
         # correct out folder and make it
         self.out_folder = os.path.realpath( self.out_folder)
         assert not os.path.isfile( self.out_folder ), "'{0}' is the name of an already existing file".format( self.out_folder )
@@ -230,42 +378,125 @@ class userParams :
         self.random_vector = ( random.uniform( -self.random_bounds[0], self.random_bounds[0] ), 
                                random.uniform( -self.random_bounds[1], self.random_bounds[1] ), 
                                random.uniform( -self.random_bounds[2], self.random_bounds[2] ) )
+        # cache where the origin ends up on the slide, in nanometers
+        self.slide_center = ( ( self.microscope_width * self.pixel_size ) / 2.0,
+                              ( self.microscope_height * self.pixel_size ) / 2.0,
+                              ( ( self.microscope_slices - 1 ) * self.voxel_depth ) / 2.0 )
         # cache converted sphere and fake radii
         self.csphere_radius = self.sphere_radius * self.input_conversion
         self.cfake_radius = self.fake_radius * self.input_conversion
+        # the imaged volume, in nanometers on the slide: pixels cover the width and
+        #  height, focal planes sit from 0 to the last plane
+        if self.cull_margin is None :
+            self.cull_margin = ( CULL_SIGMAS * self.psf_sigma[0], CULL_SIGMAS * self.psf_sigma[1] )
+        self.view_low = numpy.zeros( 3 )
+        self.view_high = numpy.array( [ self.microscope_width * self.pixel_size, self.microscope_height * self.pixel_size,
+                                        ( self.microscope_slices - 1 ) * self.voxel_depth ] )
+        self.view_margin = numpy.array( [ self.cull_margin[0], self.cull_margin[0], self.cull_margin[1] ] )
 
 
-def main( ) :
-    # did they want help?
-    if '-h' in sys.argv or '-help' in sys.argv :
-        print( USAGE_STR.format( program_name = sys.argv[0] ) )
-        sys.exit(1)
-    # we have to have at least two arguments in addition to the program name.
-    assert len( sys.argv ) > 2, USAGE_STR.format( program_name = sys.argv[0] )
-    # okay, so let's get our parameters...
-    if not os.path.isfile( sys.argv[-2] ) :
-        print( "File {0} does not exist".format( sys.argv[-2] ) )
-        sys.exit(-1)
-    coordinates_colors = [ int(x) for x in open( sys.argv[-2] ).readlines( ) ]
-    coordinates_path = sys.argv[-1]
-    if not os.path.isfile( coordinates_path ) :
-        print( "File {0} does not exist".format( coordinates_path ) )
-        sys.exit(-2)
-    # get optional parameters from other arguments
-    params = userParams( sys.argv[1:-2] )
+# what each process writing XML files needs, set up once by _init_writer
+_writer = { }
 
-    # print out the parameters that we are using to stdout
-    print( params )
-    print( '\n' )
+def _init_writer ( params, coordinates_path, targets, num_points, out_prefix, frames = None ) :
+    # targets is a list of ( params, spheres_list, indices ): each gets its own output
+    #  folder and spheres, placed at the rows indices (all of them if None) of each time step
+    _writer['params'] = params
+    if frames is None :
+        frames = brownian_frames.open_frames( coordinates_path )
+    _writer['frames'] = frames
+    _writer['targets'] = targets
+    _writer['num_points'] = num_points
+    _writer['out_prefix'] = out_prefix
 
-    # get the number of points we should have for each time step
+def _output_name ( params, out_prefix, number ) :
+    # file name of the number-th output
+    if params.render :
+        return fluorescence_render.STACK_NAME.format( prefix = out_prefix, number = number, channel = 'green' )
+    # out_prefix + '_' + number + '.xml', compressed with -compress
+    name = "{}_{}.xml".format( out_prefix, number )
+    if params.compress is not None :
+        name += '.' + params.compress
+    return name
+
+def _write_output ( params, spheres_list, number, keep = None ) :
+    # writes spheres_list as the number-th XML file (or TIFF stack with -render) in
+    #  params.out_folder, returns its path (or ( file name, XML ) with -bundle). Only
+    #  the spheres True in keep are written if it is given. Files are written under
+    #  a temporary name and only get theirs once they are complete
+    out_path = os.path.join( params.out_folder, _output_name( params, _writer['out_prefix'], number ) )
+    if params.render :
+        # skip the XML and render the green channel ourselves
+        ( positions, radii, densities ) = spheres_list.select( params.use_colors, 'green', keep, params.coalesce )
+        fluorescence_render.write_render( frame_manifest.partial_path( out_path ), params, positions, radii, densities )
+        return frame_manifest.commit( frame_manifest.partial_path( out_path ), out_path )
+    # make our xml file
+    # get our ModelObjectList using params.use_colors
+    myModelObjectList = spheres_list.make_ModelObjectList( params.use_colors, keep, params.coalesce )
+    write_str = params.xmlString( compressed_io.strip_compression( out_path ), myModelObjectList )
+    if params.bundle :
+        # the process that opened the zip file writes it
+        return ( os.path.basename( out_path ), write_str )
+    write_file = compressed_io.open_file( frame_manifest.partial_path( out_path ), 'w' )
+    write_file.write( write_str )
+    write_file.flush( )
+    write_file.close( )
+    return frame_manifest.commit( frame_manifest.partial_path( out_path ), out_path )
+
+def _write_frame ( job ) :
+    # moves the spheres of every target to time step index and writes them as its
+    #  number-th output, returns ( time, [ path written for each target ], spheres culled,
+    #  spheres there were )
+    ( number, index ) = job
+    ( frame_time, frame ) = _writer['frames'].frame( index )
+    # transform the whole time step at once, once for all targets
+    positions = _writer['params'].coordTransformArray( frame[:_writer['num_points']] )
+    out_paths = [ ]
+    culled = 0
+    spheres = 0
+    for ( params, spheres_list, indices ) in _writer['targets'] :
+        # update our coordinates in spheres_list
+        spheres_list.update_coordinates( positions if indices is None else positions[indices] )
+        keep = None
+        total = spheres_list.get_colors_length( params.use_colors )
+        if params.cull :
+            # one bounds test for every sphere of the time step
+            keep = spheres_list.in_bounds( params.view_low, params.view_high, params.view_margin )
+            culled += total - spheres_list.get_colors_length( params.use_colors, keep )
+        spheres += total
+        out_paths.append( _write_output( params, spheres_list, number, keep ) )
+    return ( frame_time, out_paths, culled, spheres )
+
+def readColorSets ( path ) :
+    # returns [ ( name, colors ) ] for every SRC in a folder of color files or a mask store
+    if src_masks.is_mask_store( path ) :
+        store = src_masks.mask_store( path )
+        return [ ( name, store.colors( name ) ) for name in store.names ]
+    return [ ( src_masks.src_name( name ), readColors( os.path.join( path, name ) ) )
+             for name in sorted( os.listdir( path ) ) ]
+
+def readColors ( path, name = None ) :
+    # reads the color of each point from path, one integer per line, or of SRC name
+    #  if path is a mask store
+    if src_masks.is_mask_store( path ) :
+        store = src_masks.mask_store( path )
+        assert name in store, "'{0}' is not an SRC of {1}".format( name, path )
+        return store.colors( name )
+    with compressed_io.open_file( path, 'r' ) as colors_file :
+        return [ int(x) for x in colors_file.readlines( ) ]
+
+def makeSpheresList ( params, coordinates_colors, spheres_list = None ) :
+    # returns a spheres list with one sphere per point in coordinates_colors (plus fake
+    #  spindle pole bodies if asked for), reusing spheres_list when it has the right size
     num_points = len( coordinates_colors )
-    print("num_points ",num_points)
+    if spheres_list is not None and not params.fake_poles and spheres_list.count( ) == num_points :
+        spheres_list.set_colors( coordinates_colors )
+        return spheres_list
+
     # make a spheres list and preallocate with spheres at (0,0,0) and correct colors (two extra for spindles)
     spheres_list = colored_spheres_list.colored_spheres_list( params.csphere_radius, num_points + 2 )
-    for i in range( num_points ) :
-        # add the spheres, put them with fluorophore density params.fluorophore_density[1] and color 'green'
-        spheres_list.add_sphere( 0.0, 0.0, 0.0, coordinates_colors[i], params.fluorophore_density[1], 'green' )
+    # add the spheres, put them with fluorophore density params.fluorophore_density[1] and color 'green'
+    spheres_list.add_spheres( numpy.zeros( ( num_points, 3 ) ), coordinates_colors, params.fluorophore_density[1], 'green' )
 
     # add fake spindle if desired (color 'blue')
     if params.fake_poles :
@@ -283,52 +514,134 @@ def main( ) :
         spheres_list.add_sphere( fake_top[0], fake_top[1], fake_top[2], fake_color, 'blue' )
         spheres_list.add_sphere( fake_bottom[0], fake_bottom[1], fake_bottom[2], fake_color, 'blue' )
     # end add fake spindle
+    return spheres_list
 
-    # now open coordinates file
-    coordinates_file = open( coordinates_path )
+def parseBrownian ( params, coordinates_colors, coordinates_path, frames = None, spheres_list = None ) :
+    # writes an XML file (or TIFF stack with -render) to params.out_folder for each selected
+    #  time step of coordinates_path, with points colored by coordinates_colors. frames (from
+    #  brownian_frames.open_frames) can be passed in to reuse it between calls, as can
+    #  spheres_list if it was made for coordinates_colors by makeSpheresList. Returns the
+    #  list of times written.
+
+    # get the number of points we should have for each time step
+    num_points = len( coordinates_colors )
+    print("num_points ",num_points)
+    if spheres_list is None :
+        spheres_list = makeSpheresList( params, coordinates_colors )
 
     # make prefix for output XML files
-    out_prefix = os.path.splitext( os.path.basename( coordinates_path ) )[0]
+    out_prefix = os.path.splitext( compressed_io.strip_compression( os.path.basename( os.path.normpath( coordinates_path ) ) ) )[0]
     print(out_prefix)
-    # loop through the file over each time step
-    count = 0 # record how many times we have passed
+    return _writeFrames( params, coordinates_path, [ ( params, spheres_list, None ) ], num_points, out_prefix, frames )
+
+def parseBrownianSets ( params, color_sets, coordinates_path, frames = None, folders = None ) :
+    # like parseBrownian for every ( name, colors ) in color_sets at once, writing each
+    #  to its own folder params.out_folder/name (or the matching entry of folders if
+    #  given). Each time step is read and transformed
+    #  once, and each SRC only keeps the spheres it writes out. Returns the list of times written.
+    assert not params.fake_poles, 'fake poles are not supported with several SRCs'
+    num_points = max( [ len( colors ) for ( name, colors ) in color_sets ] )
+    print( "num_points ", num_points )
+    if folders is None :
+        folders = [ os.path.join( params.out_folder, name ) for ( name, colors ) in color_sets ]
+    targets = [ ]
+    for ( ( name, colors ), folder ) in zip( color_sets, folders ) :
+        # the spheres of a color that is not used never reach the output
+        indices = numpy.flatnonzero( numpy.isin( colors, params.use_colors ) )
+        spheres_list = makeSpheresList( params, numpy.asarray( colors )[indices].tolist( ) )
+        targets.append( ( params.withOutput( folder ), spheres_list, indices ) )
+    out_prefix = os.path.splitext( compressed_io.strip_compression( os.path.basename( os.path.normpath( coordinates_path ) ) ) )[0]
+    print( out_prefix )
+    return _writeFrames( params, coordinates_path, targets, num_points, out_prefix, frames )
+
+def _writeFrames ( params, coordinates_path, targets, num_points, out_prefix, frames = None ) :
+    # writes the selected time steps of coordinates_path for each target (see _init_writer)
     times = [] # record all the times that we have used
-    read_line = coordinates_file.readline( )
-    while read_line != '' :
-        assert read_line[:4] == 'Time', 'Current line should tell us the time'
-        if count % params.skip == 0 : # is this a time that we will record?
-            # get the current time
-            times.append( float( read_line[4:] ) )
-            # out path is out_prefix + '_' + len(times) + '.xml'
-            out_path = os.path.join( params.out_folder, "{}_{}.xml".format( out_prefix, len(times) ) )
-            print( 'Time {:.4f} output to {}'.format( times[-1], out_path ) )
-            # update our coordinates:
-            for i in range( num_points ) :
-                coordinates = params.coordTransform( tuple( float(x) for x in coordinates_file.readline( ).split(' ') ) )
-                # update coordinates in spheres_list
-                spheres_list.update_coordinate( i, coordinates[0], coordinates[1], coordinates[2] )
-            # make our xml file
-            # get our ModelObjectList using params.use_colors
-            myModelObjectList = spheres_list.make_ModelObjectList( params.use_colors )
-            write_str = params.xmlString( out_path, myModelObjectList )
-            write_file = open( out_path, 'w' )
-            write_file.write( write_str )
-            write_file.flush( )
-            write_file.close( )
-        else : # so we don't want to record this one
-            for i in range( num_points ) :
-                coordinates_file.readline( )
-
-        # add to the number of times we have passed
-        count += 1
-        # read an empty line
-        coordinates_file.readline( )
-        # start the next time step (or read EOF)
-        read_line = coordinates_file.readline( )
-    # finished reading last time step
-
-    # we should be done now, close the file
-    coordinates_file.close( )
+
+    # pick the time steps we want, jobs are ( output number, time step index )
+    if frames is None :
+        frames = brownian_frames.open_frames( coordinates_path )
+    assert frames.beads >= num_points, \
+        'Coordinates have {0} beads, colors file has {1}'.format( frames.beads, num_points )
+    selected = brownian_frames.select_frames( frames.times, params.skip, params.start_time, params.end_time )
+    jobs = list( enumerate( selected.tolist( ), 1 ) )
+
+    # each target folder keeps a manifest of the time steps finished in it, made from
+    #  the same coordinates, settings and spheres; with -resume those are not written again
+    manifests = [ ]
+    if not params.bundle :
+        coordinates = [ os.path.realpath( coordinates_path ), os.path.getmtime( coordinates_path ) ]
+        for ( target_params, spheres_list, indices ) in targets :
+            settings = dict( target_params.outputSettings( ), coordinates = coordinates, prefix = out_prefix,
+                             spheres = spheres_list.digest( ), beads = None if indices is None else len( indices ) )
+            manifests.append( frame_manifest.frame_manifest( target_params.out_folder, settings, params.resume ) )
+    resumed = 0
+    if params.resume :
+        total = len( jobs )
+        jobs = [ ( number, index ) for ( number, index ) in jobs
+                 if not all( manifest.finished( _output_name( params, out_prefix, number ), index ) for manifest in manifests ) ]
+        resumed = total - len( jobs )
+
+    # start writing time steps, either here or spread over params.jobs processes that each
+    #  read their own time steps from coordinates_path
+    # the hot loop, timed (and profiled with -profile) as one stage
+    written = 0
+    culled = 0
+    spheres = 0
+    with params.metrics.stage( 'write_frames', len( jobs ) ) as record, metrics.profiled( params.profile_path ) :
+        start_time = time.time( )
+        writer_args = ( params, coordinates_path, targets, num_points, out_prefix )
+        # with -bundle the XML files of each target go into one zip file written here
+        bundles = [ ]
+        if params.bundle :
+            bundles = [ zipfile.ZipFile( os.path.join( target_params.out_folder, out_prefix + '_xml.zip' ), 'w', zipfile.ZIP_DEFLATED )
+                        for ( target_params, spheres_list, indices ) in targets ]
+        if params.jobs > 1 :
+            pool = multiprocessing.Pool( params.jobs, _init_writer, writer_args )
+            results = pool.imap( _write_frame, jobs, max( 1, min( 16, len( jobs ) // ( 4 * params.jobs ) ) ) )
+        else :
+            pool = None
+            _init_writer( *writer_args, frames = frames )
+            results = ( _write_frame( job ) for job in jobs )
+        try :
+            for ( ( number, index ), ( frame_time, out_paths, frame_culled, frame_spheres ) ) in zip( jobs, results ) :
+                culled += frame_culled
+                spheres += frame_spheres
+                times.append( frame_time )
+                for ( manifest, out_path ) in zip( manifests, out_paths ) :
+                    manifest.add( os.path.basename( out_path ), [ out_path ], index )
+                if bundles :
+                    for ( bundle, ( name, write_str ) ) in zip( bundles, out_paths ) :
+                        bundle.writestr( name, write_str )
+                    out_paths = [ bundle.filename for bundle in bundles ]
+                if not bundles :
+                    written += sum( os.path.getsize( out_path ) for out_path in out_paths )
+                if len( out_paths ) == 1 :
+                    print( 'Time {:.4f} output to {}'.format( times[-1], out_paths[0] ) )
+                else :
+                    print( 'Time {:.4f} output to {} folders'.format( times[-1], len( out_paths ) ) )
+        finally :
+            for bundle in bundles :
+                bundle.close( )
+                written += os.path.getsize( bundle.filename )
+        if pool is not None :
+            pool.close( )
+            pool.join( )
+        record['bytes_read'] = frames.frame_bytes( [ index for ( number, index ) in jobs ] )
+        record['bytes_written'] = written
+        record['culled'] = culled
+        record['resumed'] = resumed
+    elapsed = time.time( ) - start_time
+    # finished writing last time step
+
+    print( '\n' )
+    if params.resume :
+        print( 'Resumed: {} of {} time steps were already written'.format( resumed, resumed + len( jobs ) ) )
+    print( 'Wrote {} time steps in {:.2f} seconds ({:.2f} frames per second)'.format( len( times ),
+        elapsed, len( times ) / max( elapsed, 1e-9 ) ) )
+    if params.cull :
+        print( 'Culled {} of {} spheres outside the field of view ({:.1f}%)'.format( culled, spheres,
+            100.0 * culled / max( spheres, 1 ) ) )
 
     # print out the average time step
     if len( times ) > 1 :
@@ -336,6 +649,43 @@ def main( ) :
         average_time_step = sum( time_steps ) / len( time_steps )
         print( '\n' )
         print( 'Average Time Step: {:.4f}'.format( average_time_step ) )
+    return times
+
+def main( ) :
+    # did they want help?
+    if '-h' in sys.argv or '-help' in sys.argv :
+        print( USAGE_STR.format( program_name = sys.argv[0] ) )
+        sys.exit(1)
+    # we have to have at least two arguments in addition to the program name.
+    assert len( sys.argv ) > 2, USAGE_STR.format( program_name = sys.argv[0] )
+    # okay, so let's get our parameters...
+    if not os.path.exists( sys.argv[-2] ) :
+        print( "File {0} does not exist".format( sys.argv[-2] ) )
+        sys.exit(-1)
+    coordinates_path = sys.argv[-1]
+    if not ( os.path.isfile( coordinates_path ) or trajectory_store.is_store( coordinates_path ) ) :
+        print( "File {0} does not exist".format( coordinates_path ) )
+        sys.exit(-2)
+    # get optional parameters from other arguments
+    params = userParams( sys.argv[1:-2] )
+    # a folder of color files or a mask store without -src: every SRC in one pass
+    several = os.path.isdir( sys.argv[-2] ) or ( src_masks.is_mask_store( sys.argv[-2] ) and params.src_name is None )
+    with params.metrics.stage( 'read_colors' ) :
+        if several :
+            color_sets = readColorSets( sys.argv[-2] )
+        else :
+            coordinates_colors = readColors( sys.argv[-2], params.src_name )
+
+    # print out the parameters that we are using to stdout
+    print( params )
+    print( '\n' )
+
+    if several :
+        parseBrownianSets( params, color_sets, coordinates_path )
+    else :
+        parseBrownian( params, coordinates_colors, coordinates_path )
+    if params.metrics_path is not None :
+        print( 'Metrics written to {}'.format( params.metrics.write( params.metrics_path ) ) )
 
 # run main if this is what's being run
 if __name__ == '__main__' :
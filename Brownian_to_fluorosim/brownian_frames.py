@@ -0,0 +1,206 @@
+# brownian_frames.py
+# Purpose: one shared reader for the text output of ChromoShake/brownianMotion
+#  (and the micron copies made from it by strechscript), yielding each time step
+#  as a NumPy array instead of walking the file one coordinate at a time.
+
+# The files look like:
+#   <header lines, ignored>
+#   Time <t>
+#   <x> <y> <z> [more columns, ignored]     (one line per bead)
+#   <blank line>
+#   Time <t>
+#   ...
+
+# The first time a file is read, the byte offset and time of every time step
+#  is saved next to it (<file>.idx.npz), so selecting time steps, counting beads
+#  and counting time steps afterwards does not need to read the file again.
+#  Files compressed with gzip, bzip2 or xz (.gz, .bz2, .xz) are read the same
+#  way; offsets are then into the decompressed text, and reading time steps in
+#  order streams through the file once.
+
+import os
+import tempfile
+import zipfile
+
+import numpy
+
+import compressed_io
+import frame_manifest
+import trajectory_store
+
+INDEX_SUFFIX = '.idx.npz'
+
+
+def _parse_block ( lines ) :
+    # parses the coordinate lines of one time step in bulk, returns a (beads, 3) array
+    values = numpy.fromstring( b'\n'.join( lines ), dtype = 'float64', sep = ' ' )
+    assert len( values ) % len( lines ) == 0, \
+        'Coordinate lines of a time step have differing numbers of columns'
+    return values.reshape( len( lines ), -1 )[:, :3]
+
+
+def _scan ( path ) :
+    # one pass over path, returns ( offsets, times, beads ) of its complete time steps
+    offsets = [ ]
+    times = [ ]
+    # number of lines following each 'Time' line
+    lines = [ ]
+    beads = None
+    position = 0
+    with compressed_io.open_file( path, 'rb' ) as text_file :
+        for line in text_file :
+            if line[:4] == b'Time' :
+                if offsets and beads is None :
+                    beads = lines[-1]
+                offsets.append( position )
+                times.append( float( line[4:] ) )
+                lines.append( 0 )
+            elif offsets :
+                if beads is None and line.strip( ) == b'' :
+                    beads = lines[-1]
+                lines[-1] += 1
+            position += len( line )
+    if beads is None :
+        beads = lines[-1] if lines else 0
+    # the last time step may have been cut off
+    if lines and lines[-1] < beads :
+        offsets.pop( )
+        times.pop( )
+    return ( offsets, times, beads )
+
+
+class frame_index :
+    # byte offset and time of each time step in a text file, loaded from the
+    #  sidecar file when it is up to date and rebuilt (and saved) otherwise
+
+    def __init__ ( self, path ) :
+        self.path = path
+        stat = os.stat( path )
+        index_path = path + INDEX_SUFFIX
+        if os.path.isfile( index_path ) :
+            try :
+                saved = numpy.load( index_path )
+                if int( saved['size'] ) == stat.st_size and float( saved['mtime'] ) == stat.st_mtime :
+                    self.offsets = saved['offsets']
+                    self.times = saved['times']
+                    self.beads = int( saved['beads'] )
+                    return
+            except ( IOError, OSError, ValueError, KeyError, zipfile.BadZipfile ) :
+                # unreadable, scan the file again
+                pass
+        ( offsets, times, self.beads ) = _scan( path )
+        self.offsets = numpy.array( offsets, dtype = 'int64' )
+        self.times = numpy.array( times, dtype = 'float64' )
+        try :
+            # written under a name of its own and renamed into place, so processes on
+            #  several machines can index the same file at once
+            ( handle, partial ) = tempfile.mkstemp( prefix = frame_manifest.PARTIAL_PREFIX, dir = os.path.dirname( os.path.abspath( index_path ) ) )
+            with os.fdopen( handle, 'wb' ) as index_file :
+                numpy.savez( index_file, offsets = self.offsets, times = self.times, beads = self.beads,
+                             size = stat.st_size, mtime = stat.st_mtime )
+            frame_manifest.commit( partial, index_path )
+        except ( IOError, OSError ) :
+            # read-only location, keep the index in memory only
+            pass
+        return
+
+    def __len__ ( self ) :
+        return len( self.offsets )
+
+    def read_frame ( self, binary_file, index, scale = 1.0, beads = None ) :
+        # reads time step index from binary_file (path opened with compressed_io.open_file),
+        #  returns a (beads, 3) float64 array
+        if beads is None :
+            beads = self.beads
+        assert beads <= self.beads, \
+            'Asked for {0} beads, time steps only have {1}'.format( beads, self.beads )
+        binary_file.seek( self.offsets[index] )
+        if index + 1 < len( self.offsets ) :
+            block = binary_file.read( self.offsets[index + 1] - self.offsets[index] )
+        else :
+            block = binary_file.read( )
+        # first line is 'Time', then one line per bead
+        lines = block.split( b'\n', beads + 1 )[1:beads + 1]
+        frame = _parse_block( lines )
+        if scale != 1.0 :
+            frame = frame * scale
+        return frame
+
+    def frame_bytes ( self, indices ) :
+        # bytes of text (decompressed) reading time steps indices takes; the last time
+        #  step has no offset after it and is counted as long as the one before it
+        sizes = numpy.diff( self.offsets )
+        sizes = numpy.append( sizes, sizes[-1] if len( sizes ) else 0 )
+        return int( sizes[numpy.asarray( indices, dtype = 'int64' )].sum( ) )
+
+
+class text_frames :
+    # random access to the time steps of a text file through its frame index,
+    #  same interface as trajectory_store.trajectory_store
+
+    def __init__ ( self, path ) :
+        self.path = path
+        self.index = frame_index( path )
+        self.times = self.index.times
+        self.beads = self.index.beads
+        # opened on first use, so each process reading frames gets its own handle
+        self._file = None
+        return
+
+    def __len__ ( self ) :
+        return len( self.index )
+
+    def frame ( self, index ) :
+        # returns ( time, coordinates ) of time step index, coordinates as a float64 (beads, 3) array
+        if self._file is None :
+            self._file = compressed_io.open_file( self.path, 'rb' )
+        return ( float( self.times[index] ), self.index.read_frame( self._file, index ) )
+
+    def frame_bytes ( self, indices ) :
+        # bytes read for time steps indices
+        return self.index.frame_bytes( indices )
+
+    def iter_frames ( self, indices = None ) :
+        # yields ( time, coordinates ) for each time step in indices (all time steps if None)
+        if indices is None :
+            indices = range( len( self ) )
+        for index in indices :
+            yield self.frame( index )
+
+
+def open_frames ( path ) :
+    # returns a random access reader for path, either a trajectory store or a text file
+    if trajectory_store.is_store( path ) :
+        return trajectory_store.trajectory_store( path )
+    return text_frames( path )
+
+
+def select_frames ( times, every = 1, start = None, end = None ) :
+    # returns the indices of every every-th time step with start <= time <= end
+    selected = numpy.arange( len( times ) )
+    if start is not None :
+        selected = selected[numpy.asarray( times )[selected] >= start]
+    if end is not None :
+        selected = selected[numpy.asarray( times )[selected] <= end]
+    return selected[::every]
+
+
+def count_beads ( path ) :
+    # returns the number of beads in each time step, read from the first time step
+    return frame_index( path ).beads
+
+
+def count_frames ( path ) :
+    # returns the number of complete time steps in path
+    return len( frame_index( path ) )
+
+
+def iter_frames ( path, scale = 1.0, beads = None, every = 1, start = None, end = None ) :
+    # yields ( time, (beads, 3) float64 array ) for every every-th time step of path
+    #  with start <= time <= end, coordinates multiplied by scale. beads is found
+    #  from the file if not given, any lines after the first beads lines of a time
+    #  step are ignored.
+    index = frame_index( path )
+    with compressed_io.open_file( path, 'rb' ) as binary_file :
+        for i in select_frames( index.times, every, start, end ) :
+            yield ( float( index.times[i] ), index.read_frame( binary_file, i, scale, beads ) )
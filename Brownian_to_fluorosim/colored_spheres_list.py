@@ -7,140 +7,365 @@
 # defines a class that manages multiple spheres together, categorizing
 #  them by `color' (an integer value)
 
-# this depends on micro_sphere:
+# the spheres are kept as NumPy arrays (one entry per sphere) rather than
+#  one micro_sphere object each, so that whole time steps can be moved at
+#  once. micro_sphere is still used to render the XML of each sphere.
+
+# spheres closer together than the microscope can resolve can be written as
+#  one (coalesce). Spheres of one color and channel within the coalescing
+#  distance of each other, directly or through a chain of others, become a
+#  single sphere at their center that keeps their number of fluorophores and
+#  their spread.
+import hashlib
+
+import numpy
+
 import micro_sphere
 
+# channels a sphere can be simulated in, stored as an index into this tuple
+CHANNELS = ( 'all', 'red', 'green', 'blue' )
+
 class colored_spheres_list :
-    
+
     def __init__ ( self, set_radius = 20.0, preallocate = 500 ) :
         # _default_radius defines the default radius of each sphere
         self._default_radius = float( set_radius )
-        # _mycolors is a list of the color of each sphere
-        self._mycolors = [ None ]*preallocate
-        # _myspheres is a list of the spheres
-        self._myspheres = [ None ]*preallocate
+        # one row per sphere: position, radius, fluorophore density,
+        #  color, channel and index among spheres of the same color
+        self._preallocate = preallocate
+        self._positions = numpy.zeros( ( preallocate, 3 ), dtype = 'float64' )
+        self._radii = numpy.zeros( preallocate, dtype = 'float64' )
+        self._densities = numpy.zeros( preallocate, dtype = 'float64' )
+        self._mycolors = numpy.zeros( preallocate, dtype = 'int64' )
+        self._channels = numpy.zeros( preallocate, dtype = 'int8' )
+        self._color_index = numpy.zeros( preallocate, dtype = 'int64' )
+        # _color_counts is a dictionary of how many spheres there are of each color
+        self._color_counts = { }
         # _color_radius is a dictionary of non_default radii for specified colors
         self._color_radius = { }
 
         # keep track of how many spheres are in the list since we moved
         # to allow preallocation of space.
         self._count = 0
+        # _xml_templates caches, for each list of colors given to
+        #  make_ModelObjectList, the indices of the matching spheres and
+        #  the ModelObjectList with %f left in place of their coordinates
+        self._xml_templates = { }
         return
-    
+
     def __len__ ( self ) :
-        # return the number of spheres that colored_spheres_list has:
-        return len( self._mycolors )
-    
-    def get_colors_length ( self, colors ) :
+        # return the number of spheres that colored_spheres_list has room for:
+        return max( self._preallocate, self._count )
+
+    def _reserve ( self, count ) :
+        # makes sure the arrays have room for count spheres
+        capacity = len( self._radii )
+        if count <= capacity :
+            return
+        capacity = max( count, 2 * capacity )
+        for name in ( '_positions', '_radii', '_densities', '_mycolors', '_channels', '_color_index' ) :
+            old = getattr( self, name )
+            new = numpy.zeros( ( capacity, ) + old.shape[1:], dtype = old.dtype )
+            new[:self._count] = old[:self._count]
+            setattr( self, name, new )
+        return
+
+    def get_colors_length ( self, colors, keep = None ) :
         # return the number of spheres that are of a color in the list colors
-        ret_count = 0
-        # loop through the colors of our spheres
-        for i in range( self._count ) :
-            if self._mycolors[i] in colors:
-                ret_count += 1
-        # we finished looping through the colors of our spheres
-        # now we return the count
-        return ret_count
+        #  (and True in the boolean array keep, if given)
+        wanted = numpy.isin( self._mycolors[:self._count], list( colors ) )
+        if keep is not None :
+            wanted &= keep
+        return int( numpy.count_nonzero( wanted ) )
+
+    def in_bounds ( self, low, high, margin = 0.0 ) :
+        # returns a boolean array, True for each sphere that reaches into the box from
+        #  low to high (x, y, z) grown by margin (a number or one per axis) on every side
+        count = self._count
+        reach = self._radii[:count, numpy.newaxis] + numpy.asarray( margin, dtype = 'float64' )
+        positions = self._positions[:count]
+        return numpy.all( ( positions + reach >= low ) & ( positions - reach <= high ), axis = 1 )
 
     def update_coordinate ( self, index, x, y, z ) :
         # updates the sphere of chosen index in the list to have positional
         # coordinates (x,y,z)
         assert index < self._count, \
             'update_coordinate(): index chosen outside of list'
-        self._myspheres[index].set_x( x )
-        self._myspheres[index].set_y( y )
-        self._myspheres[index].set_z( z )
+        self._positions[index] = ( x, y, z )
         return
-    
+
+    def update_coordinates ( self, positions ) :
+        # updates the first len(positions) spheres to the rows of the (N,3) array positions
+        positions = numpy.asarray( positions, dtype = 'float64' )
+        assert len( positions ) <= self._count, \
+            'update_coordinates(): more positions than spheres in list'
+        self._positions[:len( positions )] = positions
+        return
+
     def add_sphere ( self, x, y, z, color, density, color_str = 'all' ) :
         # adds a sphere at the specified location with given color
-        
-        
-        # determine name of this object :
-        name = 'color{0}index{1}'.format( color, self._mycolors.count( color ) )
-        
-        # add sphere to _myspheres :
-        # first get radius:
-        radius = self._default_radius
-        # check if we have a non-default value
-        if color in self._color_radius :
-            radius = self._color_radius[color]
-        # we now have everything we need, make the sphere.
-        sphere = micro_sphere.micro_sphere( name, x, y, z, radius, density, color_str )
-
-        
-        if self._count == len( self._mycolors ) :
-            # add the sphere to the list of spheres
-            self._myspheres.append( sphere )
-            # add color to _mycolors :
-            self._mycolors.append( color )
-        else :
-            # we are still on preallocated space.
-            self._myspheres[self._count] = sphere
-            self._mycolors[self._count] = color
-        
+        self.add_spheres( [ ( x, y, z ) ], [ color ], density, color_str )
+        return
+
+    def add_spheres ( self, positions, colors, density, color_str = 'all' ) :
+        # adds a sphere at each row of the (N,3) array positions, with the
+        #  matching entry of colors as its color
+        assert color_str in CHANNELS, \
+            'colored_spheres_list.add_spheres() : invalid choice of color.'
+        positions = numpy.asarray( positions, dtype = 'float64' ).reshape( -1, 3 )
+        colors = numpy.asarray( colors, dtype = 'int64' )
+        assert len( colors ) == len( positions ), \
+            'add_spheres(): need one color per position'
+        start = self._count
+        stop = start + len( colors )
+        self._reserve( stop )
+
+        self._positions[start:stop] = positions
+        self._densities[start:stop] = float( density )
+        self._mycolors[start:stop] = colors
+        self._channels[start:stop] = CHANNELS.index( color_str )
+        # name each sphere by its color and how many of that color came before it,
+        #  and give it the radius of its color
+        self._radii[start:stop] = self._default_radius
+        for color in numpy.unique( colors ).tolist( ) :
+            matches = numpy.flatnonzero( colors == color ) + start
+            previous = self._color_counts.get( color, 0 )
+            self._color_index[matches] = numpy.arange( previous, previous + len( matches ) )
+            self._color_counts[color] = previous + len( matches )
+            if color in self._color_radius :
+                self._radii[matches] = self._color_radius[color]
+
         # increase the count
-        self._count += 1
-        
+        self._count = stop
+        self._xml_templates = { }
+
         # we're done with this function now!
         return
-    
+
+    def count ( self ) :
+        # return the number of spheres actually added to the list
+        return self._count
+
+    def digest ( self ) :
+        # hash of everything about the spheres but where they are (colors, sizes,
+        #  densities and channels), to tell whether output was made from the same spheres
+        count = self._count
+        digest = hashlib.sha1( )
+        for values in ( self._mycolors, self._radii, self._densities, self._channels ) :
+            digest.update( numpy.ascontiguousarray( values[:count] ).tobytes( ) )
+        return digest.hexdigest( )
+
+    def set_colors ( self, colors ) :
+        # gives the first len(colors) spheres the colors in colors, renaming
+        #  them and giving them the radii of their new colors
+        colors = numpy.asarray( colors, dtype = 'int64' )
+        assert len( colors ) <= self._count, \
+            'set_colors(): more colors than spheres in list'
+        self._mycolors[:len( colors )] = colors
+        count = self._count
+        self._color_counts = { }
+        self._radii[:count] = self._default_radius
+        for color in numpy.unique( self._mycolors[:count] ).tolist( ) :
+            matches = numpy.flatnonzero( self._mycolors[:count] == color )
+            self._color_index[matches] = numpy.arange( len( matches ) )
+            self._color_counts[color] = len( matches )
+            if color in self._color_radius :
+                self._radii[matches] = self._color_radius[color]
+        self._xml_templates = { }
+        return
+
     def set_default_radius ( self, new_radius ) :
         # changes the default radius of each sphere
         self._default_radius = float( new_radius )
         return
-    
+
     def resize_color ( self, color, new_radius ) :
         # specifies a new radius to set spheres of given color to new_radius
-        
+
         # ensure that new_radius is a float
         float_radius = float( new_radius )
-        
+
         # add/modify current entry in _color_radius for given color to new_radius:
         self._color_radius[color] = float_radius
-        
-        # now go through all those of this color and set radius to the new value:
-        for i in range( self._count ) :
-            if self._mycolors[i] == color :
-                self._myspheres[i].set_radius( float_radius )
-        # end loop over the spheres
+        self._xml_templates = { }
+
+        # now set all those of this color to the new value:
+        self._radii[:self._count][self._mycolors[:self._count] == color] = float_radius
         return
-    
+
     def reset_colors ( self ) :
         # undoes the changes made by resize_color ( int, float )
         #  that is, it makes _color_radius empty
-        
+
         self._color_radius = { }
-        # loop through all the spheres, set radius of each object to _default_radius
-        for i in range( self._count ) :
-            self._myspheres[i].set_radius( self._default_radius )
-        # end loop through all the spheres
+        self._xml_templates = { }
+        # set radius of every sphere to _default_radius
+        self._radii[:self._count] = self._default_radius
         return
-    
-    def make_ModelObjectList ( self, colors ) :
+
+    def select ( self, colors, channel = 'all', keep = None, coalesce = None ) :
+        # returns ( positions, radii, densities ) arrays of the spheres with a color inside
+        #  the list colors that are seen in channel (spheres in channel 'all' always are),
+        #  leaving out the ones False in the boolean array keep if given, and merging
+        #  the ones within coalesce of each other if given
+        count = self._count
+        wanted = numpy.isin( self._mycolors[:count], list( colors ) )
+        if keep is not None :
+            wanted &= keep
+        if channel != 'all' :
+            wanted &= numpy.isin( self._channels[:count], [ CHANNELS.index( 'all' ), CHANNELS.index( channel ) ] )
+        if coalesce is not None :
+            ( indices, groups ) = self.coalesce( numpy.flatnonzero( wanted ), coalesce )
+            return self.merged( indices, groups )
+        return ( self._positions[:count][wanted], self._radii[:count][wanted], self._densities[:count][wanted] )
+
+    def coalesce ( self, indices, distance ) :
+        # groups the spheres indices that are within distance of each other, directly or
+        #  through other spheres, separately for each color and channel. Neighbours are
+        #  found in a grid of cells of side distance: a sphere's are all in its own cell
+        #  or one of the 26 around it. Returns ( indices, groups ): groups holds the group
+        #  of each sphere, numbered in the order of their first spheres
+        indices = numpy.asarray( indices, dtype = 'int64' )
+        count = len( indices )
+        if count == 0 :
+            return ( indices, numpy.zeros( 0, dtype = 'int64' ) )
+        positions = self._positions[indices]
+        cells = numpy.floor( positions / distance ).astype( 'int64' )
+        # one integer per cell and color and channel, with room for the cells around each
+        cells -= cells.min( axis = 0 ) - 1
+        sizes = cells.max( axis = 0 ) + 2
+        kinds = numpy.unique( numpy.column_stack( ( self._mycolors[indices], self._channels[indices] ) ), axis = 0, return_inverse = True )[1].ravel( )
+        codes = ( ( kinds * sizes[0] + cells[:, 0] ) * sizes[1] + cells[:, 1] ) * sizes[2] + cells[:, 2]
+        order = numpy.argsort( codes, kind = 'stable' )
+        ( occupied, starts, members ) = numpy.unique( codes[order], return_index = True, return_counts = True )
+        # pairs of spheres in each cell and each of the 13 cells after it (the other 13
+        #  are before it, and see it)
+        first = [ ]
+        second = [ ]
+        for dx in ( -1, 0, 1 ) :
+            for dy in ( -1, 0, 1 ) :
+                for dz in ( -1, 0, 1 ) :
+                    shift = ( dx * sizes[1] + dy ) * sizes[2] + dz
+                    if shift < 0 :
+                        continue
+                    found = numpy.searchsorted( occupied, occupied + shift )
+                    found = numpy.minimum( found, len( occupied ) - 1 )
+                    a = numpy.flatnonzero( occupied[found] == occupied + shift )
+                    b = found[a]
+                    pairs = members[a] * members[b]
+                    owner = numpy.repeat( numpy.arange( len( a ) ), pairs )
+                    local = numpy.arange( pairs.sum( ) ) - numpy.repeat( numpy.cumsum( pairs ) - pairs, pairs )
+                    i = order[starts[a][owner] + local // members[b][owner]]
+                    j = order[starts[b][owner] + local % members[b][owner]]
+                    if shift == 0 :
+                        ( i, j ) = ( i[i < j], j[i < j] )
+                    close = ( ( positions[i] - positions[j] ) ** 2 ).sum( axis = 1 ) <= distance ** 2
+                    first.append( i[close] )
+                    second.append( j[close] )
+        first = numpy.concatenate( first )
+        second = numpy.concatenate( second )
+        # connected components: every sphere takes the lowest label among its neighbours
+        #  and the label its label points to, until nothing changes
+        labels = numpy.arange( count )
+        while True :
+            previous = labels.copy( )
+            lowest = numpy.minimum( labels[first], labels[second] )
+            numpy.minimum.at( labels, first, lowest )
+            numpy.minimum.at( labels, second, lowest )
+            labels = labels[labels]
+            if ( labels == previous ).all( ) :
+                break
+        # the label is the group's first sphere, so unique numbers them in that order
+        groups = numpy.unique( labels, return_inverse = True )[1].ravel( )
+        return ( indices, groups )
+
+    def merged ( self, indices, groups ) :
+        # returns ( positions, radii, densities ) with one sphere per group of coalesce: at
+        #  the center of its fluorophores, with the radius of a uniform sphere of the same
+        #  spread and the density that keeps the number of fluorophores. A group of one
+        #  sphere is that sphere unchanged
+        count = int( groups.max( ) ) + 1 if len( groups ) else 0
+        positions = self._positions[indices]
+        radii = self._radii[indices]
+        # fluorophores of each sphere, up to a constant
+        weights = self._densities[indices] * radii ** 3
+        total = numpy.bincount( groups, weights, count )
+        centers = numpy.column_stack( [ numpy.bincount( groups, weights * positions[:, k], count ) for k in range( 3 ) ] ) / total[:, numpy.newaxis]
+        # variance along each axis: the spheres' own ( r^2 / 5 ) plus their spread about the center
+        spread = radii ** 2 / 5.0 + ( ( positions - centers[groups] ) ** 2 ).sum( axis = 1 ) / 3.0
+        merged_radii = numpy.sqrt( 5.0 * numpy.bincount( groups, weights * spread, count ) / total )
+        merged_densities = total / merged_radii ** 3
+        # groups of one keep their sphere exactly
+        sizes = numpy.bincount( groups, minlength = count )
+        single = numpy.flatnonzero( sizes[groups] == 1 )
+        centers[groups[single]] = positions[single]
+        merged_radii[groups[single]] = radii[single]
+        merged_densities[groups[single]] = self._densities[indices][single]
+        return ( centers, merged_radii, merged_densities )
+
+    def _sphere ( self, index ) :
+        # returns a micro_sphere with the values of sphere index
+        return micro_sphere.micro_sphere( 'color{0}index{1}'.format( self._mycolors[index], self._color_index[index] ),
+                                          self._positions[index, 0], self._positions[index, 1], self._positions[index, 2],
+                                          self._radii[index], self._densities[index], CHANNELS[self._channels[index]] )
+
+    def _get_xml_template ( self, colors ) :
+        # returns ( indices, template, pieces ) for the spheres with a color inside
+        #  the list colors, building them the first time colors is asked for;
+        #  pieces holds the template of each sphere on its own
+        key = tuple( colors )
+        if key not in self._xml_templates :
+            indices = numpy.flatnonzero( numpy.isin( self._mycolors[:self._count], list( colors ) ) )
+            pieces = [ self._sphere( i ).xml_template( ) for i in indices ]
+            template = ''.join( [ '<ModelObjectList>' ] + pieces + [ '</ModelObjectList>' ] )
+            self._xml_templates[key] = ( indices, template, pieces )
+        return self._xml_templates[key]
+
+    def make_ModelObjectList ( self, colors, keep = None, coalesce = None ) :
         # returns an XML formatted string of a ModelObjectList for the
         #  Microscope simulator including all the spheres with a color
-        #  inside the list colors
-        
-        # ret_str is a string that will be modified and eventually returned
-        ret_str = '<ModelObjectList>'
-        # changed is a boolean value that will check if anything was of the given color (some objects)
-        changed = False
-        
-        # loop through all the spheres
-        for i in range( self._count ) :
-            # check if the color of the current sphere is in colors
-            if self._mycolors[i] in colors :
-                changed = True
-                ret_str += str( self._myspheres[i] )
-        # end loop to add the XML formats of spheres that had given colors
-        
-        # if nothing was changed, we may have a problem.
-        if not changed :
+        #  inside the list colors (and True in the boolean array keep, if given),
+        #  merging the ones within coalesce of each other if given
+
+        # everything but the coordinates is only formatted once
+        ( indices, template, pieces ) = self._get_xml_template( colors )
+
+        # if nothing was of the given color, we may have a problem.
+        if len( indices ) == 0 :
             print( 'WARNING: ModelObjectList was empty' )
-        
-        # add end tag of the ModelObjectList
-        ret_str += '</ModelObjectList>'
-        
-        # return this string
-        return ret_str
+
+        if coalesce is not None :
+            return self._coalesced_ModelObjectList( indices, pieces, keep, coalesce )
+
+        if keep is not None :
+            # only the templates of the spheres kept
+            kept = keep[indices]
+            template = ''.join( [ '<ModelObjectList>' ] +
+                                [ piece for ( piece, k ) in zip( pieces, kept.tolist( ) ) if k ] +
+                                [ '</ModelObjectList>' ] )
+            indices = indices[kept]
+
+        # fill in the coordinates of all the spheres in one go
+        return template % tuple( self._positions[indices].ravel( ).tolist( ) )
+
+    def _coalesced_ModelObjectList ( self, indices, pieces, keep, distance ) :
+        # make_ModelObjectList with coalescing: groups of one sphere reuse its cached
+        #  template, merged ones are formatted for this time step
+        piece_of = dict( zip( indices.tolist( ), pieces ) )
+        if keep is not None :
+            indices = indices[keep[indices]]
+        ( indices, groups ) = self.coalesce( indices, distance )
+        ( positions, radii, densities ) = self.merged( indices, groups )
+        count = len( radii )
+        sizes = numpy.bincount( groups, minlength = count )
+        firsts = indices[numpy.unique( groups, return_index = True )[1]]
+        merged_pieces = [ ]
+        for ( first, size, radius, density ) in zip( firsts.tolist( ), sizes.tolist( ), radii.tolist( ), densities.tolist( ) ) :
+            if size == 1 :
+                merged_pieces.append( piece_of[first] )
+            else :
+                merged_pieces.append( micro_sphere.micro_sphere(
+                    'color{0}index{1}merged{2}'.format( self._mycolors[first], self._color_index[first], size ),
+                    0.0, 0.0, 0.0, radius, density, CHANNELS[self._channels[first]] ).xml_template( ) )
+        template = ''.join( [ '<ModelObjectList>' ] + merged_pieces + [ '</ModelObjectList>' ] )
+        return template % tuple( positions.ravel( ).tolist( ) )
@@ -0,0 +1,55 @@
+# compressed_io.py
+# Purpose: opens files compressed with gzip, bzip2 or xz (by their extension)
+#  the same way as plain files, so trajectories, SRC files and XML output can
+#  be kept compressed on disk.
+
+import io
+import os
+import bz2
+import gzip
+try :
+    import lzma
+except ImportError :
+    # Python 2 has no lzma module, .xz files need Python 3
+    lzma = None
+
+# extension -> name given on commandlines
+COMPRESSIONS = { '.gz' : 'gz', '.bz2' : 'bz2', '.xz' : 'xz' }
+
+
+def compression_of ( path ) :
+    # returns 'gz', 'bz2' or 'xz' if path is compressed, None otherwise
+    return COMPRESSIONS.get( os.path.splitext( path )[1].lower( ) )
+
+
+def strip_compression ( path ) :
+    # path without its compression extension, if it has one
+    if compression_of( path ) is None :
+        return path
+    return os.path.splitext( path )[0]
+
+
+def _open_compressed ( path, mode, compression ) :
+    binary_mode = mode.replace( 't', '' )
+    if 'b' not in binary_mode :
+        binary_mode += 'b'
+    if compression == 'gz' :
+        stream = gzip.open( path, binary_mode )
+    elif compression == 'bz2' :
+        stream = bz2.BZ2File( path, binary_mode )
+    else :
+        assert lzma is not None, "Reading or writing '{0}' needs the lzma module (Python 3)".format( path )
+        stream = lzma.open( path, binary_mode )
+    if 'b' in mode :
+        return stream
+    return io.TextIOWrapper( stream )
+
+
+def open_file ( path, mode = 'rb' ) :
+    # opens path like open( path, mode ), decompressing or compressing it if its
+    #  extension says it is compressed
+    compression = compression_of( path )
+    if compression is None :
+        return open( path, mode )
+    return _open_compressed( path, mode, compression )
+
@@ -0,0 +1,117 @@
+# fluorescence_render.py
+# Purpose: renders the fluorescence z-stack of a set of labeled spheres directly
+#  with NumPy, as a much faster stand-in for writing an XML file and running
+#  Microscope Simulator on it. Runs anywhere NumPy does.
+
+# The model: each sphere holds density * volume fluorophores (density per cubic
+#  micron, as given to Microscope Simulator), spread by a Gaussian point spread
+#  function with standard deviations psf_sigma = (lateral, axial) in nanometers
+#  (widened by the sphere's own size). A voxel gets the expected light from all
+#  spheres times the gain, clipped at the maximum voxel intensity, plus optional
+#  Gaussian noise, and the contrast levels are mapped onto 0-255 like the
+#  8-bit stacks saved by Microscope Simulator.
+
+import math
+import xml.etree.ElementTree
+
+import numpy
+
+import tiff_io
+
+# name of output stacks, same as BrownianXMLtoTIFF gives them after renaming
+STACK_NAME = '{prefix}_{number}_{channel}_{number}.tif'
+
+
+def _axis_weights ( centers, positions, sigmas ) :
+    # (N, len(centers)) Gaussian weights of each sphere along one axis
+    return numpy.exp( -0.5 * ( ( centers[numpy.newaxis, :] - positions[:, numpy.newaxis] ) / sigmas[:, numpy.newaxis] ) ** 2 )
+
+
+def render_stack ( params, positions, radii, densities ) :
+    # returns the (slices, height, width) intensities of spheres at the rows of
+    #  positions (nanometers, slide coordinates as given by userParams.coordTransformArray)
+    positions = numpy.asarray( positions, dtype = 'float64' ).reshape( -1, 3 )
+    radii = numpy.broadcast_to( numpy.asarray( radii, dtype = 'float64' ), ( len( positions ), ) )
+    densities = numpy.broadcast_to( numpy.asarray( densities, dtype = 'float64' ), ( len( positions ), ) )
+    stack = numpy.zeros( ( params.microscope_slices, params.microscope_height, params.microscope_width ) )
+    if len( positions ) == 0 :
+        return stack
+    # a uniform sphere of radius r has variance r^2 / 5 along each axis
+    sigma_xy = numpy.sqrt( params.psf_sigma[0] ** 2 + radii ** 2 / 5.0 )
+    sigma_z = numpy.sqrt( params.psf_sigma[1] ** 2 + radii ** 2 / 5.0 )
+    # expected light from each sphere into one voxel at the center of its PSF
+    fluorophores = densities * ( 4.0 / 3.0 ) * math.pi * ( radii / 1000.0 ) ** 3
+    voxel = params.pixel_size ** 2 * params.voxel_depth
+    brightness = params.psf_gain * fluorophores * voxel / ( ( 2.0 * math.pi ) ** 1.5 * sigma_xy ** 2 * sigma_z )
+    # pixel centers and focal planes
+    weights_x = _axis_weights( ( numpy.arange( params.microscope_width ) + 0.5 ) * params.pixel_size, positions[:, 0], sigma_xy )
+    weights_y = _axis_weights( ( numpy.arange( params.microscope_height ) + 0.5 ) * params.pixel_size, positions[:, 1], sigma_xy )
+    weights_z = _axis_weights( numpy.arange( params.microscope_slices ) * params.voxel_depth, positions[:, 2], sigma_z )
+    # the PSF is separable, so each plane is one matrix product
+    for k in range( params.microscope_slices ) :
+        stack[k] = numpy.dot( ( weights_y * ( brightness * weights_z[:, k] )[:, numpy.newaxis] ).T, weights_x )
+    return stack
+
+
+def stack_to_image ( params, stack, rng = None ) :
+    # clips, adds noise and maps the contrast levels of a rendered stack onto 0-255
+    image = numpy.minimum( stack, params.max_voxel_intensity )
+    if params.use_noise :
+        if rng is None :
+            rng = numpy.random
+        image = image + rng.normal( 0.0, params.noise_stdev, image.shape )
+    ( low, high ) = params.constrast_levels
+    image = ( image - low ) * ( 255.0 / max( high - low, 1e-12 ) )
+    return numpy.clip( numpy.rint( image ), 0, 255 ).astype( 'uint8' )
+
+
+def write_render ( path, params, positions, radii, densities ) :
+    # renders the spheres and writes the 8-bit stack to path
+    return tiff_io.write_stack( path, stack_to_image( params, render_stack( params, positions, radii, densities ) ) )
+
+
+class simulation_params :
+    # the settings render_stack needs, read from a Microscope Simulator XML file
+
+    def __init__ ( self, settings, psf_sigma ) :
+        self.microscope_width = int( settings.get( 'imageWidth' ) )
+        self.microscope_height = int( settings.get( 'imageHeight' ) )
+        self.microscope_slices = int( settings.get( 'numberOfFocalPlanes' ) )
+        self.pixel_size = float( settings.get( 'pixelSize' ) )
+        self.voxel_depth = float( settings.get( 'focalPlaneSpacing' ) )
+        self.psf_gain = float( settings.get( 'gain' ) )
+        self.psf_sigma = psf_sigma
+        self.max_voxel_intensity = float( settings.get( 'maximumVoxelIntensity' ) )
+        self.constrast_levels = ( float( settings.get( 'minimumIntensityLevel' ) ),
+                                  float( settings.get( 'maximumIntensityLevel' ) ) )
+        self.use_noise = settings.get( 'addGaussianNoise' ) == 'true'
+        self.noise_stdev = float( settings.get( 'noiseStdDev' ) )
+
+
+def read_simulation ( path, psf_sigma ) :
+    # reads an XML file written by ParseBrownian, returns ( simulation_params, spheres )
+    #  where spheres maps each channel to ( positions, radii, densities ) arrays
+    root = xml.etree.ElementTree.parse( path ).getroot( )
+    params = simulation_params( root.find( 'FluorescenceSimulation' ).attrib, psf_sigma )
+    rows = { }
+    for sphere in root.iter( 'SphereModel' ) :
+        volume = sphere.find( 'VolumeFluorophoreModel' )
+        if volume is None or volume.get( 'enabled' ) != 'true' :
+            continue
+        rows.setdefault( volume.get( 'channel' ), [ ] ).append(
+            ( float( sphere.find( 'PositionX' ).get( 'value' ) ), float( sphere.find( 'PositionY' ).get( 'value' ) ),
+              float( sphere.find( 'PositionZ' ).get( 'value' ) ), float( sphere.find( 'Radius' ).get( 'value' ) ),
+              float( volume.get( 'density' ) ) ) )
+    spheres = { }
+    for channel in rows :
+        table = numpy.array( rows[channel] )
+        spheres[channel] = ( table[:, :3], table[:, 3], table[:, 4] )
+    return ( params, spheres )
+
+
+def channel_spheres ( spheres, channel ) :
+    # ( positions, radii, densities ) of the spheres seen in channel (their own and 'all')
+    parts = [ spheres[c] for c in ( channel, 'all' ) if c in spheres ]
+    if not parts :
+        return ( numpy.zeros( ( 0, 3 ) ), numpy.zeros( 0 ), numpy.zeros( 0 ) )
+    return tuple( numpy.concatenate( [ part[i] for part in parts ] ) for i in range( 3 ) )
@@ -0,0 +1,121 @@
+# frame_manifest.py
+# Purpose: keeps track of which frames of an output folder are finished, so a
+#  run that was stopped can carry on where it left off (-resume). Each file is
+#  written under a temporary name in its folder and renamed into place once it
+#  is complete, then recorded in the folder's manifest with its size and hash.
+#  A frame only counts as finished while it was made with the same settings and
+#  from the same source, and its files are still there unchanged.
+
+# A manifest is a text file of JSON lines. The first holds a hash of the
+#  settings of the run, each of the others one finished frame:
+#   { "frame" : name, "source" : what it was made from, "files" : { file name : [ bytes, sha1 ] } }
+#  Lines are only ever appended, so a run stopped while writing one loses at
+#  most that frame; a later line for the same frame replaces an earlier one.
+
+import os
+import json
+import shutil
+import hashlib
+
+# name of the manifest in each output folder
+MANIFEST_NAME = '.manifest.jsonl'
+# what files (or folders of files) being written start with, the extension is kept
+#  for compressed_io
+PARTIAL_PREFIX = '.partial.'
+
+
+def partial_path ( path ) :
+    # the name path is written under until it is complete
+    return os.path.join( os.path.dirname( path ), PARTIAL_PREFIX + os.path.basename( path ) )
+
+
+def commit ( partial, path ) :
+    # renames the finished file partial to path, replacing what was there
+    if os.name == 'nt' and os.path.exists( path ) :
+        os.remove( path )
+    os.rename( partial, path )
+    return path
+
+
+def file_digest ( path ) :
+    # sha1 of the contents of path
+    digest = hashlib.sha1( )
+    with open( path, 'rb' ) as hashed_file :
+        for block in iter( lambda : hashed_file.read( 1 << 20 ), b'' ) :
+            digest.update( block )
+    return digest.hexdigest( )
+
+
+def settings_key ( settings ) :
+    # hash of settings, anything that json can write
+    return hashlib.sha1( json.dumps( settings, sort_keys = True ).encode( 'utf-8' ) ).hexdigest( )
+
+
+class frame_manifest :
+    # the finished frames of one output folder
+
+    def __init__ ( self, folder, settings, resume = False ) :
+        # with resume the frames finished by an earlier run with the same settings are
+        #  kept, otherwise (or when the settings changed) the manifest starts empty.
+        #  Files and folders left half written by a run that was stopped are removed either way
+        self.folder = folder
+        self.path = os.path.join( folder, MANIFEST_NAME )
+        self.key = settings_key( settings )
+        self.frames = { }
+        for name in os.listdir( folder ) :
+            if name.startswith( PARTIAL_PREFIX ) :
+                if os.path.isdir( os.path.join( folder, name ) ) :
+                    shutil.rmtree( os.path.join( folder, name ) )
+                else :
+                    os.remove( os.path.join( folder, name ) )
+        if resume and self._read( ) :
+            return
+        self.frames = { }
+        partial = partial_path( self.path )
+        with open( partial, 'w' ) as manifest_file :
+            manifest_file.write( json.dumps( { 'settings' : self.key } ) + '\n' )
+        commit( partial, self.path )
+        return
+
+    def _read ( self ) :
+        # loads the frames of the manifest, returns False if there is none with our settings
+        if not os.path.isfile( self.path ) :
+            return False
+        with open( self.path ) as manifest_file :
+            lines = manifest_file.read( ).splitlines( )
+        try :
+            if not lines or json.loads( lines[0] ).get( 'settings' ) != self.key :
+                return False
+        except ValueError :
+            return False
+        for line in lines[1:] :
+            try :
+                entry = json.loads( line )
+            except ValueError :
+                # the line being written when the run stopped
+                continue
+            self.frames[entry['frame']] = entry
+        return True
+
+    def __len__ ( self ) :
+        return len( self.frames )
+
+    def finished ( self, frame, source = None ) :
+        # True if frame was recorded from source and its files are all there unchanged
+        entry = self.frames.get( frame )
+        if entry is None or entry.get( 'source' ) != source :
+            return False
+        for ( name, ( size, digest ) ) in entry['files'].items( ) :
+            path = os.path.join( self.folder, name )
+            if not os.path.isfile( path ) or os.path.getsize( path ) != size or file_digest( path ) != digest :
+                return False
+        return True
+
+    def add ( self, frame, paths, source = None ) :
+        # records the files paths (in our folder, already in place) as frame, made from source
+        files = dict( ( os.path.basename( path ), [ os.path.getsize( path ), file_digest( path ) ] ) for path in paths )
+        entry = { 'frame' : frame, 'source' : source, 'files' : files }
+        self.frames[frame] = entry
+        with open( self.path, 'a' ) as manifest_file :
+            manifest_file.write( json.dumps( entry, sort_keys = True ) + '\n' )
+        return entry
@@ -0,0 +1,155 @@
+# metrics.py
+# Purpose: records where the time of a run goes. Each stage of a run gets its
+#  wall and CPU time, how many items (time steps, files) it did and how fast,
+#  the bytes it read and wrote and the peak memory of the process; the runs of
+#  external programs (Microscope Simulator) get their durations. The records
+#  are written as JSON or CSV, and the hot loop can be profiled with cProfile.
+
+# Bytes are whatever the stage counted itself, and otherwise what passed through
+#  the read and write calls of this process (from /proc, so Linux only). Peak
+#  memory is the largest resident set size of the process (and, separately, of
+#  its finished child processes) up to the end of the stage.
+
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import contextlib
+try :
+    import resource
+except ImportError :
+    # Windows has no resource module, peak memory is then not recorded
+    resource = None
+
+# columns of the CSV file, in order
+FIELDS = [ 'kind', 'name', 'wall_seconds', 'cpu_seconds', 'children_cpu_seconds', 'items', 'items_per_second',
+           'bytes_read', 'bytes_written', 'culled', 'resumed', 'peak_rss_bytes', 'children_peak_rss_bytes', 'code', 'tries' ]
+
+
+def cpu_seconds ( ) :
+    # ( CPU seconds of this process, CPU seconds of its finished children ), user plus system
+    times = os.times( )
+    return ( times[0] + times[1], times[2] + times[3] )
+
+
+def _max_rss ( who ) :
+    if resource is None :
+        return None
+    rss = resource.getrusage( who ).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def peak_rss ( ) :
+    # ( peak resident set size in bytes of this process, of its largest finished child ), None if unknown
+    if resource is None :
+        return ( None, None )
+    return ( _max_rss( resource.RUSAGE_SELF ), _max_rss( resource.RUSAGE_CHILDREN ) )
+
+
+def io_counters ( ) :
+    # ( bytes read, bytes written ) through read and write calls by this process so far,
+    #  None where /proc/self/io does not exist
+    try :
+        with open( '/proc/self/io' ) as io_file :
+            counters = dict( line.split( ':' ) for line in io_file if ':' in line )
+        return ( int( counters['rchar'] ), int( counters['wchar'] ) )
+    except ( IOError, OSError, KeyError, ValueError ) :
+        return None
+
+
+def path_bytes ( path ) :
+    # size of a file, or of every file in a folder
+    if os.path.isdir( path ) :
+        return sum( os.path.getsize( os.path.join( folder, name ) )
+                    for ( folder, dirs, names ) in os.walk( path ) for name in names )
+    return os.path.getsize( path ) if os.path.isfile( path ) else 0
+
+
+@contextlib.contextmanager
+def profiled ( path ) :
+    # profiles the block with cProfile and dumps the statistics to path (pstats format),
+    #  does nothing if path is None
+    if path is None :
+        yield
+        return
+    profile = cProfile.Profile( )
+    profile.enable( )
+    try :
+        yield
+    finally :
+        profile.disable( )
+        profile.dump_stats( path )
+
+
+class run_metrics :
+    # the stage and subprocess records of one run
+
+    def __init__ ( self, name ) :
+        self.name = name
+        self.started = time.time( )
+        self.stages = [ ]
+        self.subprocesses = [ ]
+        return
+
+    @contextlib.contextmanager
+    def stage ( self, name, items = None ) :
+        # times the block as stage name, yielding its record: set 'items', 'bytes_read'
+        #  and 'bytes_written' in it to count them yourself
+        record = { 'kind' : 'stage', 'name' : name, 'items' : items, 'bytes_read' : None, 'bytes_written' : None }
+        start = time.time( )
+        ( cpu, children_cpu ) = cpu_seconds( )
+        io = io_counters( )
+        try :
+            yield record
+        finally :
+            record['wall_seconds'] = time.time( ) - start
+            ( end_cpu, end_children_cpu ) = cpu_seconds( )
+            record['cpu_seconds'] = end_cpu - cpu
+            record['children_cpu_seconds'] = end_children_cpu - children_cpu
+            end_io = io_counters( )
+            if io is not None and end_io is not None :
+                if record['bytes_read'] is None :
+                    record['bytes_read'] = end_io[0] - io[0]
+                if record['bytes_written'] is None :
+                    record['bytes_written'] = end_io[1] - io[1]
+            ( record['peak_rss_bytes'], record['children_peak_rss_bytes'] ) = peak_rss( )
+            if record['items'] is not None :
+                record['items_per_second'] = record['items'] / max( record['wall_seconds'], 1e-9 )
+            self.stages.append( record )
+
+    def subprocess ( self, name, seconds, code, tries = 1 ) :
+        # records one run of an external program
+        self.subprocesses.append( { 'kind' : 'subprocess', 'name' : name, 'wall_seconds' : seconds,
+                                    'code' : code, 'tries' : tries } )
+
+    def extend ( self, records, prefix = '' ) :
+        # adds the records (from records( ) of another run) with prefix put before their names
+        for record in records['stages'] + records['subprocesses'] :
+            record = dict( record, name = prefix + record['name'] )
+            ( self.stages if record['kind'] == 'stage' else self.subprocesses ).append( record )
+
+    def records ( self ) :
+        # everything recorded, as plain lists and dictionaries
+        durations = [ record['wall_seconds'] for record in self.subprocesses ]
+        return { 'run' : self.name, 'started' : time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( self.started ) ),
+                 'wall_seconds' : time.time( ) - self.started, 'argv' : sys.argv,
+                 'stages' : self.stages, 'subprocesses' : self.subprocesses,
+                 'subprocess_summary' : { 'count' : len( durations ), 'total_seconds' : sum( durations ),
+                                          'mean_seconds' : sum( durations ) / len( durations ) if durations else None,
+                                          'max_seconds' : max( durations ) if durations else None } }
+
+    def write ( self, path ) :
+        # writes the records to path, as CSV if it ends in .csv and JSON otherwise
+        if path.lower( ).endswith( '.csv' ) :
+            with open( path, 'w' ) as csv_file :
+                writer = csv.DictWriter( csv_file, FIELDS, extrasaction = 'ignore', lineterminator = '\n' )
+                writer.writeheader( )
+                for record in self.stages + self.subprocesses :
+                    writer.writerow( record )
+        else :
+            with open( path, 'w' ) as json_file :
+                json.dump( self.records( ), json_file, indent = 2, sort_keys = True )
+        return path
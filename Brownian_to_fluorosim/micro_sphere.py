@@ -15,6 +15,7 @@
 #   public methods:
 #     __init__ (name, pos_x, pos_y, pos_z, radius(, visible)(, scannable))
 #     __str__ ( )
+#     xml_template ( )
 #     get_name ( )
 #     is_visible ( )
 #     is_scannable ( )
@@ -53,24 +54,22 @@ class micro_sphere :
         
         return
 
-    def __str__ ( self ) :
-        # return the correct XML string for this object
+    def xml_template ( self ) :
+        # return the XML string for this object with %f in place of
+        #  the x,y,z values, everything else is already filled in
         ret_str = '<SphereModel>'
         # add the name
-        ret_str += '<Name value="{0}"/>'.format(self._name)
+        ret_str += '<Name value="{0}"/>'.format(self._name).replace('%', '%%')
         # add visibility value
         ret_str += '<Visible value="{0}"/>'.format( \
                    str(self.is_visible()).lower())
         # add scannable value
         ret_str += '<Scannable value="{0}"/>'.format( \
                    str(self.is_scannable()).lower())
-        # add x,y,z values
-        ret_str += '<PositionX value="{0:f}" optimize="false"/>'.format( \
-                   self.get_x())
-        ret_str += '<PositionY value="{0:f}" optimize="false"/>'.format( \
-                   self.get_y())
-        ret_str += '<PositionZ value="{0:f}" optimize="false"/>'.format( \
-                   self.get_z())
+        # leave room for x,y,z values
+        ret_str += '<PositionX value="%f" optimize="false"/>'
+        ret_str += '<PositionY value="%f" optimize="false"/>'
+        ret_str += '<PositionZ value="%f" optimize="false"/>'
         # add radius value
         ret_str += '<Radius value="{0:f}" optimize="false"/>'.format( \
                    self.get_radius())
@@ -81,7 +80,11 @@ class micro_sphere :
         ret_str += '</SphereModel>'
         # we're done, so return ret_str
         return ret_str
-    
+
+    def __str__ ( self ) :
+        # return the correct XML string for this object
+        return self.xml_template() % ( self.get_x(), self.get_y(), self.get_z() )
+
     # get name (read-only variable)
     def get_name ( self ) :
         return self._name
@@ -0,0 +1,119 @@
+# src_masks.py
+# Purpose: reads SRC color files (one value per bead, 4 for a labeled bead and
+#  0 otherwise) exactly, and keeps every SRC of a folder as one packed bit
+#  array in a single .npz file, so any mask loads as a boolean or index array
+#  without reading text again.
+
+# A mask store holds:
+#   names - the name of each SRC (its file name without extension)
+#   bits  - (SRCs, ceil(beads / 8)) uint8 array, one packed row per SRC
+#   beads - number of beads each mask has
+#   label - the value that marked a labeled bead
+
+import os
+import hashlib
+
+import numpy
+
+import compressed_io
+
+# value of a labeled bead in SRC files
+LABEL = 4
+# what mask stores are named
+STORE_SUFFIX = '.masks.npz'
+
+
+def read_src_values ( path ) :
+    # returns the value on each line of path as a float64 array. Only the first
+    #  comma separated field counts, blank lines are skipped, and so is a first
+    #  line that is not a number (a header)
+    values = [ ]
+    with compressed_io.open_file( path, 'r' ) as src_file :
+        for ( number, line ) in enumerate( src_file ) :
+            field = line.split( ',' )[0].strip( )
+            if not field :
+                continue
+            try :
+                values.append( float( field ) )
+            except ValueError :
+                if number == 0 :
+                    continue
+                raise ValueError( "'{0}' line {1}: '{2}' is not a number".format( path, number + 1, field ) )
+    return numpy.array( values, dtype = 'float64' )
+
+
+def src_mask ( path, beads = None, label = LABEL ) :
+    # returns the boolean mask of the beads path labels, padded with unlabeled
+    #  beads up to beads if given
+    mask = read_src_values( path ) == label
+    if beads is not None :
+        assert len( mask ) <= beads, "'{0}' has {1} values, there are only {2} beads".format( path, len( mask ), beads )
+        mask = numpy.concatenate( ( mask, numpy.zeros( beads - len( mask ), dtype = bool ) ) )
+    return mask
+
+
+def src_name ( path ) :
+    # name of an SRC, its file name without extension
+    return os.path.basename( path ).split( '.' )[0]
+
+
+def is_mask_store ( path ) :
+    # returns True if path is a file written by write_mask_store
+    return os.path.isfile( path ) and path.endswith( STORE_SUFFIX )
+
+
+def write_mask_store ( path, masks, beads, label = LABEL ) :
+    # writes masks, a list of ( name, boolean array ) with at most beads values each, to path
+    bits = numpy.zeros( ( len( masks ), ( beads + 7 ) // 8 ), dtype = 'uint8' )
+    for ( i, ( name, mask ) ) in enumerate( masks ) :
+        padded = numpy.zeros( beads, dtype = bool )
+        padded[:len( mask )] = mask
+        bits[i] = numpy.packbits( padded )
+    names = numpy.array( [ name for ( name, mask ) in masks ], dtype = 'U' )
+    # written through a file object so numpy does not append .npz to the name
+    with open( path, 'wb' ) as store_file :
+        numpy.savez( store_file, names = names, bits = bits, beads = beads, label = label )
+    return path
+
+
+def convert_src_folder ( folder, path, beads, label = LABEL ) :
+    # reads every SRC file in folder into the mask store path
+    masks = [ ( src_name( name ), src_mask( os.path.join( folder, name ), beads, label ) )
+              for name in sorted( os.listdir( folder ) ) ]
+    return write_mask_store( path, masks, beads, label )
+
+
+class mask_store :
+    # every SRC of a mask store, each unpacked when asked for
+
+    def __init__ ( self, path ) :
+        self.path = path
+        with numpy.load( path ) as saved :
+            self.names = [ str( name ) for name in saved['names'] ]
+            self.bits = saved['bits']
+            self.beads = int( saved['beads'] )
+            self.label = int( saved['label'] )
+        self._rows = dict( ( name, i ) for ( i, name ) in enumerate( self.names ) )
+        return
+
+    def __len__ ( self ) :
+        return len( self.names )
+
+    def __contains__ ( self, name ) :
+        return name in self._rows
+
+    def mask ( self, name ) :
+        # boolean array, True for each bead SRC name labels
+        return numpy.unpackbits( self.bits[self._rows[name]] )[:self.beads].astype( bool )
+
+    def indices ( self, name ) :
+        # indices of the beads SRC name labels
+        return numpy.nonzero( self.mask( name ) )[0]
+
+    def colors ( self, name ) :
+        # color of each bead as a list, like ParseBrownian.readColors gives from a text file
+        return ( self.mask( name ) * self.label ).tolist( )
+
+    def digest ( self, name ) :
+        # hash of SRC name's mask, to tell when one SRC of a store has changed
+        return hashlib.sha1( self.bits[self._rows[name]].tobytes( ) + str( self.beads ).encode( 'utf-8' ) ).hexdigest( )
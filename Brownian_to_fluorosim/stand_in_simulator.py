@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# stand_in_simulator.py
+# Summary: A stand-in for Microscope Simulator that takes the same commandline
+#  as BrownianXMLtoTIFF gives it, so that BrownianXMLtoTIFF can be tried out
+#  on machines without Microscope Simulator (give it with -simulator). It
+#  renders each asked-for channel with fluorescence_render instead, using a
+#  Gaussian PSF with STAND_IN_PSF_SIGMA="lateral,axial" nanometers (80,200).
+#  Setting STAND_IN_DELAY (seconds) makes each run slower and STAND_IN_FAIL
+#  (between 0 and 1) makes that fraction of runs fail.
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import sys
+import os
+import time
+import random
+
+import fluorescence_render
+
+
+def main( ) :
+    arguments = sys.argv[1:]
+    # the output prefix is always last, the XML file follows --open-simulation
+    assert '--open-simulation' in arguments and len( arguments ) > 1, 'Usage: same as Microscope Simulator batch mode'
+    xml_path = arguments[arguments.index( '--open-simulation' ) + 1]
+    out_prefix = arguments[-1]
+    channels = [ flag[2:] for flag in arguments if flag in ( '--red', '--green', '--blue' ) ]
+
+    time.sleep( float( os.environ.get( 'STAND_IN_DELAY', 0.0 ) ) )
+    if random.random( ) < float( os.environ.get( 'STAND_IN_FAIL', 0.0 ) ) :
+        sys.exit( 1 )
+
+    psf_sigma = tuple( float( x ) for x in os.environ.get( 'STAND_IN_PSF_SIGMA', '80,200' ).split( ',' ) )
+    ( params, spheres ) = fluorescence_render.read_simulation( xml_path, psf_sigma )
+    for channel in channels :
+        ( positions, radii, densities ) = fluorescence_render.channel_spheres( spheres, channel )
+        fluorescence_render.write_render( out_prefix + channel + '.tif', params, positions, radii, densities )
+
+if __name__ == '__main__' :
+    main( )
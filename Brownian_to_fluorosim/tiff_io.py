@@ -0,0 +1,104 @@
+# tiff_io.py
+# Purpose: reads and writes uncompressed grayscale TIFF stacks (one page per
+#  focal plane) as NumPy arrays, so that stacks can be made and measured
+#  without Microscope Simulator, Fiji or any imaging library.
+
+import struct
+
+import numpy
+
+# TIFF tags we use
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+SAMPLE_FORMAT = 339
+
+# TIFF field type -> struct format
+FIELD_TYPES = { 1 : 'B', 3 : 'H', 4 : 'I', 16 : 'Q' }
+
+# SampleFormat value for each kind of NumPy dtype
+SAMPLE_FORMATS = { 'u' : 1, 'i' : 2, 'f' : 3 }
+
+
+def write_stack ( path, stack ) :
+    # writes the (pages, height, width) array stack to path, one page per slice
+    stack = numpy.asarray( stack )
+    if stack.ndim == 2 :
+        stack = stack[numpy.newaxis]
+    assert stack.ndim == 3, 'write_stack(): stack must be (pages, height, width)'
+    assert stack.dtype.kind in SAMPLE_FORMATS, 'write_stack(): unsupported dtype {0}'.format( stack.dtype )
+    stack = stack.astype( stack.dtype.newbyteorder( '<' ), copy = False )
+    ( pages, height, width ) = stack.shape
+    page_bytes = height * width * stack.dtype.itemsize
+    # SampleFormat is only needed when it is not unsigned integer
+    entries = 9 if stack.dtype.kind == 'u' else 10
+    ifd_bytes = 2 + 12 * entries + 4
+    with open( path, 'wb' ) as tiff_file :
+        tiff_file.write( b'II' + struct.pack( '<HI', 42, 8 ) )
+        # each page is its IFD followed by its pixels
+        for page in range( pages ) :
+            offset = 8 + page * ( ifd_bytes + page_bytes )
+            data_offset = offset + ifd_bytes
+            next_offset = data_offset + page_bytes if page + 1 < pages else 0
+            tags = [ ( IMAGE_WIDTH, 4, width ), ( IMAGE_LENGTH, 4, height ),
+                     ( BITS_PER_SAMPLE, 3, 8 * stack.dtype.itemsize ), ( COMPRESSION, 3, 1 ),
+                     ( PHOTOMETRIC, 3, 1 ), ( STRIP_OFFSETS, 4, data_offset ),
+                     ( SAMPLES_PER_PIXEL, 3, 1 ), ( ROWS_PER_STRIP, 4, height ),
+                     ( STRIP_BYTE_COUNTS, 4, page_bytes ) ]
+            if entries == 10 :
+                tags.append( ( SAMPLE_FORMAT, 3, SAMPLE_FORMATS[stack.dtype.kind] ) )
+            ifd = struct.pack( '<H', entries )
+            for ( tag, field_type, value ) in tags :
+                ifd += struct.pack( '<HHI', tag, field_type, 1 )
+                ifd += struct.pack( '<' + FIELD_TYPES[field_type], value ).ljust( 4, b'\0' )
+            tiff_file.write( ifd + struct.pack( '<I', next_offset ) )
+            tiff_file.write( stack[page].tobytes( ) )
+    return path
+
+
+def _read_value ( data, endian, field_type, count, value_field ) :
+    # returns the values of one IFD entry as a list
+    fmt = FIELD_TYPES[field_type]
+    size = struct.calcsize( fmt ) * count
+    if size > 4 :
+        ( pointer, ) = struct.unpack( endian + 'I', value_field )
+        value_field = data[pointer:pointer + size]
+    return list( struct.unpack( endian + fmt * count, value_field[:size] ) )
+
+
+def read_stack ( path ) :
+    # reads an uncompressed TIFF file into a (pages, height, width) array
+    with open( path, 'rb' ) as tiff_file :
+        data = tiff_file.read( )
+    endian = { b'II' : '<', b'MM' : '>' }.get( data[:2] )
+    assert endian is not None, "'{0}' is not a TIFF file".format( path )
+    ( magic, offset ) = struct.unpack( endian + 'HI', data[2:8] )
+    assert magic == 42, "'{0}' is not a TIFF file".format( path )
+    pages = [ ]
+    while offset != 0 :
+        ( entries, ) = struct.unpack( endian + 'H', data[offset:offset + 2] )
+        tags = { }
+        for e in range( entries ) :
+            entry = data[offset + 2 + 12 * e:offset + 14 + 12 * e]
+            ( tag, field_type, count ) = struct.unpack( endian + 'HHI', entry[:8] )
+            if field_type in FIELD_TYPES :
+                tags[tag] = _read_value( data, endian, field_type, count, entry[8:] )
+        assert tags.get( COMPRESSION, [ 1 ] )[0] == 1, "'{0}' is compressed".format( path )
+        samples = tags.get( SAMPLES_PER_PIXEL, [ 1 ] )[0]
+        bits = tags.get( BITS_PER_SAMPLE, [ 1 ] )[0]
+        kind = { 1 : 'u', 2 : 'i', 3 : 'f' }[tags.get( SAMPLE_FORMAT, [ 1 ] )[0]]
+        dtype = numpy.dtype( '{0}{1}{2}'.format( endian, kind, bits // 8 ) )
+        strips = b''.join( data[start:start + count] for ( start, count ) in
+                           zip( tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS] ) )
+        page = numpy.frombuffer( strips, dtype = dtype )
+        page = page.reshape( tags[IMAGE_LENGTH][0], tags[IMAGE_WIDTH][0], samples )
+        # color images (e.g. RGB with one channel in use) are read as their brightest channel
+        pages.append( page.max( axis = 2 ) )
+        ( offset, ) = struct.unpack( endian + 'I', data[offset + 2 + 12 * entries:offset + 6 + 12 * entries] )
+    return numpy.array( pages )
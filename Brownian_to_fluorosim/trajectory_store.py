@@ -0,0 +1,105 @@
+# trajectory_store.py
+# Purpose: keeps the coordinates of a ChromoShake/brownianMotion trajectory
+#  in a compact binary form that can be opened with numpy.memmap, so that the
+#  text output only has to be parsed once and every later run reads its
+#  frames straight from disk.
+
+# A store is a folder holding three files:
+#   coordinates.bin - raw (frames, beads, 3) array in C order
+#   times.npy       - the time of each frame
+#   store.json      - number of beads and frames and the dtype of coordinates.bin
+
+import os
+import json
+
+import numpy
+
+COORDINATES_NAME = 'coordinates.bin'
+TIMES_NAME = 'times.npy'
+META_NAME = 'store.json'
+
+
+def is_store ( path ) :
+    # returns True if path is a folder written by store_writer
+    return os.path.isfile( os.path.join( path, META_NAME ) )
+
+
+class store_writer :
+    # appends frames one at a time to a new store
+
+    def __init__ ( self, path, beads, dtype = 'float64' ) :
+        assert not os.path.isfile( path ), \
+            "'{0}' is the name of an already existing file".format( path )
+        if not os.path.isdir( path ) :
+            os.mkdir( path )
+        self.path = path
+        self.beads = int( beads )
+        self.dtype = numpy.dtype( dtype )
+        self._times = [ ]
+        self._coordinates = open( os.path.join( path, COORDINATES_NAME ), 'wb' )
+        return
+
+    def __enter__ ( self ) :
+        return self
+
+    def __exit__ ( self, exc_type, exc_value, traceback ) :
+        self.close( )
+        return False
+
+    def append ( self, time, coordinates ) :
+        # writes one frame, coordinates being anything that converts to a (beads, 3) array
+        frame = numpy.asarray( coordinates, dtype = self.dtype )
+        assert frame.shape == ( self.beads, 3 ), \
+            'store_writer.append(): frame has shape {0}, expected ({1}, 3)'.format( frame.shape, self.beads )
+        frame.tofile( self._coordinates )
+        self._times.append( float( time ) )
+        return
+
+    def close ( self ) :
+        # writes the times and the metadata, only then is the store readable
+        if self._coordinates.closed :
+            return
+        self._coordinates.close( )
+        numpy.save( os.path.join( self.path, TIMES_NAME ), numpy.array( self._times, dtype = 'float64' ) )
+        with open( os.path.join( self.path, META_NAME ), 'w' ) as meta_file :
+            json.dump( { 'beads' : self.beads, 'frames' : len( self._times ),
+                         'dtype' : self.dtype.name }, meta_file )
+        return
+
+
+class trajectory_store :
+    # read-only view of a store, coordinates are memory mapped
+
+    def __init__ ( self, path ) :
+        assert is_store( path ), "'{0}' is not a trajectory store".format( path )
+        self.path = path
+        with open( os.path.join( path, META_NAME ) ) as meta_file :
+            meta = json.load( meta_file )
+        self.beads = int( meta['beads'] )
+        self.frames = int( meta['frames'] )
+        self.dtype = numpy.dtype( meta['dtype'] )
+        self.times = numpy.load( os.path.join( path, TIMES_NAME ) )
+        if self.frames > 0 :
+            self.coordinates = numpy.memmap( os.path.join( path, COORDINATES_NAME ), dtype = self.dtype,
+                                             mode = 'r', shape = ( self.frames, self.beads, 3 ) )
+        else :
+            self.coordinates = numpy.zeros( ( 0, self.beads, 3 ), dtype = self.dtype )
+        return
+
+    def __len__ ( self ) :
+        return self.frames
+
+    def frame ( self, index ) :
+        # returns ( time, coordinates ) of frame index, coordinates as a float64 (beads, 3) array
+        return ( float( self.times[index] ), numpy.asarray( self.coordinates[index], dtype = 'float64' ) )
+
+    def frame_bytes ( self, indices ) :
+        # bytes read for frames indices
+        return len( indices ) * self.beads * 3 * self.dtype.itemsize
+
+    def iter_frames ( self, indices = None ) :
+        # yields ( time, coordinates ) for each frame in indices (all frames if None)
+        if indices is None :
+            indices = range( self.frames )
+        for index in indices :
+            yield self.frame( index )
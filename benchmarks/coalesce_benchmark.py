@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coalesce_benchmark.py
+# Summary: How much ParseBrownian -coalesce saves against how much it changes
+#  the images. A synthetic chain of beads (synthetic_data.py) is parsed with
+#  each coalescing distance, and every XML frame is rendered with
+#  fluorescence_render, the renderer of the stand-in simulator. For each
+#  distance the spheres per frame, XML bytes, parse and render seconds, and the
+#  difference of the 8-bit images from those without coalescing are printed.
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim'))
+import numpy
+import ParseBrownian
+import fluorescence_render
+import synthetic_data
+
+USAGE_STR = '''Usage:
+{program_name} [args]
+        [args]:
+          [-beads n]: beads of the synthetic chain (default 5000)
+          [-frames n]: time steps of the synthetic chain (default 10)
+          [-bond meters]: distance between neighbouring beads of the chain (default 1e-8)
+          [-distances nm,nm,...]: coalescing distances to try (default 5,10,15,20)
+          [-h],[-help]: prints out usage information and exits
+'''
+
+PSF_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim','GFPbigain.txt')
+#PSF sigmas (lateral, axial nanometers) the stand-in simulator renders with
+PSF_SIGMA = (80.0,200.0)
+
+def parse(colors_path,trajectory,out_path,distance):
+    #writes the XML frames, returns the seconds it took
+    flags = ['-PSF',PSF_FILE,'-scale','1e6','-width','40','-height','40','-out',out_path]
+    if distance is not None:
+        flags += ['-coalesce',str(distance)]
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull,'w')
+    try:
+        params = ParseBrownian.userParams(flags)
+        colors = ParseBrownian.readColors(colors_path)
+        start = time.time()
+        ParseBrownian.parseBrownian(params,colors,trajectory)
+        return time.time()-start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def xmlFiles(out_path):
+    #the XML frames of out_path, not its manifest (frame_manifest.MANIFEST_NAME)
+    return glob.glob(os.path.join(out_path,'*.xml*'))
+
+def render(out_path):
+    #renders every XML frame of out_path, returns (images, spheres per frame, seconds)
+    images = []
+    spheres = 0
+    seconds = 0.0
+    names = sorted(xmlFiles(out_path),key=lambda path: int(path.rsplit('_',1)[1].split('.')[0]))
+    for name in names:
+        params,channels = fluorescence_render.read_simulation(name,PSF_SIGMA)
+        start = time.time()
+        for channel in sorted(channels):
+            positions,radii,densities = channels[channel]
+            images.append(fluorescence_render.stack_to_image(params,fluorescence_render.render_stack(params,positions,radii,densities)))
+            spheres += len(positions)
+        seconds += time.time()-start
+    return images,spheres/float(max(len(names),1)),seconds
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    beads = 5000
+    frames = 10
+    bond = 1e-8
+    distances = [5.0,10.0,15.0,20.0]
+    arguments = sys.argv[1:]
+    for i in range(len(arguments)):
+        if arguments[i]=='-beads':
+            beads = int(arguments[i+1])
+        elif arguments[i]=='-frames':
+            frames = int(arguments[i+1])
+        elif arguments[i]=='-bond':
+            bond = float(arguments[i+1])
+        elif arguments[i]=='-distances':
+            distances = [float(distance) for distance in arguments[i+1].split(',')]
+
+    work_path = tempfile.mkdtemp(prefix='coalesce_benchmark_')
+    try:
+        trajectory = synthetic_data.writeTrajectory(os.path.join(work_path,'trajectory.out'),beads,frames,bond=bond)
+        colors_path = synthetic_data.writeColors(os.path.join(work_path,'trajectory.colors'),beads)
+        print('{:<12} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'coalesce nm','spheres','XML bytes','parse s','render s','mean diff','max diff','corr'))
+        reference = None
+        for distance in [None]+distances:
+            out_path = os.path.join(work_path,'xml')
+            parse_seconds = parse(colors_path,trajectory,out_path,distance)
+            xml_bytes = sum(os.path.getsize(path) for path in xmlFiles(out_path))
+            images,spheres,render_seconds = render(out_path)
+            shutil.rmtree(out_path)
+            images = numpy.array(images,dtype='float64')
+            if reference is None:
+                reference = images
+            difference = numpy.abs(images-reference)
+            correlation = numpy.corrcoef(images.ravel(),reference.ravel())[0,1] if images.std()>0 and reference.std()>0 else float('nan')
+            print('{:<12} {:>10.1f} {:>12} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.0f} {:>10.4f}'.format(
+                'off' if distance is None else '{:g}'.format(distance),spheres,xml_bytes,parse_seconds,render_seconds,
+                difference.mean(),difference.max(),correlation))
+    finally:
+        shutil.rmtree(work_path,ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
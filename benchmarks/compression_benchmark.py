@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# compression_benchmark.py
+# Summary: Wall time and bytes written of the plain text path against compressed
+#  trajectories (.gz, .bz2, .xz) and compressed or bundled XML frames from
+#  ParseBrownian. A synthetic trajectory in the ChromoShake format is written
+#  first, unless a real one is given on the commandline.
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim'))
+import compressed_io
+import brownian_frames
+import ParseBrownian
+import synthetic_data
+
+USAGE_STR = '''Usage:
+{program_name} [args] [trajectory colors]
+        trajectory, colors: a ChromoShake .out file and its colors (default: a synthetic one)
+        [args]:
+          [-beads n]: beads of the synthetic trajectory (default 5000)
+          [-frames n]: time steps of the synthetic trajectory (default 40)
+          [-every n]: write XML frames of every n-th time step (default 1)
+          [-h],[-help]: prints out usage information and exits
+'''
+
+PSF_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim','GFPbigain.txt')
+COMPRESSIONS = [None,'gz','bz2','xz']
+XML_MODES = [[],['-compress','gz'],['-compress','bz2'],['-compress','xz'],['-bundle']]
+
+def outputFiles(path):
+    #the XML files or bundle ParseBrownian wrote to path; glob leaves out the dot files,
+    #its manifest (frame_manifest.MANIFEST_NAME) and files still being written
+    return glob.glob(os.path.join(path,'*'))
+
+def folderBytes(path):
+    return sum(os.path.getsize(name) for name in outputFiles(path))
+
+def timeRead(path):
+    #reads every time step, the sidecar index is removed first so the scan is timed too
+    if os.path.isfile(path+brownian_frames.INDEX_SUFFIX):
+        os.remove(path+brownian_frames.INDEX_SUFFIX)
+    start = time.time()
+    for frame_time,frame in brownian_frames.iter_frames(path):
+        pass
+    return time.time()-start
+
+def timeParse(colors_path,path,out_path,flags,every):
+    params = ParseBrownian.userParams(['-PSF',PSF_FILE,'-every',str(every),'-out',out_path]+flags)
+    colors = ParseBrownian.readColors(colors_path)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull,'w')
+    try:
+        start = time.time()
+        ParseBrownian.parseBrownian(params,colors,path)
+        return time.time()-start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    beads = 5000
+    frames = 40
+    every = 1
+    i = 1
+    while i<len(sys.argv) and sys.argv[i].startswith('-'):
+        if sys.argv[i]=='-beads':
+            beads = int(sys.argv[i+1])
+        elif sys.argv[i]=='-frames':
+            frames = int(sys.argv[i+1])
+        elif sys.argv[i]=='-every':
+            every = int(sys.argv[i+1])
+        i += 2
+    work_path = tempfile.mkdtemp(prefix='compression_benchmark_')
+    try:
+        if i<len(sys.argv):
+            plain_path,colors_path = sys.argv[i],sys.argv[i+1]
+        else:
+            plain_path = os.path.join(work_path,'trajectory.out')
+            colors_path = os.path.join(work_path,'trajectory.colors')
+            synthetic_data.writeTrajectory(plain_path,beads,frames)
+            synthetic_data.writeColors(colors_path,beads)
+        print('{:<28} {:>14} {:>12} {:>12}'.format('trajectory','bytes','write s','read s'))
+        for compression in COMPRESSIONS:
+            path = plain_path
+            seconds = float('nan')
+            if compression is not None:
+                path = os.path.join(work_path,'trajectory.out.'+compression)
+                start = time.time()
+                with open(plain_path,'rb') as plain_file:
+                    with compressed_io.open_file(path,'wb') as out_file:
+                        shutil.copyfileobj(plain_file,out_file)
+                seconds = time.time()-start
+            print('{:<28} {:>14} {:>12.3f} {:>12.3f}'.format(compression or 'plain',os.path.getsize(path),seconds,timeRead(path)))
+            if compression is not None:
+                os.remove(path)
+        print('')
+        print('{:<28} {:>14} {:>12} {:>12}'.format('XML frames','bytes','write s','files'))
+        for flags in XML_MODES:
+            out_path = os.path.join(work_path,'xml')
+            seconds = timeParse(colors_path,plain_path,out_path,flags,every)
+            print('{:<28} {:>14} {:>12.3f} {:>12}'.format(' '.join(flags) or 'plain',folderBytes(out_path),seconds,len(outputFiles(out_path))))
+            shutil.rmtree(out_path)
+    finally:
+        shutil.rmtree(work_path,ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
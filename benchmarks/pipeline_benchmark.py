@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# pipeline_benchmark.py
+# Summary: Times each stage of the pipeline on a synthetic trajectory and SRC
+#  files (synthetic_data.py): SRC conversion, processHeaderMicrons, scanning and
+#  parsing time steps, the MSD of every SRC, coordTransform, make_ModelObjectList,
+#  writing the XML files and exporting TIFF stacks through the stand-in simulator. Results are
+#  written as JSON and can be compared against an earlier run to catch
+#  regressions.
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import platform
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT_PATH)
+sys.path.insert(0,os.path.join(ROOT_PATH,'Brownian_to_fluorosim'))
+import numpy
+import strechscript
+import brownian_frames
+import src_masks
+import ParseBrownian
+import BrownianXMLtoTIFF
+import msd_analysis
+import synthetic_data
+
+USAGE_STR = '''Usage:
+{program_name} [args]
+        [args]:
+          [-beads n]: beads of the synthetic trajectory (default 5000)
+          [-frames n]: time steps of the synthetic trajectory (default 40)
+          [-srcs n]: synthetic SRC files (default 8)
+          [-tiff_frames n]: time steps exported to TIFF, the stand-in is slow (default 4)
+          [-repeat n]: runs each stage n times and keeps the fastest (default 3)
+          [-seed n]: seed of the synthetic data (default 1)
+          [-out file.json]: writes the results here
+          [-baseline file.json]: compares against the results of an earlier run
+          [-tolerance fraction]: a stage slower than the baseline by more than this is a regression (default 0.25)
+          [-h],[-help]: prints out usage information and exits
+'''
+
+PSF_FILE = os.path.join(ROOT_PATH,'Brownian_to_fluorosim','GFPbigain.txt')
+STAND_IN = os.path.join(ROOT_PATH,'Brownian_to_fluorosim','stand_in_simulator.py')
+#same microscope settings as processing.py
+PARSE_ARGS = ['-PSF',PSF_FILE,'-width','75','-height','75']
+
+def quiet(function,*args):
+    #calls function with what it prints thrown away
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull,'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def timeStage(name,items,run,setup=None,repeat=3):
+    #fastest of repeat runs of run() (each after setup(), which is not timed) as a result row
+    best = None
+    for k in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        run()
+        seconds = time.time()-start
+        best = seconds if best is None else min(best,seconds)
+    return {'stage':name,'seconds':best,'items':items,'items_per_second':items/max(best,1e-9)}
+
+def removeIfExists(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+def runStages(work_path,beads,frames,srcs,tiff_frames,repeat,seed):
+    #returns a result row for each stage, in pipeline order
+    trajectory,colors_path,src_path = synthetic_data.writeDataset(os.path.join(work_path,'data'),beads,frames,srcs,seed)
+    micron_path = os.path.join(work_path,'trajectory_microns.out')
+    store_path = os.path.join(work_path,'SRCs'+src_masks.STORE_SUFFIX)
+    xml_path = os.path.join(work_path,'xml')
+    tiff_input = os.path.join(work_path,'xml_tiff')
+    tiff_path = os.path.join(work_path,'tiff')
+    rows = []
+
+    rows.append(timeStage('src_masks',srcs,lambda: src_masks.convert_src_folder(src_path,store_path,beads),repeat=repeat))
+    rows.append(timeStage('processHeaderMicrons',frames,lambda: strechscript.processHeaderMicrons(trajectory,micron_path,beads),
+        lambda: removeIfExists(micron_path),repeat))
+    index_path = micron_path+brownian_frames.INDEX_SUFFIX
+    rows.append(timeStage('frame_scan',frames,lambda: brownian_frames.frame_index(micron_path),
+        lambda: removeIfExists(index_path),repeat))
+    def parse():
+        for frame_time,frame in brownian_frames.iter_frames(micron_path):
+            pass
+    rows.append(timeStage('frame_parse',frames,parse,repeat=repeat))
+    rows.append(timeStage('msd_analysis',srcs,lambda: msd_analysis.analyzeCondition('trajectory',trajectory,[src_path]),repeat=repeat))
+
+    params = quiet(ParseBrownian.userParams,PARSE_ARGS+['-out',xml_path])
+    colors = ParseBrownian.readColors(colors_path)
+    coordinates = [frame for frame_time,frame in brownian_frames.iter_frames(micron_path)]
+    def transform():
+        for point in coordinates[0]:
+            params.coordTransform(point)
+    rows.append(timeStage('coordTransform',beads,transform,repeat=repeat))
+    positions = []
+    def transformArray():
+        del positions[:]
+        for frame in coordinates:
+            positions.append(params.coordTransformArray(frame))
+    rows.append(timeStage('coordTransformArray',frames,transformArray,repeat=repeat))
+    spheres_list = ParseBrownian.makeSpheresList(params,colors)
+    model_lists = []
+    def modelObjectLists():
+        del model_lists[:]
+        for frame in positions:
+            spheres_list.update_coordinates(frame)
+            model_lists.append(spheres_list.make_ModelObjectList(params.use_colors))
+    rows.append(timeStage('make_ModelObjectList',frames,modelObjectLists,repeat=repeat))
+    def writeXML():
+        for number,model_list in enumerate(model_lists,1):
+            out_path = os.path.join(xml_path,'trajectory_{}.xml'.format(number))
+            with open(out_path,'w') as out_file:
+                out_file.write(params.xmlString(out_path,model_list))
+    rows.append(timeStage('xml_write',frames,writeXML,repeat=repeat))
+
+    #the stand-in renders each file, so only the first tiff_frames are exported
+    tiff_frames = min(tiff_frames,frames)
+    os.makedirs(tiff_input)
+    for number in range(1,tiff_frames+1):
+        shutil.copy(os.path.join(xml_path,'trajectory_{}.xml'.format(number)),tiff_input)
+    def exportTIFF():
+        tiff_params = quiet(BrownianXMLtoTIFF.commandParams,['BrownianXMLtoTIFF.py','-green','-simulator',STAND_IN,'-out',tiff_path,tiff_input])
+        failed = quiet(BrownianXMLtoTIFF.xmlToTIFF,tiff_params)
+        assert not failed, '{} XML files failed'.format(len(failed))
+    rows.append(timeStage('tiff_export',tiff_frames,exportTIFF,lambda: removeIfExists(tiff_path),repeat))
+    return rows
+
+def compareBaseline(rows,baseline,tolerance):
+    #adds the baseline's seconds per item and the ratio to each row, returns the names of the
+    #stages that got slower by more than tolerance. Seconds per item are compared so runs on
+    #different sizes can still be compared, roughly.
+    before = dict((row['stage'],row) for row in baseline['stages'])
+    regressions = []
+    for row in rows:
+        if row['stage'] not in before:
+            continue
+        old = before[row['stage']]
+        row['baseline_seconds_per_item'] = old['seconds']/max(old['items'],1)
+        row['ratio'] = (row['seconds']/max(row['items'],1))/max(row['baseline_seconds_per_item'],1e-12)
+        if row['ratio']>1.0+tolerance:
+            regressions.append(row['stage'])
+    return regressions
+
+def printTable(rows):
+    print('{:<24} {:>8} {:>12} {:>14} {:>10}'.format('Stage','Items','Seconds','Items/s','Baseline'))
+    for row in rows:
+        ratio = '{:.2f}x'.format(row['ratio']) if 'ratio' in row else '-'
+        print('{:<24} {:>8} {:>12.4f} {:>14.1f} {:>10}'.format(row['stage'],row['items'],row['seconds'],row['items_per_second'],ratio))
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    config = {'beads':5000,'frames':40,'srcs':8,'tiff_frames':4,'repeat':3,'seed':1}
+    out_path = None
+    baseline_path = None
+    tolerance = 0.25
+    arguments = sys.argv[1:]
+    for i in range(len(arguments)):
+        if arguments[i][1:] in config:
+            config[arguments[i][1:]] = int(arguments[i+1])
+        elif arguments[i]=='-out':
+            out_path = arguments[i+1]
+        elif arguments[i]=='-baseline':
+            baseline_path = arguments[i+1]
+        elif arguments[i]=='-tolerance':
+            tolerance = float(arguments[i+1])
+
+    work_path = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    try:
+        rows = runStages(work_path,config['beads'],config['frames'],config['srcs'],
+            config['tiff_frames'],config['repeat'],config['seed'])
+    finally:
+        shutil.rmtree(work_path,ignore_errors=True)
+    results = {'config':config,'stages':rows,
+               'environment':{'python':platform.python_version(),'numpy':numpy.__version__,
+                              'machine':platform.machine(),'system':platform.system()}}
+    regressions = []
+    if baseline_path is not None:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        #how often stages were repeated does not change what is measured
+        sizes = dict((name,value) for name,value in config.items() if name!='repeat')
+        if dict((name,value) for name,value in baseline['config'].items() if name!='repeat')!=sizes:
+            print('Baseline was run with {}, comparing seconds per item'.format(baseline['config']))
+        regressions = compareBaseline(rows,baseline,tolerance)
+        results['regressions'] = regressions
+    printTable(rows)
+    if out_path is not None:
+        with open(out_path,'w') as out_file:
+            json.dump(results,out_file,indent=2,sort_keys=True)
+    if regressions:
+        print('Slower than the baseline by more than {:.0%}: {}'.format(tolerance,', '.join(regressions)))
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# render_benchmark.py
+# Summary: Times the NumPy renderer (fluorescence_render) on a folder of XML files
+#  written by ParseBrownian, and compares it against Microscope Simulator: either
+#  by running the simulator on the same files (-simulator) or against stacks it
+#  already made (-simulator_tiffs, as renamed by BrownianXMLtoTIFF).
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import os
+import sys
+import glob
+import shutil
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim'))
+import numpy
+import fluorescence_render
+import tiff_io
+
+USAGE_STR = '''Usage:
+{program_name} [args] xml_folder
+        xml_folder: folder of XML files from ParseBrownian
+        [args]:
+          [-simulator path]: also run Microscope Simulator (or a stand-in) on each file and time it
+          [-simulator_tiffs folder]: compare against green stacks already made by BrownianXMLtoTIFF
+          [-psf_sigma lateral axial]: Gaussian PSF of the renderer in nanometers (default 80 200)
+          [-channel name]: channel to render and compare (default green)
+          [-h],[-help]: prints out usage information and exits
+'''
+
+def fileNumber(path):
+    # the integer after the last _ in the name, as BrownianXMLtoTIFF sorts by
+    return int(os.path.splitext(os.path.basename(path))[0].split('_')[-1])
+
+def compareStacks(ours,theirs):
+    # returns ( correlation, mean absolute difference in 0-255 levels ) of two stacks
+    ours = ours.astype('float64').ravel()
+    theirs = theirs.astype('float64').ravel()
+    if ours.std()==0 or theirs.std()==0:
+        correlation = float('nan')
+    else:
+        correlation = float(numpy.corrcoef(ours,theirs)[0,1])
+    return (correlation,float(numpy.abs(ours-theirs).mean()))
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv or len(sys.argv)<2:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    arguments = sys.argv[1:-1]
+    xml_folder = sys.argv[-1]
+    simulator = None
+    simulator_tiffs = None
+    psf_sigma = (80.0,200.0)
+    channel = 'green'
+    for i in range(len(arguments)):
+        if arguments[i]=='-simulator':
+            simulator = os.path.realpath(arguments[i+1])
+        elif arguments[i]=='-simulator_tiffs':
+            simulator_tiffs = arguments[i+1]
+        elif arguments[i]=='-psf_sigma':
+            psf_sigma = (float(arguments[i+1]),float(arguments[i+2]))
+        elif arguments[i]=='-channel':
+            channel = arguments[i+1]
+
+    xml_files = sorted(glob.glob(os.path.join(xml_folder,'*.xml')),key=fileNumber)
+    assert xml_files, 'No XML files in {}'.format(xml_folder)
+
+    #render each file ourselves, keeping the stacks to compare
+    native = {}
+    start = time.time()
+    for path in xml_files:
+        (params,spheres) = fluorescence_render.read_simulation(path,psf_sigma)
+        (positions,radii,densities) = fluorescence_render.channel_spheres(spheres,channel)
+        native[fileNumber(path)] = fluorescence_render.stack_to_image(params,
+            fluorescence_render.render_stack(params,positions,radii,densities))
+    native_seconds = (time.time()-start)/len(xml_files)
+    print('Native renderer: {} files, {:.4f} seconds per file ({:.2f} files per second)'.format(
+        len(xml_files),native_seconds,1.0/max(native_seconds,1e-9)))
+
+    #run the simulator on each file into a scratch folder
+    scratch = None
+    if simulator is not None:
+        scratch = tempfile.mkdtemp()
+        command = [sys.executable,simulator] if simulator.endswith('.py') else [simulator]
+        devnull = open(os.devnull,'w')
+        start = time.time()
+        for path in xml_files:
+            prefix = os.path.join(scratch,os.path.splitext(os.path.basename(path))[0]+'_')
+            subprocess.call(command+['--batch-mode','--open-simulation',path,'--save-fluorescence-stack',
+                '--'+channel,prefix],stdout=devnull,stderr=devnull)
+            for made in glob.glob(prefix+'*'):
+                base,ext = os.path.splitext(made)
+                os.rename(made,'{}_{}{}'.format(base,fileNumber(path),ext))
+        devnull.close()
+        simulator_seconds = (time.time()-start)/len(xml_files)
+        print('Simulator: {:.4f} seconds per file, native renderer is {:.1f} times faster'.format(
+            simulator_seconds,simulator_seconds/max(native_seconds,1e-9)))
+        if simulator_tiffs is None:
+            simulator_tiffs = scratch
+
+    #compare against the simulator's stacks
+    if simulator_tiffs is not None:
+        results = []
+        for path in glob.glob(os.path.join(simulator_tiffs,'*{}*.tif*'.format(channel))):
+            number = fileNumber(path)
+            if number not in native:
+                continue
+            theirs = tiff_io.read_stack(path)
+            if theirs.shape!=native[number].shape:
+                print('{}: shape {} does not match {}'.format(path,theirs.shape,native[number].shape))
+                continue
+            results.append(compareStacks(native[number],theirs))
+        if results:
+            results = numpy.array(results)
+            print('Compared {} stacks: mean correlation {:.4f}, mean absolute difference {:.2f} levels'.format(
+                len(results),numpy.nanmean(results[:,0]),results[:,1].mean()))
+        else:
+            print('No matching {} stacks found in {}'.format(channel,simulator_tiffs))
+    if scratch is not None:
+        shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    main()
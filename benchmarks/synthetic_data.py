@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# synthetic_data.py
+# Summary: Writes synthetic ChromoShake trajectories (header lines, then a
+#  'Time t' block of one 'x y z' line per bead for each time step, in meters)
+#  and SRC files labeling runs of beads with 4, for benchmarking the pipeline
+#  without real simulations. The same seed always gives the same files.
+
+from __future__ import print_function # imports print statement syntax from Python 3
+
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brownian_to_fluorosim'))
+import numpy
+import compressed_io
+
+USAGE_STR = '''Usage:
+{program_name} [args] out_folder
+        out_folder: where trajectory.out, trajectory.colors and SRCs/ are written
+        [args]:
+          [-beads n]: beads of the trajectory (default 5000)
+          [-frames n]: time steps of the trajectory (default 40)
+          [-srcs n]: SRC files to write (default 8)
+          [-seed n]: seed of the random numbers (default 1)
+          [-bond meters]: string the beads into a chain with neighbours this far apart
+          [-h],[-help]: prints out usage information and exits
+'''
+
+#time between time steps and the spread of the beads, roughly what ChromoShake writes
+TIME_STEP = 1.5e-4
+SPREAD = 3e-7
+STEP = 1e-9
+
+def writeTrajectory(path,beads,frames,seed=1,bond=None):
+    #random walk of beads, path can end in .gz, .bz2 or .xz to write it compressed
+    #beads are scattered around the origin, or with bond (meters) strung into a chain
+    #with neighbours bond apart like the beads of a ChromoShake DNA model
+    random = numpy.random.RandomState(seed)
+    if bond is None:
+        positions = random.normal(0,SPREAD,(beads,3))
+    else:
+        steps = random.normal(0,1,(beads,3))
+        steps *= bond/numpy.sqrt((steps**2).sum(axis=1))[:,numpy.newaxis]
+        positions = numpy.cumsum(steps,axis=0)
+        positions -= positions.mean(axis=0)
+    with compressed_io.open_file(path,'w') as out_file:
+        out_file.write('ChromoShake synthetic trajectory\nmass count {}\nseed {}\n\n'.format(beads,seed))
+        for frame in range(frames):
+            positions += random.normal(0,STEP,(beads,3))
+            out_file.write('Time {!r}\n'.format(frame*TIME_STEP))
+            out_file.write(('%r %r %r\n'*beads) % tuple(positions.ravel().tolist()))
+            out_file.write('\n')
+    return path
+
+def writeColors(path,beads,fraction=0.3,seed=1):
+    #colors file for ParseBrownian, about fraction of the beads colored 4
+    random = numpy.random.RandomState(seed)
+    with open(path,'w') as colors_file:
+        colors_file.write(''.join(numpy.where(random.rand(beads)<fraction,'4\n','0\n')))
+    return path
+
+def writeSRCs(folder,beads,count,seed=1):
+    #count SRC files of beads values, each labeling one or two runs of consecutive beads
+    random = numpy.random.RandomState(seed)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = []
+    for k in range(count):
+        labeled = numpy.zeros(beads,dtype=bool)
+        for run in range(random.randint(1,3)):
+            length = random.randint(1,max(2,beads//20))
+            start = random.randint(0,max(1,beads-length))
+            labeled[start:start+length] = True
+        paths.append(os.path.join(folder,'SRC{}.csv'.format(k)))
+        with open(paths[-1],'w') as src_file:
+            src_file.write(''.join(numpy.where(labeled,'4\n','0\n')))
+    return paths
+
+def writeDataset(folder,beads,frames,srcs,seed=1,bond=None):
+    #trajectory.out, trajectory.colors and SRCs/ in folder, returns their paths
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    trajectory = writeTrajectory(os.path.join(folder,'trajectory.out'),beads,frames,seed,bond)
+    colors = writeColors(os.path.join(folder,'trajectory.colors'),beads,seed=seed)
+    writeSRCs(os.path.join(folder,'SRCs'),beads,srcs,seed)
+    return (trajectory,colors,os.path.join(folder,'SRCs'))
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv or len(sys.argv)<2:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    arguments = sys.argv[1:-1]
+    beads = 5000
+    frames = 40
+    srcs = 8
+    seed = 1
+    bond = None
+    for i in range(len(arguments)):
+        if arguments[i]=='-beads':
+            beads = int(arguments[i+1])
+        elif arguments[i]=='-frames':
+            frames = int(arguments[i+1])
+        elif arguments[i]=='-srcs':
+            srcs = int(arguments[i+1])
+        elif arguments[i]=='-seed':
+            seed = int(arguments[i+1])
+        elif arguments[i]=='-bond':
+            bond = float(arguments[i+1])
+    for path in writeDataset(sys.argv[-1],beads,frames,srcs,seed,bond):
+        print(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import os
+import json
+import socket
+import shutil
+import hashlib
+
+#keeps track of which outputs of the pipeline are up to date
+#each output is built from some inputs (files or folders) and some parameters; the
+#hash of both is its key, stored in a stamp file once the output is complete. an
+#output is rebuilt when it is missing, has no stamp, or its key has changed.
+#outputs are written under a temporary name and renamed into place, so a crash
+#never leaves something that looks finished. with resume, the unfinished output of a
+#run that stopped is kept for the next run with the same key to carry on from.
+
+#suffix of the temporary name outputs are written under
+PARTIAL_SUFFIX = '.partial'
+
+def _stampName(path):
+    return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+
+def _writeAtomic(path,text):
+    #named after the machine and process, as several machines can share the state
+    tmp_path = '{}.{}.{}.tmp'.format(path,socket.gethostname(),os.getpid())
+    with open(tmp_path,'w') as tmp_file:
+        tmp_file.write(text)
+    if os.name=='nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path,path)
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _hashFile(path):
+    digest = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class buildGraph:
+    def __init__(self,state_dir):
+        #state_dir holds one stamp per output and cached hashes of inputs
+        self.state_dir = state_dir
+        for sub in ['outputs','hashes','partials']:
+            if not os.path.isdir(os.path.join(state_dir,sub)):
+                try:
+                    os.makedirs(os.path.join(state_dir,sub))
+                except OSError:
+                    #made by another process at the same time
+                    if not os.path.isdir(os.path.join(state_dir,sub)):
+                        raise
+        self.built = []
+        self.skipped = []
+
+    def _read(self,kind,path):
+        try:
+            with open(os.path.join(self.state_dir,kind,_stampName(path))) as f:
+                return json.load(f)
+        except (IOError,OSError,ValueError):
+            return None
+
+    def _write(self,kind,path,value):
+        _writeAtomic(os.path.join(self.state_dir,kind,_stampName(path)),json.dumps(value))
+
+    def outputKey(self,path):
+        #key an existing output was built with, None if it is missing or unfinished
+        stamp = self._read('outputs',path)
+        if stamp is None or not os.path.exists(path):
+            return None
+        return stamp['key']
+
+    def hashPath(self,path):
+        #content hash of a file or folder; outputs we built are hashed by their key,
+        #other files are only read again when their size or mtime changes
+        key = self.outputKey(path)
+        if key is not None:
+            return 'built:'+key
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for name in sorted(os.listdir(path)):
+                digest.update(name.encode('utf-8'))
+                digest.update(self.hashPath(os.path.join(path,name)).encode('utf-8'))
+            return digest.hexdigest()
+        stat = os.stat(path)
+        cached = self._read('hashes',path)
+        if cached is not None and cached['size']==stat.st_size and cached['mtime']==stat.st_mtime:
+            return cached['hash']
+        content = _hashFile(path)
+        self._write('hashes',path,{'size':stat.st_size,'mtime':stat.st_mtime,'hash':content})
+        return content
+
+    def key(self,inputs,params):
+        #hash of the inputs' contents and the parameters
+        digest = hashlib.sha1(json.dumps(params,sort_keys=True).encode('utf-8'))
+        for path in inputs:
+            digest.update(self.hashPath(path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def isStale(self,output,inputs,params):
+        return self.outputKey(output)!=self.key(inputs,params)
+
+    def build(self,output,inputs,params,action,directory=False,resume=False):
+        #runs action(partial_path) if output is stale, then renames partial_path to output;
+        #directory makes partial_path an empty folder first. with resume, partial_path is
+        #kept if action fails, and is handed to the next run with the same key as it was
+        #left, for action to skip what is already in it. returns True if it was rebuilt
+        return len(self.buildAll([(output,inputs,params)],lambda partials: action(partials[0][1]),directory,resume))==1
+
+    def buildAll(self,nodes,action,directory=False,resume=False):
+        #same as build for several outputs made by one action: nodes is a list of
+        #(output,inputs,params) and action gets [(output,partial_path)] for the stale ones.
+        #returns the outputs that were rebuilt
+        stale = []
+        for output,inputs,params in nodes:
+            key = self.key(inputs,params)
+            if self.outputKey(output)==key:
+                self.skipped.append(output)
+            else:
+                stale.append((output,key,inputs,params))
+        if not stale:
+            return []
+        partials = []
+        for output,key,inputs,params in stale:
+            partial = output+PARTIAL_SUFFIX
+            stamp = self._read('partials',output)
+            if not (resume and os.path.exists(partial) and stamp is not None and stamp['key']==key):
+                _remove(partial)
+                if directory:
+                    os.mkdir(partial)
+            self._write('partials',output,{'key':key})
+            partials.append((output,partial))
+        try:
+            action(partials)
+        except BaseException:
+            if not resume:
+                for output,partial in partials:
+                    _remove(partial)
+            raise
+        for output,key,inputs,params in stale:
+            _remove(output)
+            os.rename(output+PARTIAL_SUFFIX,output)
+            self._write('outputs',output,{'key':key,'inputs':list(inputs),'params':params})
+            _remove(os.path.join(self.state_dir,'partials',_stampName(output)))
+            self.built.append(output)
+        return [output for output,key,inputs,params in stale]
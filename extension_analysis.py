@@ -0,0 +1,213 @@
+import os
+import sys
+import tempfile
+import numpy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brownian_to_fluorosim'))
+import brownian_frames
+import trajectory_store
+import src_masks
+
+#extension and contraction rates of the labeled region of each SRC, straight from a trajectory
+#the region's size is measured in every frame at once, three ways:
+#  end_to_end: distance between the first and last labeled bead
+#  principal_axis: extent of the labeled beads along their longest principal axis
+#  spot_separation: distance between the centers of the two largest runs of labeled beads
+#the change of each over lag frames divided by the time it took is a rate in microns per
+#second, extension when positive and contraction when negative.
+
+USAGE_STR = '''Usage:
+{program_name} [args] trajectory SRC [SRC ...]
+        trajectory: ChromoShake .out file, or a trajectory store folder written by
+          strechscript.processHeaderStore (in microns)
+        SRC: SRC color files (.csv or converted .txt), folders of them or mask stores (.masks.npz)
+        [args]:
+          [-name condition]: name of the condition in the output (default: name of the trajectory)
+          [-every n]: only use every n-th frame
+          [-start time],[-end time]: only use frames between these times
+          [-lag n]: rates are measured over n of the used frames (default 1)
+          [-scale factor]: multiply coordinates by factor to get microns (default: 1e6 for text
+            trajectories, ChromoShake .out files are in meters; 1 for stores. Text files already
+            in microns, like those of strechscript.processHeaderMicrons, need -scale 1)
+          [-out file.csv]: writes the rate summaries here (default: prints them)
+          [-series folder]: also saves each SRC's size over time in folder/<SRC>.npz
+          [-h],[-help]: prints out usage information and exits
+'''
+
+MEASURES = ['end_to_end','principal_axis','spot_separation']
+SUMMARY_HEADER = ['condition','SRC','measure','frames','mean_length',
+                  'extensions','extension_mean','extension_median','extension_p90',
+                  'contractions','contraction_mean','contraction_median','contraction_p90']
+
+#frames read at a time, so memory does not grow with the length of the trajectory
+CHUNK_FRAMES = 64
+
+def labeledRuns(mask):
+    #index arrays of the runs of consecutive labeled beads
+    edges = numpy.diff(numpy.concatenate([[0],mask.astype('int8'),[0]]))
+    return [numpy.arange(a,b) for a,b in zip(numpy.nonzero(edges==1)[0],numpy.nonzero(edges==-1)[0])]
+
+def loadBeads(path,indices,every=1,start=None,end=None,memory=None,scale=None):
+    #times and (frames, len(indices), 3) positions in microns of some of the beads; with
+    #memory (bytes), positions that would take more are kept in a temporary file instead.
+    #coordinates are multiplied by scale, by default 1e6 for text files (ChromoShake's
+    #meters) and 1 for stores, which are already in microns
+    frames = brownian_frames.open_frames(path)
+    if scale is None:
+        scale = 1.0 if trajectory_store.is_store(path) else 1e6
+    selected = brownian_frames.select_frames(frames.times,every,start,end)
+    shape = (len(selected),len(indices),3)
+    if memory is not None and numpy.prod(shape)*8>memory:
+        #the file is deleted as soon as the array is no longer used
+        coords = numpy.memmap(tempfile.TemporaryFile(),dtype='float64',mode='w+',shape=shape)
+    else:
+        coords = numpy.empty(shape)
+    if isinstance(frames,trajectory_store.trajectory_store):
+        for a in range(0,len(selected),CHUNK_FRAMES):
+            coords[a:a+CHUNK_FRAMES] = frames.coordinates[selected[a:a+CHUNK_FRAMES]][:,indices]*scale
+    else:
+        for k,(time,frame) in enumerate(frames.iter_frames(selected)):
+            coords[k] = frame[indices]*scale
+    return (numpy.asarray(frames.times)[selected],coords)
+
+def endToEnd(coords):
+    return numpy.sqrt(((coords[:,-1]-coords[:,0])**2).sum(axis=1))
+
+def principalAxis(coords):
+    #extent along the eigenvector of the largest eigenvalue of each frame's covariance
+    centered = coords-coords.mean(axis=1)[:,numpy.newaxis]
+    covariance = numpy.einsum('fki,fkj->fij',centered,centered)
+    axes = numpy.linalg.eigh(covariance)[1][:,:,-1]
+    projected = numpy.einsum('fki,fi->fk',centered,axes)
+    return projected.max(axis=1)-projected.min(axis=1)
+
+def spotSeparation(coords,runs):
+    #runs index into the beads of coords; nan when there are not two spots
+    if len(runs)<2:
+        return numpy.full(len(coords),numpy.nan)
+    largest = sorted(runs,key=len)[-2:]
+    centers = [coords[:,run].mean(axis=1) for run in largest]
+    return numpy.sqrt(((centers[0]-centers[1])**2).sum(axis=1))
+
+def measureRegion(coords,mask):
+    #each measure of the labeled beads for every frame; coords holds only the labeled beads
+    runs = labeledRuns(mask)
+    #positions of each run within the labeled beads
+    offset = 0
+    local_runs = []
+    for run in runs:
+        local_runs.append(numpy.arange(offset,offset+len(run)))
+        offset += len(run)
+    if coords.shape[1]<2:
+        empty = numpy.full(len(coords),numpy.nan)
+        return dict((name,empty) for name in MEASURES)
+    return {'end_to_end':endToEnd(coords),
+            'principal_axis':principalAxis(coords),
+            'spot_separation':spotSeparation(coords,local_runs)}
+
+def rates(times,lengths,lag=1):
+    #change of length over lag frames divided by the time between them, microns per second
+    return (lengths[lag:]-lengths[:-lag])/(times[lag:]-times[:-lag])
+
+def rateSummary(rate):
+    #count, mean, median and 90th percentile of the extension and contraction speeds
+    rate = rate[numpy.isfinite(rate)]
+    row = []
+    for speeds in [rate[rate>0],-rate[rate<0]]:
+        if len(speeds):
+            row.extend([len(speeds),float(speeds.mean()),float(numpy.median(speeds)),float(numpy.percentile(speeds,90))])
+        else:
+            row.extend([0,float('nan'),float('nan'),float('nan')])
+    return row
+
+def loadMasks(paths,beads):
+    #(name, mask) of every SRC in the files, folders and mask stores given, one value per
+    #bead of a trajectory of beads; color files with fewer values are padded with unlabeled beads
+    masks = []
+    for path in paths:
+        if src_masks.is_mask_store(path):
+            store = src_masks.mask_store(path)
+            if store.beads!=beads:
+                raise Exception('{} holds masks of {} beads, the trajectory has {}'.format(path,store.beads,beads))
+            masks.extend((name,store.mask(name)) for name in store.names)
+        elif os.path.isdir(path):
+            masks.extend(loadMasks([os.path.join(path,name) for name in sorted(os.listdir(path))],beads))
+        else:
+            mask = src_masks.src_mask(path)
+            if len(mask)>beads:
+                raise Exception('{} has {} values, the trajectory has only {} beads'.format(path,len(mask),beads))
+            masks.append((src_masks.src_name(path),numpy.concatenate([mask,numpy.zeros(beads-len(mask),dtype=bool)])))
+    return masks
+
+def analyzeCondition(condition,path,SRC_paths,every=1,start=None,end=None,lag=1,series_path=None,scale=None):
+    #summary rows of every SRC against one trajectory
+    beads = brownian_frames.open_frames(path).beads
+    SRCs = loadMasks(SRC_paths,beads)
+    names = [name for name,mask in SRCs]
+    masks = [mask for name,mask in SRCs]
+    #read the beads any SRC labels once, then pick each SRC's out of them
+    union = numpy.nonzero(numpy.any(masks,axis=0))[0] if masks else numpy.zeros(0,dtype=int)
+    times,coords = loadBeads(path,union,every,start,end,scale=scale)
+    position = numpy.full(beads,-1)
+    position[union] = numpy.arange(len(union))
+    rows = []
+    for SRC,mask in zip(names,masks):
+        measures = measureRegion(coords[:,position[mask]],mask)
+        for name in MEASURES:
+            lengths = measures[name]
+            mean_length = float(numpy.nanmean(lengths)) if numpy.isfinite(lengths).any() else float('nan')
+            rows.append([condition,SRC,name,len(lengths),mean_length]+rateSummary(rates(times,lengths,lag)))
+        if series_path is not None:
+            numpy.savez(os.path.join(series_path,SRC+'.npz'),times=times,**measures)
+    return rows
+
+def writeSummary(rows,out_path=None):
+    lines = [','.join(SUMMARY_HEADER)]
+    for row in rows:
+        lines.append(','.join(str(value) if isinstance(value,str) else repr(value) for value in row))
+    if out_path is None:
+        print('\n'.join(lines))
+    else:
+        with open(out_path,'w') as out_file:
+            out_file.write('\n'.join(lines)+'\n')
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv or len(sys.argv)<3:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    condition = None
+    every = 1
+    start = None
+    end = None
+    lag = 1
+    out_path = None
+    series_path = None
+    scale = None
+    i = 1
+    while sys.argv[i].startswith('-'):
+        if sys.argv[i]=='-name':
+            condition = sys.argv[i+1]
+        elif sys.argv[i]=='-every':
+            every = int(sys.argv[i+1])
+        elif sys.argv[i]=='-start':
+            start = float(sys.argv[i+1])
+        elif sys.argv[i]=='-end':
+            end = float(sys.argv[i+1])
+        elif sys.argv[i]=='-lag':
+            lag = int(sys.argv[i+1])
+        elif sys.argv[i]=='-scale':
+            scale = float(sys.argv[i+1])
+        elif sys.argv[i]=='-out':
+            out_path = sys.argv[i+1]
+        elif sys.argv[i]=='-series':
+            series_path = sys.argv[i+1]
+        i += 2
+    path = sys.argv[i]
+    if condition is None:
+        condition = os.path.basename(os.path.normpath(path)).split('.')[0]
+    if series_path is not None and not os.path.isdir(series_path):
+        os.makedirs(series_path)
+    rows = analyzeCondition(condition,path,sys.argv[i+1:],every,start,end,lag,series_path,scale)
+    writeSummary(rows,out_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import os
+import sys
+import math
+import numpy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brownian_to_fluorosim'))
+import brownian_frames
+import extension_analysis
+
+#mean squared displacement of the labeled beads of each SRC, straight from a trajectory
+#the MSD of every lag time is averaged over all pairs of frames that far apart, two ways:
+#  beads: the MSD of each labeled bead, averaged over the labeled beads
+#  center: the MSD of the center of the labeled beads, what a microscope sees of a spot
+#each curve is fitted with MSD = 6 K t^alpha on log-log axes: alpha below 1 is
+#subdiffusive, 1 is free diffusion. the MSD of all lags of a bead takes O(T log T)
+#with FFTs, and blocks of beads are done at once within a memory budget.
+
+USAGE_STR = '''Usage:
+{program_name} [args] trajectory SRC [SRC ...]
+        trajectory: ChromoShake .out file, or a trajectory store folder written by
+          strechscript.processHeaderStore (in microns)
+        SRC: SRC color files (.csv or converted .txt), folders of them or mask stores (.masks.npz)
+        [args]:
+          [-name condition]: name of the condition in the output (default: name of the trajectory)
+          [-every n]: only use every n-th frame
+          [-start time],[-end time]: only use frames between these times
+          [-scale factor]: multiply coordinates by factor to get microns (default: 1e6 for text
+            trajectories, ChromoShake .out files are in meters; 1 for stores. Text files already
+            in microns, like those of strechscript.processHeaderMicrons, need -scale 1)
+          [-fit first last]: fit the exponent over lags first to last, in used frames (default: 1 to a quarter of the frames)
+          [-memory MB]: memory for positions and FFTs; longer runs keep positions in a temporary file (default 512)
+          [-out file.csv]: writes the fitted exponents here (default: prints them)
+          [-curves file.npz]: also saves the MSD curves of every SRC here
+          [-h],[-help]: prints out usage information and exits
+'''
+
+MEASURES = ['beads','center']
+SUMMARY_HEADER = ['condition','SRC','measure','beads','frames','time_step',
+                  'fit_first_lag','fit_last_lag','alpha','K','fit_r2']
+
+#default memory budget, bytes
+MEMORY = 512*2**20
+#lags the fit uses at most, spaced evenly in log lag so long lags do not outweigh short ones
+FIT_POINTS = 50
+
+def fftLength(count):
+    #smallest power of two that holds count values, zero padding enough to not wrap around
+    return 1<<max(0,int(count)-1).bit_length()
+
+def msdFFT(positions):
+    #MSD of lags 0 to T-1 of each trajectory in positions (T, ..., 3), averaged over all
+    #pairs of frames that lag apart. sum |r(t+m)-r(t)|^2 = sum r(t)^2+r(t+m)^2 - 2 r(t).r(t+m):
+    #the squares come from prefix sums and the cross term is the autocorrelation, by FFT
+    positions = numpy.asarray(positions,dtype='float64')
+    count = len(positions)
+    if count==0:
+        return numpy.zeros(positions.shape[:-1])
+    lags = numpy.arange(count)
+    squares = (positions**2).sum(axis=-1)
+    prefix = numpy.concatenate([numpy.zeros((1,)+squares.shape[1:]),numpy.cumsum(squares,axis=0)])
+    #r(t)^2 summed over t < T-m, plus r(t+m)^2 summed over the same t
+    square_sums = prefix[count-lags]+(prefix[count]-prefix[lags])
+    size = fftLength(2*count)
+    transform = numpy.fft.rfft(positions,size,axis=0)
+    correlation = numpy.fft.irfft((transform.real**2+transform.imag**2).sum(axis=-1),size,axis=0)[:count]
+    msd = (square_sums-2.0*correlation)/(count-lags).reshape((count,)+(1,)*(squares.ndim-1))
+    #rounding can leave tiny negatives where the MSD is close to 0
+    msd[0] = 0.0
+    return numpy.maximum(msd,0.0)
+
+def msdDirect(positions):
+    #same as msdFFT by summing every pair of frames, O(T^2); for checking it
+    positions = numpy.asarray(positions,dtype='float64')
+    msd = numpy.zeros(positions.shape[:-1])
+    for lag in range(1,len(positions)):
+        msd[lag] = ((positions[lag:]-positions[:-lag])**2).sum(axis=-1).mean(axis=0)
+    return msd
+
+def blockBeads(count,memory):
+    #beads whose MSD fits in memory at once with count frames
+    #(the padded input, its transform and a few arrays of squares per bead)
+    return max(1,int(memory//(fftLength(2*count)*3*8*4)))
+
+def fitExponent(lag_times,msd,first,last):
+    #alpha, K and r^2 of MSD = 6 K t^alpha, least squares on log-log axes over lags first to last
+    last = min(last,len(msd)-1)
+    if first<1 or last<=first:
+        return (float('nan'),float('nan'),float('nan'))
+    lags = numpy.unique(numpy.round(numpy.logspace(math.log10(first),math.log10(last),FIT_POINTS)).astype(int))
+    lags = lags[(msd[lags]>0)&numpy.isfinite(msd[lags])]
+    if len(lags)<2:
+        return (float('nan'),float('nan'),float('nan'))
+    x = numpy.log(lag_times[lags])
+    y = numpy.log(msd[lags])
+    alpha,intercept = numpy.polyfit(x,y,1)
+    residual = y-(alpha*x+intercept)
+    spread = ((y-y.mean())**2).sum()
+    r2 = 1.0-(residual**2).sum()/spread if spread>0 else 1.0
+    return (float(alpha),float(math.exp(intercept)/6.0),float(r2))
+
+def conditionCurves(path,SRC_paths,every=1,start=None,end=None,memory=MEMORY,scale=None):
+    #(names, bead counts, lag times, {measure: (SRCs, lags) MSD}) of every SRC against one trajectory
+    beads = brownian_frames.open_frames(path).beads
+    SRCs = extension_analysis.loadMasks(SRC_paths,beads)
+    names = [name for name,mask in SRCs]
+    masks = numpy.array([mask for name,mask in SRCs],dtype=bool).reshape(len(SRCs),beads)
+    #read the beads any SRC labels once, every SRC's curves come out of them
+    union = numpy.nonzero(masks.any(axis=0))[0]
+    times,coords = extension_analysis.loadBeads(path,union,every,start,end,memory,scale)
+    count = len(times)
+    #weight of each read bead in the mean of each SRC
+    labeled = masks[:,union].T.astype('float64')
+    counts = labeled.sum(axis=0)
+    weights = labeled/numpy.maximum(counts,1.0)
+    curves = dict((measure,numpy.zeros((count,len(names)))) for measure in MEASURES)
+    centers = numpy.zeros((count,len(names),3))
+    block = blockBeads(count,memory)
+    for a in range(0,len(union),block):
+        part = numpy.asarray(coords[:,a:a+block])
+        curves['beads'] += numpy.dot(msdFFT(part),weights[a:a+block])
+        centers += numpy.einsum('fki,ks->fsi',part,weights[a:a+block])
+    curves['center'] = msdFFT(centers)
+    for measure in MEASURES:
+        curves[measure][:,counts==0] = numpy.nan
+        curves[measure] = curves[measure].T
+    time_step = float(numpy.median(numpy.diff(times))) if count>1 else float('nan')
+    return (names,counts.astype(int),numpy.arange(count)*time_step,curves)
+
+def analyzeCondition(condition,path,SRC_paths,every=1,start=None,end=None,fit=None,memory=MEMORY,curves_path=None,scale=None):
+    #summary rows of every SRC against one trajectory; fit is (first, last) lag, in used frames
+    names,counts,lag_times,curves = conditionCurves(path,SRC_paths,every,start,end,memory,scale)
+    first,last = fit if fit is not None else (1,max(2,len(lag_times)//4))
+    last = min(last,len(lag_times)-1)
+    time_step = lag_times[1] if len(lag_times)>1 else float('nan')
+    rows = []
+    for k,SRC in enumerate(names):
+        for measure in MEASURES:
+            rows.append([condition,SRC,measure,int(counts[k]),len(lag_times),float(time_step),first,last]+
+                        list(fitExponent(lag_times,curves[measure][k],first,last)))
+    if curves_path is not None:
+        #through a file object so numpy does not append .npz to the name
+        with open(curves_path,'wb') as curves_file:
+            numpy.savez(curves_file,condition=condition,SRCs=numpy.array(names,dtype='U'),
+                        lag_times=lag_times,**curves)
+    return rows
+
+def writeSummary(rows,out_path=None):
+    lines = [','.join(SUMMARY_HEADER)]
+    for row in rows:
+        lines.append(','.join(str(value) if isinstance(value,str) else repr(value) for value in row))
+    if out_path is None:
+        print('\n'.join(lines))
+    else:
+        with open(out_path,'w') as out_file:
+            out_file.write('\n'.join(lines)+'\n')
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv or len(sys.argv)<3:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    condition = None
+    every = 1
+    start = None
+    end = None
+    fit = None
+    memory = MEMORY
+    out_path = None
+    curves_path = None
+    scale = None
+    i = 1
+    while sys.argv[i].startswith('-'):
+        if sys.argv[i]=='-name':
+            condition = sys.argv[i+1]
+        elif sys.argv[i]=='-every':
+            every = int(sys.argv[i+1])
+        elif sys.argv[i]=='-start':
+            start = float(sys.argv[i+1])
+        elif sys.argv[i]=='-end':
+            end = float(sys.argv[i+1])
+        elif sys.argv[i]=='-scale':
+            scale = float(sys.argv[i+1])
+        elif sys.argv[i]=='-fit':
+            fit = (int(sys.argv[i+1]),int(sys.argv[i+2]))
+            i += 1
+        elif sys.argv[i]=='-memory':
+            memory = int(float(sys.argv[i+1])*2**20)
+        elif sys.argv[i]=='-out':
+            out_path = sys.argv[i+1]
+        elif sys.argv[i]=='-curves':
+            curves_path = sys.argv[i+1]
+        i += 2
+    path = sys.argv[i]
+    if condition is None:
+        condition = os.path.basename(os.path.normpath(path)).split('.')[0]
+    rows = analyzeCondition(condition,path,sys.argv[i+1:],every,start,end,fit,memory,curves_path,scale)
+    writeSummary(rows,out_path)
+
+if __name__ == '__main__':
+    main()
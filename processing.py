@@ -1,115 +1,243 @@
 import os
-import datetime
 import sys
-import shutil
+import multiprocessing
 sys.path.insert(0,os.getcwd()+'/YeastYogi')
 from strechscript import *
-
-print('Welcome to YeastYogi...')
-print('Initializing...')
+from buildgraph import buildGraph
+from scheduler import jobScheduler
+from workqueue import workQueue
+import extension_analysis
+import msd_analysis
+import src_masks
+import metrics
+import ParseBrownian
+import BrownianXMLtoTIFF
 
 pwd = os.getcwd()
 YOGI_PATH = os.path.join(pwd,'YeastYogiResults')
-if not os.path.isdir(YOGI_PATH):
-    os.mkdir(YOGI_PATH)
-
 BASE_PATH = os.path.join(pwd,'chromoshake_centromere')
 PSF_FILE = os.path.join(pwd,'YeastYogi','Brownian_to_fluorosim','GFPbigain.txt')
-
-#if not os.path.exists(PSF_FILE):
-   # raise Exception('Please check for a PSF file in '+BASE_PATH)
-
+#hashes of what each output was built from, so only outputs whose inputs changed are redone
+BUILD_PATH = os.path.join(YOGI_PATH,'.build')
 
 out_files = ['WT.out','no_coh.out','no_cond.out','no_coh_no_cond.out']
 
-#Need the number of beads for each file
-number_dict = {
-'WT.out':12416,
-'no_coh.out':11648,
-'no_cond.out':12416,
-'no_coh_no_cond.out':11648
-}
-
 #convert the excel files
 EXCEL_PATH = os.path.join(BASE_PATH, '5000trimmed_MSD_analysis',)
 COH_PATH = os.path.join(EXCEL_PATH,'6p8_coh_SRC')
 NO_COH_PATH = os.path.join(EXCEL_PATH,'6p8_no_coh_SRC')
+#every SRC of a folder goes into one packed mask store
+COH_PATH_OUT = os.path.join(YOGI_PATH,'6p8_coh_SRC'+src_masks.STORE_SUFFIX)
+NO_COH_PATH_OUT = os.path.join(YOGI_PATH,'6p8_no_coh_SRC'+src_masks.STORE_SUFFIX)
+
+#each condition, the mask store of the SRC set it is run against and the name of its folder for them
+CONDITIONS = [
+('WT.out',COH_PATH_OUT,'coh'),
+('no_cond.out',COH_PATH_OUT,'coh'),
+('no_coh.out',NO_COH_PATH_OUT,'no_coh'),
+('no_coh_no_cond.out',NO_COH_PATH_OUT,'no_coh')
+]
+
+#arguments for ParseBrownian and BrownianXMLtoTIFF, same as on their command lines
+#ParseBrownian reads the .out files directly, converting their meters to microns
+PARSE_ARGS = ['-PSF',PSF_FILE,'-width','75','-height','75','-every','25','-scale','1e6']
+TIFF_ARGS = ['-green']
+#SRCs parsed by each ParseBrownian job, reading the trajectory once for all of them; fixed
+#rather than one group per local worker, so every machine sharing a queue makes the same jobs
+PARSE_GROUP = 4
+
+def runTIFF(tiff_args,out_path,tiff_path):
+    #BrownianXMLtoTIFF on the XML files of one SRC, returns its metrics records; files
+    #finished by a run that stopped or failed are not run again
+    params = BrownianXMLtoTIFF.commandParams(['BrownianXMLtoTIFF.py']+tiff_args+['-resume','-out',tiff_path,out_path])
+    failed = BrownianXMLtoTIFF.xmlToTIFF(params)
+    if failed:
+        raise Exception('{} of {} XML files failed'.format(len(failed),len(params.file_list)))
+    return params.metrics.records()
+
+#the jobs below run in the scheduler's worker processes; each returns how many of its
+#outputs it rebuilt, how many it has and the metrics records of what it ran (or None).
+#the folders of ParseBrownian and BrownianXMLtoTIFF are built with resume: if a job
+#stops or fails, what it finished is kept and the next run only does the rest
+
+def parseJob(params,parse_args,path,masks_path,SRCs,set_path):
+    #ParseBrownian on some SRCs of a condition, reading each time step once for all of them
+    store = src_masks.mask_store(masks_path)
+    #keyed on each SRC's mask rather than the whole store, so changing one SRC reruns only it
+    nodes = [(os.path.join(set_path,SRC),[path,PSF_FILE],
+              {'stage':'ParseBrownian','args':parse_args,'SRC':SRC,'mask':store.digest(SRC)}) for SRC in SRCs]
+    params.metrics = metrics.run_metrics('ParseBrownian')
+    def parse(partials):
+        color_sets = [(os.path.basename(output),store.colors(os.path.basename(output))) for output,partial in partials]
+        ParseBrownian.parseBrownianSets(params,color_sets,path,folders=[partial for output,partial in partials])
+    return (len(buildGraph(BUILD_PATH).buildAll(nodes,parse,True,True)),len(nodes),params.metrics.records())
+
+def extensionJob(condition,path,masks_path,out_path):
+    #extension and contraction rates of every SRC of a condition
+    def analyze(partial):
+        extension_analysis.writeSummary(extension_analysis.analyzeCondition(condition,path,[masks_path]),partial)
+    return (int(buildGraph(BUILD_PATH).build(out_path,[path,masks_path],{'stage':'extension_analysis'},analyze)),1,None)
 
-print('Converting color files...')
-COH_PATH_OUT = os.path.join(YOGI_PATH,'6p8_coh_SRC')
-NO_COH_PATH_OUT = os.path.join(YOGI_PATH,'6p8_no_coh_SRC')
-if not os.path.isdir(COH_PATH_OUT):
-    os.mkdir(COH_PATH_OUT)
-    convertColorFiles(COH_PATH,COH_PATH_OUT,number_dict['WT.out'])
-if not os.path.isdir(NO_COH_PATH_OUT):
-    os.mkdir(NO_COH_PATH_OUT)
-    convertColorFiles(NO_COH_PATH,NO_COH_PATH_OUT,number_dict['no_coh.out'])
-
-#convert the outfiles -- take off header and multiply
-for f in out_files:
-    path = os.path.join(BASE_PATH,f)
-    txt_file = os.path.join(YOGI_PATH,f.replace('.out','.txt'))
-    if not os.path.exists(txt_file):
-        print('Converting {}...'.format(f))
-        processHeaderMicrons(path,txt_file,number_dict[f])
-
-#for each SRC, output a shorter text file
-#parseBrownian
-#BrownianXMLtoTIFF
-print('Processing files...')
-for f in ['WT.out','no_cond.out']:
-    condition = f.split('.')[0]
-    condition_path = os.path.join(YOGI_PATH,condition)
-    file_path = os.path.join(YOGI_PATH,condition+'.txt')
-    coh_path = os.path.join(condition_path,'coh')
-    if not os.path.isdir(condition_path):
-        os.mkdir(condition_path)
-    if not os.path.isdir(coh_path):
-        os.mkdir(coh_path)
-    for SRC in os.listdir(COH_PATH_OUT):
-        out_path = os.path.join(coh_path,SRC.split('.')[0])
-        SRC_path = os.path.join(COH_PATH_OUT,SRC)
-        tiff_path = os.path.join(coh_path,SRC.split('.')[0]+'_tiff')
-        if not os.path.isdir(out_path):
-            try: 
-                os.mkdir(out_path)
-                os.system("python {} -PSF {} -out {} -width 75 -height 75 -every 25 {} {}".format(os.path.join('YeastYogi','Brownian_to_fluorosim','ParseBrownian.py'),PSF_FILE,out_path,SRC_path,file_path))
-            except (KeyboardInterrupt, SystemExit):
-                shutil.rmtree(out_path)
-            except:
-                pass
-        if not os.path.isdir(tiff_path):
-            try:
-                os.mkdir(tiff_path)
-                os.system("python {} -green -out {} {}".format(os.path.join('YeastYogi','Brownian_to_fluorosim','BrownianXMLtoTIFF.py'),tiff_path,out_path))
-            except (KeyboardInterrupt, SystemExit):
-                shutil.rmtree(tiff_path)
-            except:
-                pass      
-for f in ['no_coh.out','no_coh_no_cond.out']:
-    condition = f.split('.')[0]
-    condition_path = os.path.join(YOGI_PATH,condition)
-    file_path = os.path.join(YOGI_PATH,condition+'.txt')
-    no_coh_path = os.path.join(condition_path,'no_coh')
-    if not os.path.isdir(condition_path):
-        os.mkdir(condition_path)
-    if not os.path.isdir(no_coh_path):
-        os.mkdir(no_coh_path)
-    for SRC in os.listdir(NO_COH_PATH_OUT):
-        out_path = os.path.join(no_coh_path,SRC.split('.')[0])
-        SRC_path = os.path.join(NO_COH_PATH_OUT,SRC)
-        tiff_path = os.path.join(coh_path,SRC.split('.')[0]+'_tiff')
+def msdJob(condition,path,masks_path,out_path):
+    #MSD curves and fitted exponents of every SRC of a condition, in one folder
+    def analyze(partial):
+        rows = msd_analysis.analyzeCondition(condition,path,[masks_path],curves_path=os.path.join(partial,'msd_curves.npz'))
+        msd_analysis.writeSummary(rows,os.path.join(partial,'msd_summary.csv'))
+    return (int(buildGraph(BUILD_PATH).build(out_path,[path,masks_path],{'stage':'msd_analysis'},analyze,True)),1,None)
+
+def tiffJob(tiff_args,out_path,tiff_path):
+    #BrownianXMLtoTIFF on one SRC
+    records = []
+    rebuilt = buildGraph(BUILD_PATH).build(tiff_path,[out_path],{'stage':'BrownianXMLtoTIFF','args':tiff_args},
+        lambda partial: records.append(runTIFF(tiff_args,out_path,partial)),True,True)
+    return (int(rebuilt),1,records[0] if records else None)
+
+def makeFolder(path):
+    #makes path unless it is there, also when another worker makes it at the same time
+    if not os.path.isdir(path):
         try:
-            if not os.path.isdir(out_path):
-                os.mkdir(out_path)
-                print(out_path)
-                os.system("python {} -PSF {} -out {} -width 75 -height 75 -every 25 {} {}".format(os.path.join('YeastYogi','Brownian_to_fluorosim','ParseBrownian.py'),PSF_FILE,out_path,SRC_path,file_path))
-            if not os.path.isdir(tiff_path):
-                os.mkdir(tiff_path)
-                os.system("python {} -green -out {} {}".format(os.path.join('YeastYogi','Brownian_to_fluorosim','BrownianXMLtoTIFF.py'),tiff_path,out_path))
-        except:
-            try:
-                os.rmdir(out_path)
-                os.rmdir(tiff_path)
-            except:
-                pass  
\ No newline at end of file
+            os.mkdir(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+def writeMetrics(run,scheduler,path):
+    #the run's own stages, then each job and what it ran, to path (.json or .csv)
+    for j in scheduler.jobs:
+        if j.record is not None:
+            run.stages.append(dict(j.record,name=j.label()))
+        if j.result is not None and j.result[2] is not None:
+            run.extend(j.result[2],j.label()+': ')
+    return run.write(path)
+
+def main():
+    print('Welcome to YeastYogi...')
+    print('Initializing...')
+    workers = {'parse':multiprocessing.cpu_count(),'render':1}
+    parse_group = PARSE_GROUP
+    metrics_path = None
+    profile_folder = None
+    queue_folder = None
+    queue_args = {}
+    for i in range(1,len(sys.argv)):
+        #a different Microscope Simulator (or stand_in_simulator.py)
+        if sys.argv[i]=='-simulator':
+            TIFF_ARGS.extend(['-simulator',sys.argv[i+1]])
+        #leave out spheres too far from the 75x75 pixel, 5 plane volume to show up in it;
+        #the default margin is 5 sigmas of the stand-in's Gaussian PSF, far less than the
+        #axial tails of the widefield PSF file, so give Microscope Simulator runs a margin
+        #(-cull_margin lateral axial, nanometers) as wide as that PSF
+        elif sys.argv[i]=='-cull':
+            PARSE_ARGS.append('-cull')
+        elif sys.argv[i]=='-cull_margin':
+            PARSE_ARGS.extend(['-cull_margin',sys.argv[i+1],sys.argv[i+2]])
+        #how many SRCs are parsed and rendered at once
+        elif sys.argv[i]=='-workers':
+            workers = {'parse':int(sys.argv[i+1]),'render':int(sys.argv[i+1])}
+        elif sys.argv[i]=='-parse_workers':
+            workers['parse'] = int(sys.argv[i+1])
+        elif sys.argv[i]=='-render_workers':
+            workers['render'] = int(sys.argv[i+1])
+        #how many SRCs each ParseBrownian job parses
+        elif sys.argv[i]=='-parse_group':
+            parse_group = int(sys.argv[i+1])
+        #time, bytes and memory of every stage and job to a .json or .csv file
+        elif sys.argv[i]=='-metrics':
+            metrics_path = sys.argv[i+1]
+        #cProfile each job into a folder
+        elif sys.argv[i]=='-profile':
+            profile_folder = os.path.realpath(sys.argv[i+1])
+        #share the jobs with every processing.py started with the same folder (on a
+        #filesystem all of them see), each running the jobs it claims
+        elif sys.argv[i]=='-queue':
+            queue_folder = os.path.realpath(sys.argv[i+1])
+        #name of this worker in the queue, seconds between its heartbeats, and how long
+        #a claim can go without one before it counts as left by a dead worker
+        elif sys.argv[i]=='-worker':
+            queue_args['worker'] = sys.argv[i+1]
+        elif sys.argv[i]=='-heartbeat':
+            queue_args['heartbeat'] = float(sys.argv[i+1])
+        elif sys.argv[i]=='-stale':
+            queue_args['stale'] = float(sys.argv[i+1])
+    makeFolder(YOGI_PATH)
+    graph = buildGraph(BUILD_PATH)
+    work_queue = None
+    if queue_folder is not None:
+        work_queue = workQueue(queue_folder,**queue_args)
+        print('Sharing jobs through {} as {}'.format(queue_folder,work_queue.worker))
+    run = metrics.run_metrics('processing')
+    if profile_folder is not None and not os.path.isdir(profile_folder):
+        os.makedirs(profile_folder)
+
+    #if not os.path.exists(PSF_FILE):
+       # raise Exception('Please check for a PSF file in '+BASE_PATH)
+
+    #Need the number of beads for each file, read from its first time step; this also
+    #indexes the time steps of each file once, before the jobs read them
+    number_dict = {}
+    for f in out_files:
+        number_dict[f] = countBeads(os.path.join(BASE_PATH,f))
+
+    print('Converting color files...')
+    def convertMasks():
+        for SRC_path,out_path,number in [(COH_PATH,COH_PATH_OUT,number_dict['WT.out']),
+                                         (NO_COH_PATH,NO_COH_PATH_OUT,number_dict['no_coh.out'])]:
+            graph.build(out_path,[SRC_path],{'stage':'masks','beads':number},
+                lambda partial: convertColorStore(SRC_path,partial,number))
+    with run.stage('color_masks',2):
+        if work_queue is None:
+            convertMasks()
+        else:
+            #one worker converts them, the others wait and find them up to date
+            with work_queue.exclusive('color_masks'):
+                convertMasks()
+
+    #the job matrix: every condition against every SRC of its set
+    #the .out files are read as they are (header skipped, scaled to microns while
+    #transforming), only the time steps that are used get parsed
+    #for each SRC parseBrownian, then BrownianXMLtoTIFF
+    #the PSF file is read once, then each SRC gets a copy pointing at its own folder
+    params = ParseBrownian.userParams(PARSE_ARGS+['-out',YOGI_PATH])
+    #set outside PARSE_ARGS, so it is not part of what the outputs are keyed on
+    params.resume = True
+    scheduler = jobScheduler(workers,profile_folder)
+    for f,masks_path,SRC_set in CONDITIONS:
+        condition = f.split('.')[0]
+        condition_path = os.path.join(YOGI_PATH,condition)
+        path = os.path.join(BASE_PATH,f)
+        set_path = os.path.join(condition_path,SRC_set)
+        makeFolder(condition_path)
+        makeFolder(set_path)
+        scheduler.add('parse',(condition,),'extension_analysis',extensionJob,
+            (condition,path,masks_path,os.path.join(condition_path,'extension_rates.csv')))
+        scheduler.add('parse',(condition,),'msd_analysis',msdJob,
+            (condition,path,masks_path,os.path.join(condition_path,'msd')))
+        #the SRCs are split into groups of at most parse_group; each group reads the
+        #trajectory once for all of its SRCs
+        SRCs = src_masks.mask_store(masks_path).names
+        groups = max(1,-(-len(SRCs)//parse_group))
+        for g in range(groups):
+            group = SRCs[g::groups]
+            parse = scheduler.add('parse',(condition,'SRC group {} of {}'.format(g+1,groups)),'ParseBrownian',parseJob,
+                (params,list(PARSE_ARGS),path,masks_path,group,set_path))
+            for SRC in group:
+                #the TIFFs are only made from XML files that are up to date
+                scheduler.add('render',(condition,SRC),'BrownianXMLtoTIFF',tiffJob,
+                    (list(TIFF_ARGS),os.path.join(set_path,SRC),os.path.join(set_path,SRC+'_tiff')),parse)
+
+    print('Processing {} jobs...'.format(len(scheduler.jobs)))
+    with run.stage('jobs',len(scheduler.jobs)):
+        failed = scheduler.run() if work_queue is None else scheduler.runShared(work_queue)
+    print(scheduler.summary())
+    counts = [j.result for j in scheduler.jobs if j.result is not None]
+    rebuilt = sum(built for built,total,records in counts)
+    print('{} outputs rebuilt, {} up to date.'.format(rebuilt,sum(total for built,total,records in counts)-rebuilt))
+    if metrics_path is not None:
+        print('Metrics written to {}'.format(writeMetrics(run,scheduler,metrics_path)))
+    if failed:
+        print('{} jobs failed.'.format(len(failed)))
+    else:
+        print('All jobs finished.')
+
+if __name__ == '__main__':
+    main()
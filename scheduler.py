@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import queue
+from io import StringIO
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brownian_to_fluorosim'))
+import metrics
+import workqueue
+
+#runs a matrix of independent jobs on local process pools
+#jobs are added with the pool they run in and optionally a job they wait for; each pool
+#has its own worker count, so e.g. parsing and rendering can be limited separately.
+#what a job prints is kept with its result, and progress, timings and failures are
+#reported in one place. Each job also gets a metrics record (wall and CPU time, bytes,
+#peak memory of its worker) and can be profiled with cProfile.
+#a job whose result cannot be sent back, or whose worker dies, fails instead of being
+#waited for; a pool that lost a worker is replaced for the jobs still to come.
+#with runShared, several schedulers (on different machines) share one matrix of jobs
+#through a workqueue: each job runs in whichever scheduler claims it first.
+
+class job:
+    def __init__(self,name,stage,function,args,after=None):
+        #name is a tuple such as (condition,SRC); function must be importable by the workers
+        self.name = name
+        self.stage = stage
+        self.function = function
+        self.args = args
+        self.after = after
+        self.status = 'waiting'
+        self.result = None
+        self.error = None
+        self.output = ''
+        self.seconds = 0.0
+        self.record = None
+        self.started = None
+
+    def label(self):
+        return ' '.join([str(n) for n in self.name]+[self.stage])
+
+    def finished(self):
+        #succeeded, here or in another scheduler sharing the queue
+        return self.status in ['done','elsewhere']
+
+def _runJob(function,args,stage,profile_path=None):
+    #runs in a worker: times and measures the job and keeps what it prints
+    start = time.time()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    result = None
+    error = None
+    run = metrics.run_metrics(stage)
+    try:
+        with run.stage(stage),metrics.profiled(profile_path):
+            result = function(*args)
+    except (Exception,SystemExit):
+        error = traceback.format_exc()
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return (result,error,time.time()-start,output,run.stages[0])
+
+class jobScheduler:
+    def __init__(self,workers,profile_folder=None):
+        #workers maps each pool name to its number of processes; with profile_folder
+        #each job is profiled into profile_folder/<job>.prof
+        self.workers = workers
+        self.profile_folder = profile_folder
+        self.jobs = []
+        self.pools = {}
+        self.seconds = 0.0
+
+    def add(self,pool,name,stage,function,args,after=None):
+        assert pool in self.workers, 'No pool named {}'.format(pool)
+        new_job = job(name,stage,function,args,after)
+        new_job.pool = pool
+        self.jobs.append(new_job)
+        return new_job
+
+    def _startPools(self):
+        self.pools = dict((name,ProcessPoolExecutor(count)) for name,count in self.workers.items())
+
+    def _stopPools(self,wait):
+        for pool in self.pools.values():
+            #without waiting, the jobs not started yet are dropped
+            pool.shutdown(wait,cancel_futures=not wait)
+
+    def _submit(self,new_job,finished):
+        new_job.status = 'running'
+        new_job.started = time.time()
+        profile_path = None
+        if self.profile_folder is not None:
+            profile_path = os.path.join(self.profile_folder,'_'.join(new_job.label().split())+'.prof')
+        args = (_runJob,new_job.function,new_job.args,new_job.stage,profile_path)
+        try:
+            future = self.pools[new_job.pool].submit(*args)
+        except BrokenProcessPool:
+            #a worker of the pool died, failing the jobs it had; the rest get a new pool
+            self.pools[new_job.pool] = ProcessPoolExecutor(self.workers[new_job.pool])
+            future = self.pools[new_job.pool].submit(*args)
+        future.add_done_callback(lambda future: finished.put((new_job,future)))
+
+    def _outcome(self,j,future):
+        #what _runJob returned, or a failure if it never got to return it (its result
+        #could not be sent back, or its worker died)
+        error = future.exception()
+        if error is None:
+            return future.result()
+        #the same error can fail several jobs, so not its growing traceback
+        return (None,''.join(traceback.format_exception_only(type(error),error)),time.time()-j.started,'',None)
+
+    def run(self):
+        #runs every job, starting each as soon as the one it waits for has succeeded
+        start = time.time()
+        finished = queue.Queue()
+        waiting = {}
+        for j in self.jobs:
+            if j.after is not None:
+                waiting.setdefault(id(j.after),[]).append(j)
+        self._startPools()
+        try:
+            remaining = len(self.jobs)
+            for j in self.jobs:
+                if j.after is None:
+                    self._submit(j,finished)
+            done = 0
+            while remaining:
+                #a timeout keeps the wait interruptible with Ctrl-C
+                try:
+                    j,future = finished.get(timeout=1)
+                except queue.Empty:
+                    continue
+                j.result,j.error,j.seconds,j.output,j.record = self._outcome(j,future)
+                remaining -= 1
+                done += 1
+                j.status = 'failed' if j.error is not None else 'done'
+                print('[{}/{}] {} {} ({:.2f} s)'.format(done,len(self.jobs),j.label(),j.status,j.seconds))
+                #jobs waiting on a failed job are skipped, and so are the ones waiting on them
+                blocked = list(waiting.get(id(j),[]))
+                for dependent in blocked:
+                    if j.status=='done':
+                        self._submit(dependent,finished)
+                    else:
+                        dependent.status = 'skipped'
+                        remaining -= 1
+                        blocked.extend(waiting.get(id(dependent),[]))
+            self._stopPools(True)
+        finally:
+            self._stopPools(False)
+        self.seconds = time.time()-start
+        return self.failed()
+
+    def runShared(self,work_queue,poll=1.0):
+        #like run, but sharing the jobs with every scheduler that uses work_queue: a job
+        #runs here once claimed, while there is room in its pool and the job it waits for
+        #has finished anywhere. jobs finished by another scheduler count as 'elsewhere'
+        #(or failed), and claims of dead workers are released every poll seconds
+        start = time.time()
+        finished = queue.Queue()
+        names = dict((id(j),workqueue.jobName(j.label())) for j in self.jobs)
+        work_queue.register([names[id(j)] for j in self.jobs])
+        pending = list(self.jobs)
+        busy = dict((name,0) for name in self.workers)
+        done = 0
+        self._startPools()
+        work_queue.start()
+        try:
+            while pending or sum(busy.values()):
+                for j in list(pending):
+                    state = work_queue.state(names[id(j)])
+                    if j.after is not None and j.after.status in ['failed','skipped']:
+                        j.status = 'skipped'
+                    elif state is not None:
+                        j.status = 'elsewhere' if state[0]=='done' else 'failed'
+                        if state[0]=='failed':
+                            j.error = '{} on {}'.format(state[1].get('error','').rstrip(),state[1]['worker'])
+                    elif busy[j.pool]<self.workers[j.pool] and (j.after is None or j.after.finished()) \
+                            and work_queue.claim(names[id(j)]):
+                        busy[j.pool] += 1
+                        self._submit(j,finished)
+                    else:
+                        continue
+                    pending.remove(j)
+                    if j.status!='running':
+                        done += 1
+                        print('[{}/{}] {} {}'.format(done,len(self.jobs),j.label(),j.status))
+                #a timeout keeps the wait interruptible with Ctrl-C
+                try:
+                    j,future = finished.get(timeout=poll)
+                except queue.Empty:
+                    for name in work_queue.releaseStale():
+                        print('Released the claim of a dead worker on {}'.format(name))
+                    continue
+                j.result,j.error,j.seconds,j.output,j.record = self._outcome(j,future)
+                busy[j.pool] -= 1
+                done += 1
+                j.status = 'failed' if j.error is not None else 'done'
+                work_queue.finish(names[id(j)],j.status=='done',{'seconds':j.seconds,'error':j.error})
+                print('[{}/{}] {} {} ({:.2f} s)'.format(done,len(self.jobs),j.label(),j.status,j.seconds))
+            self._stopPools(True)
+        finally:
+            work_queue.stop()
+            self._stopPools(False)
+        self.seconds = time.time()-start
+        return self.failed()
+
+    def failed(self):
+        return [j for j in self.jobs if j.status=='failed']
+
+    def summary(self):
+        #one table of every job, totals per stage, then the failures with their output
+        lines = ['{:<50} {:>8} {:>10}'.format('Job','Status','Seconds')]
+        for j in self.jobs:
+            lines.append('{:<50} {:>8} {:>10.2f}'.format(j.label(),j.status,j.seconds))
+        lines.append('')
+        stages = []
+        for j in self.jobs:
+            if j.stage not in stages:
+                stages.append(j.stage)
+        for stage in stages:
+            jobs = [j for j in self.jobs if j.stage==stage]
+            counts = ', '.join('{} {}'.format(len([j for j in jobs if j.status==status]),status)
+                for status in ['done','elsewhere','failed','skipped'])
+            lines.append('{}: {} jobs ({}), {:.2f} s of work'.format(stage,len(jobs),counts,sum(j.seconds for j in jobs)))
+        lines.append('{} jobs in {:.2f} s with {}'.format(len(self.jobs),self.seconds,
+            ', '.join('{} {} workers'.format(count,name) for name,count in sorted(self.workers.items()))))
+        for j in self.failed():
+            lines.append('')
+            lines.append('{} failed:'.format(j.label()))
+            if j.output and j.output.strip():
+                lines.append(j.output.rstrip())
+            lines.append(j.error.rstrip())
+        return '\n'.join(lines)
@@ -0,0 +1,303 @@
+import os
+import re
+import sys
+import glob
+import time
+import multiprocessing
+import numpy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brownian_to_fluorosim'))
+import tiff_io
+
+#finds and fits the fluorescent spots in the stacks made by BrownianXMLtoTIFF
+#each *_tiff folder is read one stack (time point) at a time. spots are local maxima well
+#above the background, and each is fitted with a Gaussian (3D, or 2D on the max projection)
+#by Levenberg-Marquardt steps done for all spots of a stack at once. for every folder it writes
+#a table of the spots of each frame and the separation of the two brightest spots over time.
+
+USAGE_STR = '''Usage:
+{program_name} [args] folder [folder ...]
+        folder: a *_tiff folder from BrownianXMLtoTIFF, or a folder to search for them
+        [args]:
+          [-channel name]: only stacks with this in their name (default green)
+          [-2d]: fit 2D Gaussians on the maximum projection instead of 3D Gaussians
+          [-threshold k]: spots must be k noise levels above the background (default 5)
+          [-min_distance n]: pixels between two spots (default 2)
+          [-max_spots n]: keeps the n brightest spots of each stack (default 10)
+          [-window n]: fits use pixels up to n away from the spot (default 3)
+          [-pixel_size nm],[-voxel_depth nm]: size of the pixels and distance between the focal planes,
+            positions and separations are in nanometers (default ParseBrownian's, 63.0971 and 200)
+          [-out folder]: where to write the tables (default: next to each *_tiff folder)
+          [-jobs n]: folders analyzed at once (default 1)
+          [-h],[-help]: prints out usage information and exits
+'''
+
+SPOT_HEADER = ['frame','spot','x','y','z','amplitude','background','sigma','sigma_z','fit_ok']
+SEPARATION_HEADER = ['frame','spots','separation']
+
+#ParseBrownian's default pixel size and focal plane spacing, nanometers
+PIXEL_SIZE = 63.0971
+VOXEL_DEPTH = 200.0
+
+#Levenberg-Marquardt settings
+FIT_ITERATIONS = 20
+FIT_DAMPING = 1e-3
+
+class spotSettings:
+    def __init__(self):
+        self.channel = 'green'
+        self.fit_3d = True
+        self.threshold = 5.0
+        self.min_distance = 2
+        self.max_spots = 10
+        self.window = 3
+        self.pixel_size = PIXEL_SIZE
+        self.voxel_depth = VOXEL_DEPTH
+        self.out_folder = None
+        self.jobs = 1
+
+def stackNumber(path):
+    #the integer after the last _ in the name, as BrownianXMLtoTIFF sorts by
+    return int(re.findall(r'\d+',os.path.basename(path))[-1])
+
+def maxFilter(stack,radius):
+    #maximum over a box of +-radius along each axis, one axis at a time
+    for axis in range(stack.ndim):
+        if stack.shape[axis]==1:
+            continue
+        padded = numpy.pad(stack,[(radius,radius) if a==axis else (0,0) for a in range(stack.ndim)],
+                           mode='constant',constant_values=-numpy.inf)
+        out = numpy.full(stack.shape,-numpy.inf)
+        for shift in range(2*radius+1):
+            numpy.maximum(out,numpy.take(padded,range(shift,shift+stack.shape[axis]),axis=axis),out=out)
+        stack = out
+    return stack
+
+def findSpots(stack,settings):
+    #(n, 3) z, y, x pixel indices of the local maxima above the threshold, brightest first
+    background = numpy.median(stack)
+    noise = 1.4826*numpy.median(numpy.abs(stack-background))
+    if noise==0:
+        #noiseless images, such as renders without noise: one intensity level
+        noise = 1.0
+    peaks = (stack==maxFilter(stack,settings.min_distance)) & (stack>background+settings.threshold*noise)
+    candidates = numpy.argwhere(peaks)
+    candidates = candidates[numpy.argsort(-stack[peaks],kind='stable')]
+    #flat tops (e.g. saturated pixels) give several maxima, keep the first of each
+    spots = []
+    for candidate in candidates:
+        if len(spots)==settings.max_spots:
+            break
+        if not spots or numpy.abs(numpy.array(spots)-candidate).max(axis=1).min()>settings.min_distance:
+            spots.append(candidate)
+    return numpy.array(spots,dtype=int).reshape(-1,3)
+
+def extractWindows(stack,spots,window):
+    #(n, wz, wy, wx) pixels around each spot, the offsets of the window, and which of the
+    #window's pixels are inside the stack (the others are 0 and get no weight in the fit)
+    half = [min(window,(size-1)//2) if size>1 else 0 for size in stack.shape]
+    padded = numpy.pad(stack,[(h,h) for h in half],mode='constant')
+    inside = numpy.pad(numpy.ones(stack.shape,dtype=bool),[(h,h) for h in half],mode='constant')
+    offsets = [numpy.arange(-h,h+1) for h in half]
+    zz = spots[:,0,None,None,None]+half[0]+offsets[0][None,:,None,None]
+    yy = spots[:,1,None,None,None]+half[1]+offsets[1][None,None,:,None]
+    xx = spots[:,2,None,None,None]+half[2]+offsets[2][None,None,None,:]
+    return (padded[zz,yy,xx],offsets,inside[zz,yy,xx])
+
+def gaussianModel(params,offsets,fit_3d):
+    #values and (n, pixels, parameters) Jacobian of Gaussians on the window grid
+    #params are amplitude, x, y, background, sigma, and for 3D also z, sigma_z
+    dz,dy,dx = [o.astype('float64') for o in offsets]
+    Z,Y,X = numpy.meshgrid(dz,dy,dx,indexing='ij')
+    X = X.ravel()[None]
+    Y = Y.ravel()[None]
+    Z = Z.ravel()[None]
+    A,x0,y0,B,s = [params[:,k,None] for k in range(5)]
+    ex = (X-x0)**2+(Y-y0)**2
+    if fit_3d:
+        z0,sz = params[:,5,None],params[:,6,None]
+        ez = (Z-z0)**2
+    else:
+        ez = 0.0*X
+        sz = numpy.ones_like(s)
+    g = numpy.exp(-ex/(2*s**2)-ez/(2*sz**2))
+    columns = [g,A*g*(X-x0)/s**2,A*g*(Y-y0)/s**2,numpy.ones_like(g),A*g*ex/s**3]
+    if fit_3d:
+        columns += [A*g*(Z-z0)/sz**2,A*g*ez/sz**3]
+    return (A*g+B,numpy.stack(columns,axis=2))
+
+def fitGaussians(windows,offsets,fit_3d,inside=None):
+    #Levenberg-Marquardt fit of every window at once, only of the pixels inside the stack
+    #(all by default); returns (params, fit_ok)
+    n = len(windows)
+    if inside is None:
+        inside = numpy.ones(windows.shape,dtype=bool)
+    data = windows.reshape(n,-1).astype('float64')
+    weight = inside.reshape(n,-1).astype('float64')
+    if not fit_3d:
+        data = windows.max(axis=1).reshape(n,-1).astype('float64')
+        weight = inside.any(axis=1).reshape(n,-1).astype('float64')
+        offsets = [numpy.zeros(1,dtype=int),offsets[1],offsets[2]]
+    background = numpy.where(weight>0,data,numpy.inf).min(axis=1)
+    params = numpy.zeros((n,7 if fit_3d else 5))
+    params[:,0] = numpy.where(weight>0,data,-numpy.inf).max(axis=1)-background
+    params[:,3] = background
+    params[:,4] = 1.5
+    if fit_3d:
+        params[:,6] = 1.5
+    damping = numpy.full(n,FIT_DAMPING)
+    model,jacobian = gaussianModel(params,offsets,fit_3d)
+    cost = (weight*(model-data)**2).sum(axis=1)
+    for iteration in range(FIT_ITERATIONS):
+        JTJ = numpy.einsum('npi,np,npj->nij',jacobian,weight,jacobian)
+        JTr = numpy.einsum('npi,np->ni',jacobian,weight*(data-model))
+        diagonal = numpy.einsum('nii->ni',JTJ)
+        step = numpy.linalg.solve(JTJ+(damping[:,None]*(diagonal+1e-9))[:,:,None]*numpy.eye(len(params[0]))[None],JTr[:,:,None])[:,:,0]
+        trial = params+step
+        trial_model,trial_jacobian = gaussianModel(trial,offsets,fit_3d)
+        trial_cost = (weight*(trial_model-data)**2).sum(axis=1)
+        better = numpy.isfinite(trial_cost) & (trial_cost<cost)
+        params[better] = trial[better]
+        model[better] = trial_model[better]
+        jacobian[better] = trial_jacobian[better]
+        cost[better] = trial_cost[better]
+        damping = numpy.where(better,damping/10,damping*10)
+    #a fit is trusted if its center stayed inside the window and its width is sensible
+    limits = [offsets[2].max(),offsets[1].max()]
+    fit_ok = numpy.all(numpy.isfinite(params),axis=1) & (params[:,0]>0) & (numpy.abs(params[:,4])>0.1)
+    fit_ok &= (numpy.abs(params[:,1])<=limits[0]) & (numpy.abs(params[:,2])<=limits[1])
+    if fit_3d:
+        fit_ok &= (numpy.abs(params[:,5])<=max(offsets[0].max(),0.5)) & (numpy.abs(params[:,6])>0.1)
+    return (params,fit_ok)
+
+def analyzeStack(stack,settings):
+    #rows of x, y, z, amplitude, background, sigma, sigma_z, fit_ok for each spot of one stack
+    stack = numpy.asarray(stack,dtype='float64')
+    if not settings.fit_3d:
+        stack = stack.max(axis=0)[None]
+    spots = findSpots(stack,settings)
+    if len(spots)==0:
+        return numpy.zeros((0,8))
+    windows,offsets,inside = extractWindows(stack,spots,settings.window)
+    params,fit_ok = fitGaussians(windows,offsets,settings.fit_3d,inside)
+    #nor is a fit whose center left the stack
+    fit_ok &= numpy.abs(spots[:,2]+params[:,1]-(stack.shape[2]-1)/2.0)<=stack.shape[2]/2.0
+    fit_ok &= numpy.abs(spots[:,1]+params[:,2]-(stack.shape[1]-1)/2.0)<=stack.shape[1]/2.0
+    if settings.fit_3d:
+        fit_ok &= numpy.abs(spots[:,0]+params[:,5]-(stack.shape[0]-1)/2.0)<=stack.shape[0]/2.0
+    rows = numpy.zeros((len(spots),8))
+    #failed fits keep the pixel of the maximum
+    rows[:,0] = spots[:,2]+numpy.where(fit_ok,params[:,1],0)
+    rows[:,1] = spots[:,1]+numpy.where(fit_ok,params[:,2],0)
+    rows[:,2] = spots[:,0]+(numpy.where(fit_ok,params[:,5],0) if settings.fit_3d else 0)
+    rows[:,3] = params[:,0]
+    rows[:,4] = params[:,3]
+    rows[:,5] = numpy.abs(params[:,4])
+    rows[:,6] = numpy.abs(params[:,6]) if settings.fit_3d else numpy.nan
+    rows[:,7] = fit_ok
+    #to nanometers
+    rows[:,:2] *= settings.pixel_size
+    rows[:,5] *= settings.pixel_size
+    rows[:,2] *= settings.voxel_depth
+    rows[:,6] *= settings.voxel_depth
+    return rows
+
+def separation(rows):
+    #distance between the two brightest spots, nan if there are fewer
+    if len(rows)<2:
+        return float('nan')
+    return float(numpy.sqrt(((rows[0,:3]-rows[1,:3])**2).sum()))
+
+def outputPrefix(folder,settings):
+    if settings.out_folder is None:
+        return os.path.normpath(folder)
+    #condition, SRC set and SRC, so folders of different conditions do not collide
+    parts = os.path.normpath(os.path.abspath(folder)).split(os.sep)[-3:]
+    return os.path.join(settings.out_folder,'_'.join(parts))
+
+def analyzeFolder(job):
+    #writes the spot table and separations of one folder, returns (folder, stacks, seconds)
+    folder,settings = job
+    start = time.time()
+    stacks = sorted(glob.glob(os.path.join(folder,'*{}*.tif*'.format(settings.channel))),key=stackNumber)
+    prefix = outputPrefix(folder,settings)
+    with open(prefix+'_spots.csv','w') as spots_file:
+        with open(prefix+'_separation.csv','w') as separation_file:
+            spots_file.write(','.join(SPOT_HEADER)+'\n')
+            separation_file.write(','.join(SEPARATION_HEADER)+'\n')
+            #one stack in memory at a time
+            for path in stacks:
+                frame = stackNumber(path)
+                rows = analyzeStack(tiff_io.read_stack(path),settings)
+                for k,row in enumerate(rows):
+                    spots_file.write('{},{},{}\n'.format(frame,k,','.join(repr(float(v)) for v in row[:7])+','+str(int(row[7]))))
+                separation_file.write('{},{},{!r}\n'.format(frame,len(rows),separation(rows)))
+    return (folder,len(stacks),time.time()-start)
+
+def findFolders(paths):
+    #the *_tiff folders given or under the folders given
+    folders = []
+    for path in paths:
+        if os.path.basename(os.path.normpath(path)).endswith('_tiff'):
+            folders.append(path)
+            continue
+        for root,dirs,files in os.walk(path):
+            dirs.sort()
+            for name in dirs:
+                if name.endswith('_tiff'):
+                    folders.append(os.path.join(root,name))
+    return folders
+
+def main():
+    if '-h' in sys.argv or '-help' in sys.argv or len(sys.argv)<2:
+        print(USAGE_STR.format(program_name=sys.argv[0]))
+        sys.exit(1)
+    settings = spotSettings()
+    i = 1
+    while i<len(sys.argv) and sys.argv[i].startswith('-'):
+        if sys.argv[i]=='-2d':
+            settings.fit_3d = False
+            i += 1
+            continue
+        elif sys.argv[i]=='-channel':
+            settings.channel = sys.argv[i+1]
+        elif sys.argv[i]=='-threshold':
+            settings.threshold = float(sys.argv[i+1])
+        elif sys.argv[i]=='-min_distance':
+            settings.min_distance = int(sys.argv[i+1])
+        elif sys.argv[i]=='-max_spots':
+            settings.max_spots = int(sys.argv[i+1])
+        elif sys.argv[i]=='-window':
+            settings.window = int(sys.argv[i+1])
+        elif sys.argv[i]=='-pixel_size':
+            settings.pixel_size = float(sys.argv[i+1])
+        elif sys.argv[i]=='-voxel_depth':
+            settings.voxel_depth = float(sys.argv[i+1])
+        elif sys.argv[i]=='-out':
+            settings.out_folder = sys.argv[i+1]
+        elif sys.argv[i]=='-jobs':
+            settings.jobs = max(1,int(sys.argv[i+1]))
+        i += 2
+    folders = findFolders(sys.argv[i:])
+    if settings.out_folder is not None and not os.path.isdir(settings.out_folder):
+        os.makedirs(settings.out_folder)
+    print('Analyzing {} folders...'.format(len(folders)))
+    start = time.time()
+    jobs = [(folder,settings) for folder in folders]
+    if settings.jobs>1:
+        pool = multiprocessing.Pool(settings.jobs)
+        results = pool.imap_unordered(analyzeFolder,jobs)
+    else:
+        pool = None
+        results = (analyzeFolder(job) for job in jobs)
+    stacks = 0
+    for folder,count,seconds in results:
+        stacks += count
+        print('{}: {} stacks in {:.2f} seconds'.format(folder,count,seconds))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time()-start
+    print('Analyzed {} stacks in {:.2f} seconds ({:.2f} stacks per second)'.format(stacks,elapsed,stacks/max(elapsed,1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -1,66 +1,53 @@
 import os
+import sys
 import fnmatch
+import numpy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brownian_to_fluorosim'))
+import brownian_frames
+import trajectory_store
+import src_masks
+import compressed_io
 
 #this needs to make the array of T/F
+#a bead is labeled when its line is exactly 4, padded with unlabeled beads up to number
 def getColorArray(path,number):
-    f = open(path,'r')
-    mass_color = []
-    for line in f:
-        if '4' in line:
-            mass_color.append(True)
-        if '0' in line:
-            mass_color.append(False)
-    length = len(mass_color)
-    for i in range(length,number):
-        mass_color.append(False)
-    assert(len(mass_color)==number)
-    f.close()
-    return mass_color
+    return src_masks.src_mask(path,number).tolist()
 
 def getMassColor(path):
-    f = open(path,'r')
-    mass_color = []
-    for line in f:
-        if '4' in line:
-            mass_color.append(True)
-        if '0' in line:
-            mass_color.append(False)
-    return mass_color
+    return src_masks.src_mask(path).tolist()
 
-def processHeaderMicrons(path,out_path,length):
-    mass_counter = 0
-    in_time_step = False
-    file_name = path.split('/')[-1].split('.')[0]
-    processed_file = open(out_path,'a')
-    f = open(path,'r')
-    if(length>0):
-        for line in f:
-            if line.startswith('Time'):
-                in_time_step = True
-                processed_file.write(line)
-                continue
-            if in_time_step:
-                coordinates = line.strip().split(' ')
-                processed_file.write(str(1000000.*float(coordinates[0]))+' '+str(1000000.*float(coordinates[1]))+' '+str(1000000.*float(coordinates[2]))+'\n')
-                mass_counter+=1
-                if(mass_counter==length):
-                    #unsure if I need to write out this newline
-                    processed_file.write('\n')
-                    in_time_step = False
-                    mass_counter = 0
+def countBeads(path):
+    return brownian_frames.count_beads(path)
+
+#path can be compressed (.gz, .bz2, .xz), and so can out_path to write it compressed
+def processHeaderMicrons(path,out_path,length=None):
+    processed_file = compressed_io.open_file(out_path,'a')
+    if(length is None or length>0):
+        for time,frame in brownian_frames.iter_frames(path,1000000.,length):
+            processed_file.write('Time {!r}\n'.format(time))
+            processed_file.write(('%r %r %r\n'*len(frame)) % tuple(frame.ravel().tolist()))
+            #unsure if I need to write out this newline
+            processed_file.write('\n')
     processed_file.close()
-    f.close()
+    return out_path
+
+#same as processHeaderMicrons, but writes a binary trajectory store instead of text
+def processHeaderStore(path,out_path,length=None,dtype='float64'):
+    if length is None:
+        length = countBeads(path)
+    with trajectory_store.store_writer(out_path,length,dtype) as store:
+        if(length>0):
+            for time,frame in brownian_frames.iter_frames(path,1000000.,length):
+                store.append(time,frame)
     return out_path
 
 def convertColorFiles(file_name,out_path,number):
     for csv in os.listdir(file_name):
-        with open(os.path.join(file_name,csv),'r') as csv_file:
-            out_file = open(os.path.join(out_path,csv.split('.')[0]+'.txt'),'a')
-            mass_color = getColorArray(os.path.join(file_name,csv),number)
-            for mass in mass_color:
-                if mass:
-                    out_file.write('4'+'\n')
-                if not mass:
-                    out_file.write('0'+'\n')
-            out_file.close()
+        mask_color = src_masks.src_mask(os.path.join(file_name,csv),number)
+        with open(os.path.join(out_path,csv.split('.')[0]+'.txt'),'a') as out_file:
+            out_file.write(''.join(numpy.where(mask_color,'4\n','0\n')))
     return
+
+#same as convertColorFiles, but puts every SRC of file_name into one packed mask store
+def convertColorStore(file_name,out_path,number):
+    return src_masks.convert_src_folder(file_name,out_path,number)
@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import errno
+import time
+import socket
+import threading
+import contextlib
+
+#a queue of jobs shared by processes on several machines through a folder on a shared
+#filesystem, without any server: every process builds the same list of jobs and runs
+#the ones it manages to claim. the folder holds
+#  jobs.json         the names of the jobs, written by the first process, so the others
+#                    can check they were started the same way
+#  claims/<job>      a lock file, created atomically by the one process that runs the job
+#  done/<job>        written once the job succeeded; failed/<job> once it failed
+#  workers/<worker>  touched by each process, its time is the filesystem's clock
+#a process touches the claims it holds every heartbeat seconds. a claim not touched for
+#stale seconds (or of a process on this machine that is gone) was left by a dead worker
+#and is released, so the job runs again elsewhere. outputs are built under temporary
+#names and carry on from what a dead worker finished (buildgraph), so a job run twice
+#is only time lost.
+
+#seconds between touching the claims, and how long a claim can go untouched
+HEARTBEAT = 10.0
+STALE = 60.0
+
+def jobName(label):
+    #file name of a job, from its label
+    return re.sub('[^A-Za-z0-9_.-]+','_',label)
+
+def _processAlive(pid):
+    try:
+        os.kill(pid,0)
+    except OSError as error:
+        #it exists, but belongs to someone else
+        return error.errno==errno.EPERM
+    return True
+
+def _writeAtomic(path,text):
+    tmp_path = '{}.{}.{}.tmp'.format(path,socket.gethostname(),os.getpid())
+    with open(tmp_path,'w') as tmp_file:
+        tmp_file.write(text)
+    if os.name=='nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path,path)
+
+class workQueue:
+    def __init__(self,folder,worker=None,heartbeat=HEARTBEAT,stale=STALE):
+        self.folder = folder
+        self.worker = jobName(worker if worker is not None else '{}-{}'.format(socket.gethostname(),os.getpid()))
+        self.heartbeat = heartbeat
+        self.stale = stale
+        self.held = set()
+        self._stop = threading.Event()
+        self._thread = None
+        for sub in ['claims','done','failed','workers']:
+            if not os.path.isdir(os.path.join(folder,sub)):
+                try:
+                    os.makedirs(os.path.join(folder,sub))
+                except OSError:
+                    #made by another worker at the same time
+                    if not os.path.isdir(os.path.join(folder,sub)):
+                        raise
+        self.touch()
+
+    def _path(self,kind,name):
+        return os.path.join(self.folder,kind,name)
+
+    def register(self,names):
+        #records the job names of the run, or checks them against the ones recorded
+        path = os.path.join(self.folder,'jobs.json')
+        try:
+            fd = os.open(path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except OSError:
+            for k in range(50):
+                try:
+                    with open(path) as jobs_file:
+                        recorded = json.load(jobs_file)
+                    break
+                except ValueError:
+                    #still being written
+                    time.sleep(0.1)
+            else:
+                raise Exception('{} cannot be read'.format(path))
+            if recorded!=list(names):
+                raise Exception('The jobs of this run differ from the ones in {}; start every worker with the same data and arguments'.format(self.folder))
+            return
+        with os.fdopen(fd,'w') as jobs_file:
+            json.dump(list(names),jobs_file)
+
+    def touch(self):
+        #touches our worker file, returns its time: now, on the filesystem's clock
+        path = self._path('workers',self.worker)
+        with open(path,'a'):
+            os.utime(path,None)
+        return os.path.getmtime(path)
+
+    def state(self,name):
+        #('done'|'failed', what the worker recorded) once the job has finished, else None
+        for kind in ['done','failed']:
+            try:
+                with open(self._path(kind,name)) as state_file:
+                    return (kind,json.load(state_file))
+            except (IOError,OSError,ValueError):
+                continue
+        return None
+
+    def claim(self,name):
+        #True if we now hold the job; only one worker can create its claim
+        path = self._path('claims',name)
+        try:
+            fd = os.open(path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except OSError:
+            return False
+        with os.fdopen(fd,'w') as claim_file:
+            json.dump({'worker':self.worker,'host':socket.gethostname(),'pid':os.getpid(),'claimed':time.time()},claim_file)
+        #it may have finished between looking and claiming
+        if self.state(name) is not None:
+            os.remove(path)
+            return False
+        self.held.add(name)
+        return True
+
+    def finish(self,name,ok,info=None):
+        #records the job as done (or failed) with info, then lets go of its claim
+        info = dict(info or {},worker=self.worker,finished=time.time())
+        _writeAtomic(self._path('done' if ok else 'failed',name),json.dumps(info))
+        self.release(name)
+
+    def release(self,name):
+        self.held.discard(name)
+        try:
+            os.remove(self._path('claims',name))
+        except OSError:
+            pass
+
+    def _isStale(self,path,now):
+        try:
+            with open(path) as claim_file:
+                owner = json.load(claim_file)
+            if owner['host']==socket.gethostname() and not _processAlive(owner['pid']):
+                return True
+        except (IOError,OSError,ValueError,KeyError):
+            #being written, or gone
+            pass
+        try:
+            return now-os.path.getmtime(path)>self.stale
+        except OSError:
+            return False
+
+    def releaseStale(self):
+        #releases the claims of dead workers, returns their job names
+        now = self.touch()
+        released = []
+        for name in os.listdir(os.path.join(self.folder,'claims')):
+            path = self._path('claims',name)
+            if name in self.held or name.endswith('.released') or not self._isStale(path,now):
+                continue
+            #renamed out of the way first, so only one worker releases it; if it was
+            #claimed again in between, the new claim is put back
+            broken = '{}.{}.released'.format(path,self.worker)
+            try:
+                os.rename(path,broken)
+            except OSError:
+                continue
+            if not self._isStale(broken,now):
+                try:
+                    os.link(broken,path)
+                except (OSError,AttributeError):
+                    pass
+                os.remove(broken)
+                continue
+            os.remove(broken)
+            released.append(name)
+        return released
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            self.touch()
+            for name in list(self.held):
+                try:
+                    os.utime(self._path('claims',name),None)
+                except OSError:
+                    pass
+
+    def start(self):
+        #touches our claims every heartbeat seconds until stop; False if already doing so
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._beat)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _stopBeat(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stop(self):
+        self._stopBeat()
+        for name in list(self.held):
+            self.release(name)
+
+    @contextlib.contextmanager
+    def exclusive(self,name,poll=1.0):
+        #runs the block in one worker at a time, waiting for the others to finish it
+        path = self._path('claims',name)
+        while True:
+            try:
+                fd = os.open(path,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+                break
+            except OSError:
+                self.releaseStale()
+                time.sleep(poll)
+        with os.fdopen(fd,'w') as claim_file:
+            json.dump({'worker':self.worker,'host':socket.gethostname(),'pid':os.getpid(),'claimed':time.time()},claim_file)
+        self.held.add(name)
+        #its claim is touched like the others, or a block longer than stale would look
+        #like a dead worker's and run in another worker at the same time
+        beating = self.start()
+        try:
+            yield
+        finally:
+            self.release(name)
+            if beating:
+                self._stopBeat()